@@ -0,0 +1,338 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "btl-utils",
+    "db_cache.sqlite",
+)
+
+# Cache modes
+# on:      return cached rows that are younger than the table TTL, otherwise query and store
+# refresh: always query and store (overwrite) the rows
+# offline: only return cached rows (ignoring the TTL); never query the database
+# off:     no caching
+MODES = ["on", "refresh", "offline", "off"]
+
+# Time to live (in seconds) of the cached rows for each table
+# The smallest TTL is used for queries that read several tables
+DEFAULT_TTL = 1800
+
+# Number of rows read from/written to the cache file at a time
+BATCH_SIZE = 5000
+
+# Time (in seconds) to wait for the lock of the cache file
+SQLITE_TIMEOUT = 60
+TABLE_TTLS = {
+    "parts": 1800,
+    "p3": 1800,
+    "p10": 1800,
+    "p11": 1800,
+    "p100": 1800,
+    "c3000": 86400,
+    "c3060": 86400,
+}
+
+
+class OfflineCacheMiss(Exception) :
+    
+    def __init__(self, query, params) :
+        
+        self.query = query
+        self.params = params
+    
+    def __str__(self) :
+        
+        return f"Query not found in the cache (offline mode): {self.query} {self.params or ''}"
+
+
+def normalize_query(query) :
+    """
+    Collapse whitespace outside of quoted strings
+    """
+    
+    l_tokens = re.split(r"('(?:[^']|'')*')", query.strip())
+    l_tokens = [_tok if _tok.startswith("'") else re.sub(r"\s+", " ", _tok) for _tok in l_tokens]
+    
+    return "".join(l_tokens)
+
+
+def get_query_tables(query) :
+    
+    return sorted(set(_tab.lower() for _tab in re.findall(r"mtd_cmsr\.(\w+)", query, flags = re.IGNORECASE)))
+
+
+class QueryCache :
+    """
+    Read-through cache of database query results, stored in a local SQLite file
+    Keyed by the server URL, the normalized query and its bind parameters
+    (so that the results of e.g. a local stand-in server are never returned for the tunnel)
+    """
+    
+    def __init__(self, fname = DEFAULT_CACHE_FILE, mode = "on", d_ttls = None) :
+        
+        assert (mode in MODES), f"Invalid cache mode {mode}. Must be one of: {MODES}"
+        
+        self.fname = fname
+        self.mode = mode
+        self.d_ttls = {**TABLE_TTLS, **(d_ttls or {})}
+        self.d_stats = {"hits": 0, "misses": 0, "expired": 0, "stores": 0}
+        self.lock = threading.Lock()
+        self.conn = None
+        
+        if (mode != "off") :
+            
+            cache_dir = os.path.dirname(fname)
+            
+            if len(cache_dir) :
+                
+                os.makedirs(cache_dir, exist_ok = True)
+            
+            self.conn = sqlite3.connect(fname, check_same_thread = False, timeout = SQLITE_TIMEOUT)
+            # WAL: the readers of iter_rows keep a consistent snapshot while rows are stored
+            self.conn.execute("pragma journal_mode = wal")
+            self.conn.execute("create table if not exists queries (key text primary key, query text, params text, tables text, fetched real, nrows integer)")
+            self.conn.execute("create table if not exists rows (key text, idx integer, data text, primary key (key, idx))")
+            self.conn.commit()
+    
+    def key(self, query, params = None, server = None) :
+        
+        params_str = json.dumps({str(_key): str(_val) for _key, _val in (params or {}).items()}, sort_keys = True)
+        
+        return hashlib.sha1(f"{server or ''}\n{normalize_query(query)}\n{params_str}".encode("utf-8")).hexdigest()
+    
+    def ttl(self, query) :
+        
+        l_ttls = [self.d_ttls.get(_tab, DEFAULT_TTL) for _tab in get_query_tables(query)]
+        
+        return min(l_ttls) if l_ttls else DEFAULT_TTL
+    
+    def lookup(self, query, params = None, server = None) :
+        """
+        Get the cache key if the query results of the server are cached (and have not expired), otherwise None
+        Raises OfflineCacheMiss in offline mode if the query is not in the cache
+        """
+        
+        if (self.mode in ["off", "refresh"]) :
+            
+            return None
+        
+        key = self.key(query, params, server = server)
+        
+        with self.lock :
+            
+            res = self.conn.execute("select fetched from queries where key = ?", (key,)).fetchone()
+            
+            if (res is None) :
+                
+                self.d_stats["misses"] += 1
+            
+            elif (self.mode != "offline" and (time.time() - res[0]) > self.ttl(query)) :
+                
+                self.d_stats["expired"] += 1
+                self.d_stats["misses"] += 1
+                return None
+            
+            else :
+                
+                self.d_stats["hits"] += 1
+                return key
+        
+        if (self.mode == "offline") :
+            
+            raise OfflineCacheMiss(query, params)
+        
+        return None
+    
+    def iter_rows(self, key, batch_size = BATCH_SIZE) :
+        """
+        Iterate over the cached rows of a query (read in batches)
+        The rows are read from one snapshot of the cache file (own connection, one read transaction),
+        so a concurrent store of the same query does not change them while iterating
+        """
+        
+        conn = sqlite3.connect(self.fname, timeout = SQLITE_TIMEOUT, isolation_level = None)
+        
+        try :
+            
+            conn.execute("begin")
+            
+            # Rows stored (swapped in) since the lookup are read as well: they are a complete result too
+            if (conn.execute("select 1 from queries where key = ?", (key,)).fetchone() is None) :
+                
+                logger.warning(f"Cached query {key} was removed before it could be read")
+            
+            idx = -1
+            
+            while True :
+                
+                l_batch = conn.execute("select idx, data from rows where key = ? and idx > ? order by idx limit ?", (key, idx, batch_size)).fetchall()
+                
+                if not l_batch :
+                    
+                    break
+                
+                idx = l_batch[-1][0]
+                
+                for _, data in l_batch :
+                    
+                    yield json.loads(data)
+        
+        finally :
+            
+            conn.close()
+    
+    def get(self, query, params = None, server = None) :
+        """
+        Get the cached rows, or None if they need to be fetched from the database
+        Raises OfflineCacheMiss in offline mode if the query is not in the cache
+        """
+        
+        key = self.lookup(query, params, server = server)
+        
+        return list(self.iter_rows(key)) if (key is not None) else None
+    
+    def store(self, query, params, rows, batch_size = BATCH_SIZE, server = None) :
+        """
+        Store the rows of a query while passing them through (generator)
+        The rows are written under a temporary key, and swapped in with the query once all rows have been consumed
+        (so concurrent stores of the same query do not collide and the readers never see a partial result)
+        """
+        
+        if (self.mode in ["off", "offline"]) :
+            
+            yield from rows
+            return
+        
+        key = self.key(query, params, server = server)
+        tmp_key = f"{key}.{uuid.uuid4().hex}"
+        complete = False
+        
+        try :
+            
+            nrows = 0
+            l_batch = []
+            
+            for row in rows :
+                
+                l_batch.append((tmp_key, nrows, json.dumps(row)))
+                nrows += 1
+                
+                yield row
+                
+                if (len(l_batch) >= batch_size) :
+                    
+                    with self.lock :
+                        
+                        self.conn.executemany("insert into rows (key, idx, data) values (?, ?, ?)", l_batch)
+                        self.conn.commit()
+                    
+                    l_batch = []
+            
+            with self.lock :
+                
+                # One transaction: the previous rows of the query are replaced by the new ones
+                self.conn.executemany("insert into rows (key, idx, data) values (?, ?, ?)", l_batch)
+                self.conn.execute("delete from rows where key = ?", (key,))
+                nmoved = self.conn.execute("update rows set key = ? where key = ?", (key, tmp_key)).rowcount
+                
+                # The temporary rows were removed meanwhile (clear): do not record a partial result
+                if (nmoved != nrows) :
+                    
+                    logger.warning(f"Rows of the cached query {key} were removed while storing them; not caching it")
+                    return
+                
+                self.conn.execute("insert or replace into queries (key, query, params, tables, fetched, nrows) values (?, ?, ?, ?, ?, ?)", (
+                    key,
+                    normalize_query(query),
+                    json.dumps(params or {}, sort_keys = True),
+                    ",".join(get_query_tables(query)),
+                    time.time(),
+                    nrows,
+                ))
+                self.conn.commit()
+                self.d_stats["stores"] += 1
+            
+            complete = True
+        
+        finally :
+            
+            # Not fully consumed (or failed): drop the partial rows, the previous result (if any) stays cached
+            if not complete :
+                
+                with self.lock :
+                    
+                    self.conn.rollback()
+                    self.conn.execute("delete from rows where key = ?", (tmp_key,))
+                    self.conn.commit()
+    
+    def put(self, query, params, l_rows, server = None) :
+        """
+        Store the rows of a query
+        """
+        
+        for _ in self.store(query, params, l_rows, server = server) :
+            
+            pass
+    
+    def clear(self, table = None) :
+        """
+        Remove all cached queries, or only the ones that read the given table
+        """
+        
+        if (self.conn is None) :
+            
+            return
+        
+        with self.lock :
+            
+            if (table is None) :
+                
+                self.conn.execute("delete from rows")
+                self.conn.execute("delete from queries")
+            
+            else :
+                
+                l_keys = [_row[0] for _row in self.conn.execute("select key, tables from queries") if table.lower() in _row[1].split(",")]
+                self.conn.executemany("delete from rows where key = ?", ((_key,) for _key in l_keys))
+                self.conn.executemany("delete from queries where key = ?", ((_key,) for _key in l_keys))
+            
+            self.conn.commit()
+    
+    def stats(self) :
+        
+        return dict(self.d_stats)
+    
+    def print_stats(self) :
+        
+        nlookups = self.d_stats["hits"] + self.d_stats["misses"]
+        
+        if not (nlookups or self.d_stats["stores"]) :
+            
+            return
+        
+        hit_rate = 100.0 * self.d_stats["hits"] / nlookups if nlookups else 0.0
+        
+        logger.info(
+            f"Database cache ({self.mode}, {self.fname}): "
+            f"{self.d_stats['hits']} hits, {self.d_stats['misses']} misses ({self.d_stats['expired']} expired), "
+            f"{self.d_stats['stores']} stored, hit rate {hit_rate:0.1f}%"
+        )
+    
+    def close(self) :
+        
+        if (self.conn is not None) :
+            
+            self.conn.close()
+            self.conn = None
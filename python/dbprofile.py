@@ -0,0 +1,277 @@
+import atexit
+import contextvars
+import dataclasses
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import dbcache
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_TRACE_FILE = "dbprofile.jsonl"
+
+# Functions and modules of the database layer; the calling helper of a query is the first frame outside of them
+DB_LAYER_FUNCTIONS = ["iter_db_query", "_iter_db_query", "run_db_query", "run_db_queries", "run_db_query_subprocess"]
+DB_LAYER_MODULES = ["dbprofile", "dbcache", "rhapi", "threading", "concurrent.futures.thread", "contextlib"]
+
+# Record of the query being fetched (seen by the RhApi request hook, also in the page fetching threads)
+current_record = contextvars.ContextVar("dbprofile_current_record", default = None)
+
+# Calling helper of the queries submitted to a thread pool (see submit)
+current_helper = contextvars.ContextVar("dbprofile_current_helper", default = None)
+
+profiler = None
+
+
+@dataclasses.dataclass(init = True)
+class QueryRecord :
+    
+    helper: str
+    query: str
+    nparams: int = 0
+    cache: str = None
+    start: float = 0
+    wall: float = 0
+    round_trips: int = 0
+    http_time: float = 0
+    nrows: int = 0
+    nbytes: int = 0
+    error: str = None
+
+
+class DbProfiler :
+    """
+    Records the wall time, round trips, rows, bytes and cache status of every database query
+    The records are written to a JSON lines trace file (optional) and summarized per calling helper
+    """
+    
+    def __init__(self, tracefile = None) :
+        
+        self.tracefile = tracefile
+        self.lock = threading.Lock()
+        self.l_records = []
+        self.fopen = None
+        
+        if (tracefile is not None) :
+            
+            trace_dir = os.path.dirname(tracefile)
+            
+            if len(trace_dir) :
+                
+                os.makedirs(trace_dir, exist_ok = True)
+            
+            self.fopen = open(tracefile, "w")
+    
+    def profile(self, query, params, rows, helper = None) :
+        """
+        Iterate over the rows of a query and record it
+        helper is the calling helper of the query (see get_caller), taken when the query is made since the rows may be consumed elsewhere
+        The wall time only counts the fetching of the rows, not the time spent by the consumer between them
+        """
+        
+        record = QueryRecord(helper = helper or get_caller(), query = dbcache.normalize_query(query), nparams = len(params or {}), start = time.time())
+        
+        try :
+            
+            while True :
+                
+                # Only set the current record while fetching, the consumer may interleave other queries
+                token = current_record.set(record)
+                start = time.perf_counter()
+                
+                try :
+                    
+                    row = next(rows)
+                
+                except StopIteration :
+                    
+                    break
+                
+                finally :
+                    
+                    record.wall += time.perf_counter() - start
+                    current_record.reset(token)
+                
+                record.nrows += 1
+                
+                yield row
+        
+        except Exception as e :
+            
+            record.error = f"{type(e).__name__}: {e}"
+            raise
+        
+        finally :
+            
+            self.add(record)
+    
+    def on_request(self, record, method, url, status, nbytes, seconds) :
+        
+        with self.lock :
+            
+            record.round_trips += 1
+            record.nbytes += nbytes
+            record.http_time += seconds
+    
+    def add(self, record) :
+        
+        with self.lock :
+            
+            self.l_records.append(record)
+            
+            if (self.fopen is not None) :
+                
+                print(json.dumps(dataclasses.asdict(record)), file = self.fopen, flush = True)
+    
+    def summary(self) :
+        """
+        Summary table of the queries per calling helper, sorted by total wall time
+        """
+        
+        d_helpers = {}
+        
+        with self.lock :
+            
+            for record in self.l_records :
+                
+                d_stats = d_helpers.setdefault(record.helper, {"queries": 0, "hits": 0, "misses": 0, "errors": 0, "round_trips": 0, "rows": 0, "bytes": 0, "wall": 0.0, "max": 0.0})
+                d_stats["queries"] += 1
+                d_stats["hits"] += (record.cache == "hit")
+                d_stats["misses"] += (record.cache == "miss")
+                d_stats["errors"] += (record.error is not None)
+                d_stats["round_trips"] += record.round_trips
+                d_stats["rows"] += record.nrows
+                d_stats["bytes"] += record.nbytes
+                d_stats["wall"] += record.wall
+                d_stats["max"] = max(d_stats["max"], record.wall)
+        
+        width = max([len("helper")] + [len(_helper) for _helper in d_helpers])
+        
+        l_lines = [
+            f"{'helper':<{width}} {'queries':>7} {'hits':>5} {'misses':>6} {'errors':>6} {'trips':>6} {'rows':>9} {'MB':>8} {'total [s]':>9} {'mean [s]':>9} {'max [s]':>8}"
+        ]
+        
+        for helper, d_stats in sorted(d_helpers.items(), key = lambda _item: -_item[1]["wall"]) :
+            
+            l_lines.append(
+                f"{helper:<{width}} {d_stats['queries']:>7} {d_stats['hits']:>5} {d_stats['misses']:>6} {d_stats['errors']:>6} {d_stats['round_trips']:>6} "
+                f"{d_stats['rows']:>9} {d_stats['bytes']/1e6:>8.2f} {d_stats['wall']:>9.2f} {d_stats['wall']/d_stats['queries']:>9.3f} {d_stats['max']:>8.2f}"
+            )
+        
+        return "\n".join(l_lines)
+    
+    def print_summary(self) :
+        
+        if not len(self.l_records) :
+            
+            return
+        
+        # Wall times of concurrent queries overlap, so the total can exceed the run time
+        logger.info(f"Database profile: {len(self.l_records)} queries{f' (trace: {self.tracefile})' if self.tracefile else ''}\n{self.summary()}")
+    
+    def close(self) :
+        
+        self.print_summary()
+        
+        if (self.fopen is not None) :
+            
+            self.fopen.close()
+            self.fopen = None
+
+
+def enable(tracefile = DEFAULT_TRACE_FILE) :
+    """
+    Start profiling the database queries; the summary is printed at the end of the run
+    """
+    
+    global profiler
+    
+    if (profiler is None) :
+        
+        profiler = DbProfiler(tracefile = tracefile)
+        atexit.register(profiler.close)
+    
+    return profiler
+
+
+def get_profiler() :
+    
+    return profiler
+
+
+def set_cache_status(status) :
+    """
+    Set the cache status (hit, miss, off) of the query being fetched
+    """
+    
+    record = current_record.get()
+    
+    if (record is not None) :
+        
+        record.cache = status
+
+
+def on_request(method, url, status, nbytes, seconds) :
+    """
+    RhApi request hook: count the round trip and bytes for the query being fetched
+    """
+    
+    record = current_record.get()
+    
+    if (record is not None and profiler is not None) :
+        
+        profiler.on_request(record, method, url, status, nbytes, seconds)
+
+
+def get_function_name(code) :
+    """
+    Qualified name of the function of a code object; closures (for e.g. get_part_barcodes.<locals>.fetch) are named after their enclosing function
+    """
+    
+    name = getattr(code, "co_qualname", code.co_name)
+    
+    return name.split(".<locals>.", 1)[0]
+
+
+def get_caller() :
+    """
+    Name of the helper that runs the query: first frame outside of the database layer
+    """
+    
+    frame = sys._getframe(1)
+    
+    while (frame is not None) :
+        
+        module = frame.f_globals.get("__name__", "")
+        
+        name = frame.f_code.co_name
+        
+        # Skip the comprehensions and generator expressions (<listcomp>, <genexpr>, ...) but not <module>
+        if (module not in DB_LAYER_MODULES and name not in DB_LAYER_FUNCTIONS and (name == "<module>" or not name.startswith("<"))) :
+            
+            return f"{module}.{get_function_name(frame.f_code)}"
+        
+        frame = frame.f_back
+    
+    return current_helper.get() or "<unknown>"
+
+
+def submit(executor, function, *args, **kwargs) :
+    """
+    Submit a function to a thread pool executor, keeping the calling helper of the queries it runs
+    """
+    
+    if (profiler is None) :
+        
+        return executor.submit(function, *args, **kwargs)
+    
+    context = contextvars.copy_context()
+    context.run(current_helper.set, get_caller())
+    
+    return executor.submit(context.run, function, *args, **kwargs)
@@ -0,0 +1,125 @@
+"""
+Registry of the database table columns read by utils.py
+Queries are built from the columns each helper declares (see get_projection) instead of "select s.*"
+The keys of the rows (JSON2 format) are the camelCase names of the columns, for e.g. PART_PARENT_ID -> partParentId
+The registry is checked offline against the server table metadata kept in the rhapi schema cache (see set_server_columns)
+"""
+
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+TABLE_COLUMNS = {
+    # Parts (all part types)
+    "parts": [
+        "ID",
+        "BARCODE",
+        "KIND_OF_PART",
+        "LOCATION_ID",
+        "PRODUCTION_DATE",
+        "PART_PARENT_ID",
+    ],
+    
+    # Positions of the parts in their parents
+    "p3": ["BARCODE", "APOSITION_IN_SENSORMODULE"],
+    "p10": ["BARCODE", "APOSITION_IN_RU"],
+    "p11": ["BARCODE", "APOSITION_IN_DETECTORMODULE"],
+    "p100": ["BARCODE", "APOSITION_IN_TRAY"],
+    
+    # SiPM conditions: Vbr per channel and TEC resistance
+    "c3000": ["PART_BARCODE", "VBRRT"],
+    "c3060": ["PART_BARCODE", "RAC"],
+}
+
+
+# Columns of the tables on the server, from the cached table metadata (see set_server_columns)
+# Registered columns missing on the server are rejected as well
+d_server_columns = {}
+
+
+class UnknownColumnError(Exception) :
+    
+    def __init__(self, table, column, on_server = False) :
+        
+        self.table = table
+        self.column = column
+        self.on_server = on_server
+    
+    def __str__(self) :
+        
+        if self.on_server :
+            
+            return f"Column {self.column} is not a column of table {self.table} on the server. Server columns: {d_server_columns.get(self.table, [])}"
+        
+        return f"Column {self.column} is not registered for table {self.table}. Registered columns: {TABLE_COLUMNS.get(self.table, [])}"
+
+
+def to_key(column) :
+    """
+    Key of a column in the JSON2 rows, for e.g. PART_PARENT_ID -> partParentId
+    """
+    
+    l_words = column.lower().split("_")
+    
+    return l_words[0] + "".join(_word.capitalize() for _word in l_words[1:])
+
+
+def check_columns(table, l_columns) :
+    """
+    Check that the columns are registered for the table
+    """
+    
+    assert (table in TABLE_COLUMNS), f"Table {table} is not registered. Registered tables: {list(TABLE_COLUMNS.keys())}"
+    
+    for column in l_columns :
+        
+        if (column.upper() not in TABLE_COLUMNS[table]) :
+            
+            raise UnknownColumnError(table, column)
+        
+        if (table in d_server_columns and column.upper() not in d_server_columns[table]) :
+            
+            raise UnknownColumnError(table, column, on_server = True)
+
+
+def set_server_columns(d_columns) :
+    """
+    Set the columns of the tables on the server ({table: [columns]}), for e.g. from the rhapi schema cache
+    """
+    
+    d_server_columns.update({_table.lower(): [_col.upper() for _col in _l_columns] for _table, _l_columns in d_columns.items()})
+    
+    for table, l_columns in TABLE_COLUMNS.items() :
+        
+        l_missing = [_col for _col in l_columns if (table in d_server_columns and _col not in d_server_columns[table])]
+        
+        if len(l_missing) :
+            
+            logger.warning(f"Registered columns of table {table} not found on the server: {l_missing}")
+
+
+# Oracle regular expression of the text values that can be converted to numbers (see get_numeric)
+NUMBER_PATTERN = "^ *[-+]?([0-9]+([.][0-9]*)?|[.][0-9]+)([eE][-+]?[0-9]+)? *$"
+
+
+def get_numeric(table, column, alias = "s") :
+    """
+    Get the numeric value of a text column, NULL for the values that are not numbers
+    (a plain TO_NUMBER would fail the whole query on one bad row)
+    """
+    
+    check_columns(table, [column])
+    
+    return f"CASE WHEN REGEXP_LIKE({alias}.{column.upper()}, '{NUMBER_PATTERN}') THEN TO_NUMBER({alias}.{column.upper()}) END"
+
+
+def get_projection(table, l_columns, alias = "s") :
+    """
+    Get the select list for the columns of a table, for e.g. "s.ID, s.BARCODE"
+    """
+    
+    check_columns(table, l_columns)
+    
+    return ", ".join(f"{alias}.{_col.upper()}" for _col in l_columns)
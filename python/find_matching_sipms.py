@@ -4,9 +4,9 @@ import argparse
 import numpy
 import os
 
+import constants
 import utils
 from utils import logging
-from utils import yaml
 
 
 SIPM_BARCODE_BASE = 32110010000000
@@ -51,9 +51,8 @@ def main() :
     
     args = parser.parse_args()
     
-    with open(args.sipminfo, "r") as fopen :
-        
-        d_sipminfo = yaml.load(fopen.read())
+    # Columnar table: the Vbrs are read as arrays, without creating the SiPM objects
+    t_sipminfo = utils.load_part_table(parttype = constants.SIPM.KIND_OF_PART, yamlfile = args.sipminfo)
     
     def strip(s) :
         return s.strip()
@@ -69,11 +68,16 @@ def main() :
     
     #print("\n".join(l_sipms_1))
     
-    l_sipms_1 = [_sipm for _sipm in l_sipms_1 if _sipm in d_sipminfo]
-    l_sipms_2 = [_sipm for _sipm in l_sipms_2 if _sipm in d_sipminfo]
+    l_sipms_1 = [_sipm for _sipm in l_sipms_1 if _sipm in t_sipminfo]
+    l_sipms_2 = [_sipm for _sipm in l_sipms_2 if _sipm in t_sipminfo]
+    
+    a_sipm_vbrs_1 = t_sipminfo.column("vbr_avg", l_sipms_1)
+    a_sipm_vbrs_2 = t_sipminfo.column("vbr_avg", l_sipms_2)
+    
+    d_sipm_vbrs = {**dict(zip(l_sipms_1, a_sipm_vbrs_1)), **dict(zip(l_sipms_2, a_sipm_vbrs_2))}
     
-    #a_sipm_vbrs_1 = numpy.array([d_sipminfo[_sipm]["vbr_avg"] for _sipm in l_sipms_1 if _sipm in d_sipminfo])
-    a_sipm_vbrs_2 = numpy.array([d_sipminfo[_sipm]["vbr_avg"] for _sipm in l_sipms_2 if _sipm in d_sipminfo])
+    # SiPMs without Vbr (NaN) are never matched
+    a_sipm_vbrs_2 = numpy.nan_to_num(a_sipm_vbrs_2, nan = 9999)
     
     l_sipm_pairs = []
     
@@ -94,9 +98,13 @@ def main() :
     
     #print(d_sipm_tray)
     
-    for sipm in l_sipms_1 :
+    for sipm, vbr in zip(l_sipms_1, a_sipm_vbrs_1) :
+        
+        if numpy.isnan(vbr) :
+            
+            logging.warning(f"SiPM {sipm} has no Vbr; skipping it.")
+            continue
         
-        vbr = d_sipminfo[sipm]["vbr_avg"]
         a_delta_vbr = numpy.abs(a_sipm_vbrs_2 - vbr)
         
         idx_min = numpy.argmin(a_delta_vbr)
@@ -110,9 +118,9 @@ def main() :
         sipm2_short = f"{int(sipm2)-SIPM_BARCODE_BASE:05d}"
         
         print(
-            f"{sipm1_short} ({d_sipminfo[sipm1]['vbr_avg']:0.2f})"
+            f"{sipm1_short} ({d_sipm_vbrs[sipm1]:0.2f})"
             " , "
-            f"{sipm2_short} ({d_sipminfo[sipm2]['vbr_avg']:0.2f}, {d_sipm_tray.get(sipm2_short, 'NA')})"
+            f"{sipm2_short} ({d_sipm_vbrs[sipm2]:0.2f}, {d_sipm_tray.get(sipm2_short, 'NA')})"
         )
     
     return 0
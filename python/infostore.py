@@ -0,0 +1,260 @@
+"""
+Binary companion stores of the part info files (for e.g. info/MIB/sipm_info.yaml -> info/MIB/sipm_info.sqlite)
+The parts are kept as JSON rows of a SQLite file, which loads much faster than the YAML file
+A store records the size, modification time and hash of its YAML file, and is only used while the YAML file is unchanged,
+so an edited (or updated) YAML file takes precedence
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Version of the store format; stores of another version are not used
+STORE_VERSION = 2
+
+STORE_EXTENSION = ".sqlite"
+
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def get_store_file(yamlfile) :
+    """
+    Store file of a YAML part info file: same name, .sqlite extension
+    """
+    
+    return f"{os.path.splitext(yamlfile)[0]}{STORE_EXTENSION}"
+
+
+def encode(value) :
+    """
+    JSON-compatible value; dictionaries with non-string keys (for e.g. {position: barcode}) are kept as lists of items
+    """
+    
+    if isinstance(value, dict) :
+        
+        if all(isinstance(_key, str) for _key in value.keys()) :
+            
+            return {_key: encode(_val) for _key, _val in value.items()}
+        
+        return {"__items__": [[_key, encode(_val)] for _key, _val in value.items()]}
+    
+    if isinstance(value, (list, tuple)) :
+        
+        return [encode(_val) for _val in value]
+    
+    return value
+
+
+def decode(value) :
+    
+    if isinstance(value, dict) :
+        
+        if (len(value) == 1 and "__items__" in value) :
+            
+            return {_key: decode(_val) for _key, _val in value["__items__"]}
+        
+        return {_key: decode(_val) for _key, _val in value.items()}
+    
+    if isinstance(value, list) :
+        
+        return [decode(_val) for _val in value]
+    
+    return value
+
+
+def get_yaml_hash(yamlfile) :
+    """
+    SHA-1 of the content of a YAML file
+    """
+    
+    sha = hashlib.sha1()
+    
+    with open(yamlfile, "rb") as fopen :
+        
+        for chunk in iter(lambda: fopen.read(HASH_CHUNK_SIZE), b"") :
+            
+            sha.update(chunk)
+    
+    return sha.hexdigest()
+
+
+def get_yaml_signature(yamlfile) :
+    """
+    Size, modification time and hash of a YAML file, as saved in the info table of its store (empty if there is no YAML file)
+    """
+    
+    if not os.path.exists(yamlfile) :
+        
+        return {}
+    
+    stat = os.stat(yamlfile)
+    
+    return {
+        "yaml_size": str(stat.st_size),
+        "yaml_mtime": str(stat.st_mtime_ns),
+        "yaml_hash": get_yaml_hash(yamlfile),
+    }
+
+
+def read_info(storefile) :
+    """
+    Info table of a store ({key: value}), None if the store is missing or unreadable
+    """
+    
+    if not os.path.exists(storefile) :
+        
+        return None
+    
+    try :
+        
+        conn = sqlite3.connect(f"file:{storefile}?mode=ro", uri = True)
+        
+        try :
+            
+            return dict(conn.execute("select key, value from info").fetchall())
+        
+        finally :
+            
+            conn.close()
+    
+    except sqlite3.Error as e :
+        
+        logger.warning(f"Could not read part info store {storefile}: {e}")
+        return None
+
+
+def is_fresh(yamlfile, d_info = None) :
+    """
+    Whether the store of a YAML file can be used: it exists, has the current version and the YAML file (if any) is the one it was saved with
+    The YAML file is the same if its size and modification time did not change, or if only its modification time changed but not its hash
+    d_info is the info table of the store, if already read
+    """
+    
+    storefile = get_store_file(yamlfile)
+    
+    if (d_info is None) :
+        
+        d_info = read_info(storefile)
+    
+    if (d_info is None) :
+        
+        return False
+    
+    if (d_info.get("version") != str(STORE_VERSION)) :
+        
+        logger.warning(f"Ignoring part info store {storefile} (version {d_info.get('version')}, expected {STORE_VERSION}).")
+        return False
+    
+    if not os.path.exists(yamlfile) :
+        
+        return True
+    
+    # A YAML file created after the store
+    if ("yaml_size" not in d_info) :
+        
+        return False
+    
+    stat = os.stat(yamlfile)
+    
+    if (str(stat.st_size) != d_info["yaml_size"]) :
+        
+        return False
+    
+    if (str(stat.st_mtime_ns) == d_info["yaml_mtime"]) :
+        
+        return True
+    
+    return get_yaml_hash(yamlfile) == d_info["yaml_hash"]
+
+
+def load(yamlfile) :
+    """
+    Load the parts ({barcode: part dictionary}) from the store of a YAML file
+    Returns None if the store cannot be used (missing, other version, YAML file changed since the store was saved, or unreadable)
+    """
+    
+    storefile = get_store_file(yamlfile)
+    
+    if not is_fresh(yamlfile, d_info = read_info(storefile)) :
+        
+        return None
+    
+    try :
+        
+        conn = sqlite3.connect(f"file:{storefile}?mode=ro", uri = True)
+        
+        try :
+            
+            l_rows = conn.execute("select barcode, data from parts order by idx").fetchall()
+        
+        finally :
+            
+            conn.close()
+    
+    except sqlite3.Error as e :
+        
+        logger.warning(f"Could not read part info store {storefile}: {e}")
+        return None
+    
+    return {_barcode: (None if (_data is None) else decode(json.loads(_data))) for _barcode, _data in l_rows}
+
+
+def save(yamlfile, d_parts, parttype = None) :
+    """
+    Save the parts ({barcode: part dictionary}) into the store of a YAML file, with the signature of the YAML file (see is_fresh)
+    The YAML file must be written first; if it is not written (or not up to date), the store is still used as long as the YAML file is left as is
+    The store is written to a temporary file first, so readers never see a partial store
+    """
+    
+    storefile = get_store_file(yamlfile)
+    tmpfile = f"{storefile}.tmp{os.getpid()}"
+    
+    outdir = os.path.dirname(storefile)
+    
+    if len(outdir) :
+        
+        os.makedirs(outdir, exist_ok = True)
+    
+    try :
+        
+        conn = sqlite3.connect(tmpfile)
+        
+        try :
+            
+            conn.execute("create table info (key text primary key, value text)")
+            conn.execute("create table parts (idx integer primary key, barcode text, data text)")
+            conn.executemany("insert into info values (?, ?)", [
+                ("version", str(STORE_VERSION)),
+                ("parttype", str(parttype)),
+                ("saved", str(time.time())),
+            ] + list(get_yaml_signature(yamlfile).items()))
+            conn.executemany("insert into parts values (?, ?, ?)", (
+                (_idx, str(_barcode), None if (_part is None) else json.dumps(encode(_part)))
+                for _idx, (_barcode, _part) in enumerate(d_parts.items())
+            ))
+            conn.commit()
+        
+        finally :
+            
+            conn.close()
+        
+        os.replace(tmpfile, storefile)
+    
+    except (sqlite3.Error, OSError, TypeError, ValueError) as e :
+        
+        logger.warning(f"Could not save part info store {storefile}: {e}")
+        
+        if os.path.exists(tmpfile) :
+            
+            os.remove(tmpfile)
+        
+        return False
+    
+    return True
@@ -0,0 +1,294 @@
+"""
+In-memory graph of the parts (SiPM, LYSO, SM, DM, RU, Tray, ...) loaded from the part info stores
+The parts are kept as loaded (their daughters are barcode strings), the edges are indexed separately:
+lookup by barcode or database id, parent/children with positions, and cached ancestor/descendant queries
+"""
+
+import dataclasses
+import logging
+
+import constants
+
+
+logger = logging.getLogger(__name__)
+
+
+# Daughters of each part type: (attribute, daughter part type)
+# The daughter position is the attribute name, or the key if the attribute is a {position: barcode} dictionary
+PART_DAUGHTERS = {
+    constants.SM.KIND_OF_PART: [
+        ("lyso", constants.LYSO.KIND_OF_PART),
+        ("sipm1", constants.SIPM.KIND_OF_PART),
+        ("sipm2", constants.SIPM.KIND_OF_PART),
+    ],
+    constants.DM.KIND_OF_PART: [
+        ("feb", constants.FE.KIND_OF_PART),
+        ("sm1", constants.SM.KIND_OF_PART),
+        ("sm2", constants.SM.KIND_OF_PART),
+    ],
+    constants.RU.KIND_OF_PART: [
+        ("cc", constants.CC.KIND_OF_PART),
+        ("pcc1p2", constants.PCC1P2.KIND_OF_PART),
+        ("pcc2p5", constants.PCC2P5.KIND_OF_PART),
+        ("dms", constants.DM.KIND_OF_PART),
+    ],
+    constants.TRAY.KIND_OF_PART: [
+        ("coldtray", constants.COLDTRAY.KIND_OF_PART),
+        ("rus", constants.RU.KIND_OF_PART),
+    ],
+}
+
+
+@dataclasses.dataclass(init = True, frozen = True)
+class PartEdge :
+    
+    parent: str
+    child: str
+    parttype: str
+    attr: str
+    position: object
+
+
+def to_barcode(value) :
+    """
+    Barcode of a daughter, which can also be a part object (for e.g. after utils.combine_parts)
+    """
+    
+    value = getattr(value, "barcode", value)
+    
+    return None if (value is None or value == "None") else str(value)
+
+
+class PartGraph :
+    """
+    Parts indexed by barcode and database id, with typed parent/child edges
+    Build it once from the info stores (see from_stores) and share it
+    """
+    
+    def __init__(self) :
+        
+        # barcode -> part, barcode -> part type, database id -> barcode
+        self.d_parts = {}
+        self.d_types = {}
+        self.d_ids = {}
+        self.set_types = set()
+        
+        # barcode -> edge to the parent, barcode -> edges to the daughters
+        self.d_parent_edges = {}
+        self.d_child_edges = {}
+        
+        self.d_ancestors = {}
+        self.d_descendants = {}
+        self.d_linked = {}
+    
+    @classmethod
+    def from_stores(cls, d_stores) :
+        """
+        Build the graph from the part info stores: {part type: {barcode: part}}
+        """
+        
+        graph = cls()
+        
+        for parttype, d_parts in d_stores.items() :
+            
+            graph.add_parts(parttype, d_parts)
+        
+        return graph
+    
+    def add_parts(self, parttype, d_parts) :
+        """
+        Add the parts of a type ({barcode: part}, parts that are None are skipped)
+        """
+        
+        for barcode, part in d_parts.items() :
+            
+            if (part is None) :
+                
+                continue
+            
+            barcode = str(barcode)
+            self.d_parts[barcode] = part
+            self.d_types[barcode] = parttype
+            self.set_types.add(parttype)
+            
+            if (getattr(part, "id", None) is not None) :
+                
+                self.d_ids[str(part.id)] = barcode
+            
+            l_edges = []
+            
+            for attr, daughter_parttype in PART_DAUGHTERS.get(parttype, []) :
+                
+                value = getattr(part, attr, None)
+                d_values = value if isinstance(value, dict) else {attr: value}
+                
+                for position, daughter in d_values.items() :
+                    
+                    daughter = to_barcode(daughter)
+                    
+                    if (daughter is None) :
+                        
+                        continue
+                    
+                    edge = PartEdge(parent = barcode, child = daughter, parttype = daughter_parttype, attr = attr, position = position)
+                    l_edges.append(edge)
+                    
+                    if (daughter in self.d_parent_edges and self.d_parent_edges[daughter].parent != barcode) :
+                        
+                        logger.warning(f"{daughter_parttype} {daughter} is mounted in both {self.d_parent_edges[daughter].parent} and {barcode}; keeping {barcode}")
+                    
+                    self.d_parent_edges[daughter] = edge
+            
+            self.d_child_edges[barcode] = l_edges
+        
+        # The cached queries may change with the new edges
+        self.d_ancestors.clear()
+        self.d_descendants.clear()
+        self.d_linked.clear()
+    
+    def __contains__(self, barcode) :
+        
+        return str(barcode) in self.d_parts
+    
+    def __len__(self) :
+        
+        return len(self.d_parts)
+    
+    def get(self, barcode, default = None) :
+        
+        return self.d_parts.get(str(barcode), default)
+    
+    def get_by_id(self, id, default = None) :
+        """
+        Part with a database id
+        """
+        
+        barcode = self.d_ids.get(str(id), None)
+        
+        return default if (barcode is None) else self.d_parts[barcode]
+    
+    def get_type(self, barcode) :
+        """
+        Part type of a barcode: the type of its store, or the daughter type of its edge to the parent
+        """
+        
+        barcode = str(barcode)
+        
+        if (barcode in self.d_types) :
+            
+            return self.d_types[barcode]
+        
+        edge = self.d_parent_edges.get(barcode, None)
+        
+        return None if (edge is None) else edge.parttype
+    
+    def parts(self, parttype) :
+        """
+        Parts of a type: {barcode: part}
+        """
+        
+        return {_bc: _part for _bc, _part in self.d_parts.items() if self.d_types[_bc] == parttype}
+    
+    def parent(self, barcode) :
+        """
+        Edge to the parent of a part (parent barcode and position of the part), None if not mounted
+        """
+        
+        return self.d_parent_edges.get(str(barcode), None)
+    
+    def children(self, barcode, parttype = None) :
+        """
+        Edges to the daughters of a part, optionally of a part type only
+        """
+        
+        l_edges = self.d_child_edges.get(str(barcode), [])
+        
+        return [_edge for _edge in l_edges if (parttype is None or _edge.parttype == parttype)]
+    
+    def ancestors(self, barcode) :
+        """
+        Edges from a part up to the top of its hierarchy, for e.g. for a SiPM:
+        [SM edge (position sipm1/sipm2), DM edge (sm1/sm2), RU edge (DM position), Tray edge (RU position)]
+        """
+        
+        barcode = str(barcode)
+        
+        if (barcode not in self.d_ancestors) :
+            
+            edge = self.d_parent_edges.get(barcode, None)
+            self.d_ancestors[barcode] = [] if (edge is None) else [edge] + self.ancestors(edge.parent)
+        
+        return self.d_ancestors[barcode]
+    
+    def locate(self, barcode) :
+        """
+        Where a part is mounted: {parent part type: (parent barcode, position of the branch holding the part)}
+        For e.g. locate(sipm)[constants.TRAY.KIND_OF_PART] is the tray of the SiPM and the position of its RU in the tray
+        """
+        
+        return {self.get_type(_edge.parent): (_edge.parent, _edge.position) for _edge in self.ancestors(barcode)}
+    
+    def ancestor(self, barcode, parttype) :
+        """
+        Barcode of the ancestor of a type, None if the part is not mounted in one
+        """
+        
+        return self.locate(barcode).get(parttype, (None, None))[0]
+    
+    def descendants(self, barcode, parttype = None) :
+        """
+        Barcodes of all the parts mounted in a part (at any depth), optionally of a part type only
+        """
+        
+        barcode = str(barcode)
+        
+        if (barcode not in self.d_descendants) :
+            
+            l_descendants = []
+            
+            for edge in self.d_child_edges.get(barcode, []) :
+                
+                l_descendants.append(edge.child)
+                l_descendants.extend(self.descendants(edge.child))
+            
+            self.d_descendants[barcode] = l_descendants
+        
+        return [_bc for _bc in self.d_descendants[barcode] if (parttype is None or self.get_type(_bc) == parttype)]
+    
+    def linked(self, barcode) :
+        """
+        Copy of a part with its daughters replaced by their linked copies (None if not in the graph), as utils.combine_parts does
+        The parts of the graph are not modified
+        """
+        
+        barcode = str(barcode)
+        
+        if (barcode not in self.d_parts) :
+            
+            return None
+        
+        if (barcode not in self.d_linked) :
+            
+            part = self.d_parts[barcode]
+            d_changes = {}
+            
+            for attr, _daughter_parttype in PART_DAUGHTERS.get(self.d_types[barcode], []) :
+                
+                value = getattr(part, attr, None)
+                
+                # Only the daughters of the types in the graph are linked
+                if (_daughter_parttype not in self.set_types) :
+                    
+                    continue
+                
+                if isinstance(value, dict) :
+                    
+                    d_changes[attr] = {_pos: self.linked(to_barcode(_bc)) for _pos, _bc in value.items()}
+                
+                elif (value is not None) :
+                    
+                    d_changes[attr] = self.linked(to_barcode(value))
+            
+            self.d_linked[barcode] = dataclasses.replace(part, **d_changes)
+        
+        return self.d_linked[barcode]
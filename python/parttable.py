@@ -0,0 +1,357 @@
+"""
+Columnar tables of parts, for e.g. the tens of thousands of SiPMs of an info file
+The columns follow the fields of the part dataclass (see utils.SiPMArray, ...):
+  str: int64 array if all the values are integers written without leading zeros (barcodes, ids), object array otherwise
+  float: float64 array, None is NaN (integer values, for e.g. a tec_res of 0, are read back as floats)
+  int: categorical (codes and categories), for e.g. location ids
+  list: ragged float64 array (values and offsets), for e.g. the per-channel Vbrs
+  others (dict, ...): object array
+The part objects are only created when a row is accessed (table[barcode]);
+the fields missing from a part dictionary get the dataclass default, as when the part is created from the dictionary
+"""
+
+import collections.abc
+import dataclasses
+import itertools
+import logging
+import math
+
+import numpy
+import pandas
+
+
+logger = logging.getLogger(__name__)
+
+
+def iter_list(value) :
+    """
+    Iterate over a list; the ruamel sequences (CommentedSeq) are lists, but iterate much slower than plain ones
+    """
+    
+    return list.__iter__(value)
+
+
+def is_int_string(value) :
+    
+    return isinstance(value, str) and value.isdigit() and (value == "0" or not value.startswith("0")) and len(value) < 19
+
+
+class Column :
+    """
+    Base column: object array
+    """
+    
+    def __init__(self, l_values) :
+        
+        self.a_values = numpy.empty(len(l_values), dtype = object)
+        self.a_values[:] = l_values
+    
+    def get(self, irow) :
+        
+        return self.a_values[irow]
+    
+    def array(self, a_rows) :
+        
+        return self.a_values[a_rows]
+    
+    @property
+    def nbytes(self) :
+        
+        return self.a_values.nbytes
+
+
+class StrColumn(Column) :
+    """
+    Strings of integers (barcodes, ids) as int64
+    """
+    
+    def __init__(self, l_values) :
+        
+        self.a_values = numpy.array([int(_val) for _val in l_values], dtype = numpy.int64)
+    
+    def get(self, irow) :
+        
+        return str(self.a_values[irow])
+    
+    @staticmethod
+    def accepts(l_values) :
+        
+        return all(is_int_string(_val) for _val in l_values)
+
+
+class FloatColumn(Column) :
+    """
+    Floats as float64, None is NaN
+    """
+    
+    def __init__(self, l_values) :
+        
+        self.a_values = numpy.array([numpy.nan if (_val is None) else _val for _val in l_values], dtype = numpy.float64)
+    
+    def get(self, irow) :
+        
+        value = self.a_values[irow]
+        
+        return None if math.isnan(value) else float(value)
+    
+    @staticmethod
+    def accepts(l_values) :
+        
+        return all(_val is None or (isinstance(_val, (int, float)) and not isinstance(_val, bool)) for _val in l_values)
+
+
+class CategoricalColumn(Column) :
+    """
+    Few distinct values (for e.g. location ids) as codes into the list of categories, None is -1
+    """
+    
+    def __init__(self, l_values) :
+        
+        a_codes, index_categories = pandas.factorize(pandas.Series(l_values, dtype = object), use_na_sentinel = True)
+        
+        ncategories = len(index_categories)
+        dtype = numpy.int8 if (ncategories < 2**7) else numpy.int16 if (ncategories < 2**15) else numpy.int32
+        
+        self.a_values = a_codes.astype(dtype)
+        self.l_categories = [_val.item() if isinstance(_val, numpy.generic) else _val for _val in index_categories]
+        self.a_categories = numpy.empty(ncategories + 1, dtype = object)
+        self.a_categories[:ncategories] = self.l_categories
+    
+    def get(self, irow) :
+        
+        code = self.a_values[irow]
+        
+        return None if (code < 0) else self.l_categories[code]
+    
+    def array(self, a_rows) :
+        
+        # Code -1 (None) is the last element of a_categories
+        return self.a_categories[self.a_values[a_rows]]
+    
+    @staticmethod
+    def accepts(l_values) :
+        
+        try :
+            
+            return len(set(l_values)) <= max(16, len(l_values)//16)
+        
+        except TypeError :
+            
+            return False
+
+
+class RaggedColumn(Column) :
+    """
+    Lists of floats as one float64 array of the values and the offsets of the rows (None lists are kept apart from empty ones)
+    """
+    
+    def __init__(self, l_values) :
+        
+        a_lengths = numpy.array([len(_val) if (_val is not None) else 0 for _val in l_values], dtype = numpy.int64)
+        
+        self.a_offsets = numpy.zeros(len(l_values) + 1, dtype = numpy.int64)
+        numpy.cumsum(a_lengths, out = self.a_offsets[1:])
+        
+        self.a_values = numpy.fromiter(itertools.chain.from_iterable(iter_list(_val) for _val in l_values if _val), dtype = numpy.float64, count = int(self.a_offsets[-1]))
+        self.a_none = numpy.array([_val is None for _val in l_values], dtype = bool)
+    
+    def get(self, irow) :
+        
+        if self.a_none[irow] :
+            
+            return None
+        
+        return self.a_values[self.a_offsets[irow]: self.a_offsets[irow+1]].tolist()
+    
+    def array(self, a_rows) :
+        
+        l_values = [self.a_values[self.a_offsets[_irow]: self.a_offsets[_irow+1]] for _irow in a_rows]
+        
+        return numpy.array(l_values + [None], dtype = object)[:-1]
+    
+    @property
+    def nbytes(self) :
+        
+        return self.a_values.nbytes + self.a_offsets.nbytes + self.a_none.nbytes
+    
+    @staticmethod
+    def accepts(l_values) :
+        
+        return all(_val is None or (isinstance(_val, list) and all(isinstance(_x, (int, float)) and not isinstance(_x, bool) for _x in iter_list(_val))) for _val in l_values)
+
+
+# Column types to try for each field type, in order (Column always accepts)
+FIELD_COLUMNS = {
+    str: [StrColumn],
+    float: [FloatColumn],
+    int: [CategoricalColumn],
+    list: [RaggedColumn],
+}
+
+
+def make_column(field_type, l_values) :
+    
+    for column_class in FIELD_COLUMNS.get(field_type, []) :
+        
+        if column_class.accepts(l_values) :
+            
+            return column_class(l_values)
+    
+    return Column(l_values)
+
+
+class PartTable(collections.abc.Mapping) :
+    """
+    Read-only mapping {barcode: part} of the parts of a type, stored by column
+    Rows are created on access, so only the parts that are used become objects
+    Use column() to get a field of many parts at once as an array
+    """
+    
+    def __init__(self, part_class, d_dicts) :
+        """
+        d_dicts: {barcode: part dictionary}, for e.g. from a part info file; parts that are None are skipped
+        """
+        
+        self.part_class = part_class
+        
+        l_barcodes = [str(_bc) for _bc, _val in d_dicts.items() if _val is not None]
+        l_dicts = [_val for _val in d_dicts.values() if _val is not None]
+        
+        self.index = make_column(str, l_barcodes)
+        
+        # Sorted barcodes for the lookups
+        if isinstance(self.index, StrColumn) :
+            
+            self.a_sorted_rows = numpy.argsort(self.index.a_values, kind = "stable")
+            self.a_sorted_barcodes = self.index.a_values[self.a_sorted_rows]
+            self.d_rows = None
+        
+        else :
+            
+            self.d_rows = {_bc: _irow for _irow, _bc in enumerate(l_barcodes)}
+        
+        self.d_columns = {}
+        
+        # Rows without a field in their dictionary (field name -> boolean array), only for the fields missing somewhere
+        self.d_missing = {}
+        
+        for field in dataclasses.fields(part_class) :
+            
+            # dict.get: the ruamel mappings (CommentedMap) are dicts with a much slower get
+            l_values = [dict.get(_val, field.name, None) for _val in l_dicts]
+            
+            a_missing = numpy.fromiter((not dict.__contains__(_val, field.name) for _val in l_dicts), dtype = bool, count = len(l_dicts))
+            
+            if numpy.any(a_missing) :
+                
+                self.d_missing[field.name] = a_missing
+            
+            # The barcodes are usually the keys, no need to keep them twice
+            if (field.name == "barcode" and l_values == l_barcodes) :
+                
+                self.d_columns[field.name] = self.index
+                continue
+            
+            self.d_columns[field.name] = make_column(field.type, l_values)
+        
+        self.nrows = len(l_barcodes)
+    
+    @classmethod
+    def from_parts(cls, part_class, d_parts) :
+        """
+        Table of part objects ({barcode: part})
+        """
+        
+        return cls(part_class, {_bc: (None if (_part is None) else _part.__dict__) for _bc, _part in d_parts.items()})
+    
+    def __len__(self) :
+        
+        return self.nrows
+    
+    def __iter__(self) :
+        
+        for irow in range(self.nrows) :
+            
+            yield self.index.get(irow)
+    
+    def __contains__(self, barcode) :
+        
+        return self.get_row(barcode) >= 0
+    
+    def __getitem__(self, barcode) :
+        
+        irow = self.get_row(barcode)
+        
+        if (irow < 0) :
+            
+            raise KeyError(barcode)
+        
+        return self.row(irow)
+    
+    def get_row(self, barcode) :
+        """
+        Row number of a barcode, -1 if not found
+        """
+        
+        return int(self.get_rows([barcode])[0])
+    
+    def get_rows(self, l_barcodes) :
+        """
+        Row numbers of a list of barcodes as an array, -1 for the ones not found
+        """
+        
+        if (self.d_rows is not None) :
+            
+            return numpy.array([self.d_rows.get(str(_bc), -1) for _bc in l_barcodes], dtype = numpy.int64)
+        
+        a_keys = numpy.array([int(_bc) if is_int_string(str(_bc)) else -1 for _bc in l_barcodes], dtype = numpy.int64)
+        a_pos = numpy.searchsorted(self.a_sorted_barcodes, a_keys)
+        a_pos = numpy.minimum(a_pos, max(self.nrows - 1, 0))
+        
+        if (self.nrows == 0) :
+            
+            return numpy.full(len(a_keys), -1, dtype = numpy.int64)
+        
+        return numpy.where(self.a_sorted_barcodes[a_pos] == a_keys, self.a_sorted_rows[a_pos], -1)
+    
+    def row(self, irow) :
+        """
+        Part object of a row
+        The fields missing from its dictionary are left out, so they get their default (field.default or field.default_factory())
+        """
+        
+        return self.part_class(**{
+            _name: _column.get(irow) for _name, _column in self.d_columns.items()
+            if not (_name in self.d_missing and self.d_missing[_name][irow])
+        })
+    
+    def column(self, name, l_barcodes = None) :
+        """
+        Values of a field as an array, for all the rows or for a list of barcodes (all must be in the table)
+        float fields are float64 arrays (None is NaN), str fields of integers are int64 arrays, lists are arrays of arrays
+        """
+        
+        column = self.d_columns[name]
+        
+        if (l_barcodes is None) :
+            
+            a_rows = numpy.arange(self.nrows)
+        
+        else :
+            
+            a_rows = self.get_rows(l_barcodes)
+            
+            if numpy.any(a_rows < 0) :
+                
+                l_missing = [_bc for _bc, _irow in zip(l_barcodes, a_rows) if _irow < 0]
+                raise KeyError(f"Barcodes not found: {l_missing[:10]}{' ...' if len(l_missing) > 10 else ''}")
+        
+        return column.array(a_rows)
+    
+    @property
+    def nbytes(self) :
+        """
+        Memory used by the columns (excluding the Python objects of the object columns)
+        """
+        
+        return sum(_column.nbytes for _column in set([self.index, *self.d_columns.values()])) + sum(_a_missing.nbytes for _a_missing in self.d_missing.values())
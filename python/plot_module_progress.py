@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
 import numpy
 import os
 import pandas
@@ -107,9 +108,15 @@ def main() :
         required = True,
     )
     
+    utils.add_db_cache_arguments(parser)
+    utils.add_db_profile_arguments(parser)
+    
     # Parse arguments
     args = parser.parse_args()
     
+    utils.configure_db_cache(args)
+    utils.configure_db_profile(args)
+    
     d_module_info = {}
     d_module_hist = {}
     d_module_time = {}
@@ -119,6 +126,19 @@ def main() :
     
     d_time_max = {}
     
+    # Fetch all module types and locations concurrently
+    l_mtype_locs = list(itertools.product(args.moduletypes, args.locations))
+    
+    l_module_info = utils.gather_all_part_info([dict(
+        parttype = _mtype,
+        outyamlfile = f"{args.outdir}/info_{_mtype}_{_loc}.yaml",
+        inyamlfile = f"{args.outdir}/info_{_mtype}_{_loc}.yaml",
+        location_id = getattr(constants.LOCATION, _loc),
+        ret = True
+    ) for _mtype, _loc in l_mtype_locs])
+    
+    d_fetched_info = dict(zip(l_mtype_locs, l_module_info))
+    
     for mtype in args.moduletypes :
         
         d_module_info[mtype] = {}
@@ -128,15 +148,7 @@ def main() :
         
         for loc in args.locations :
             
-            fname_info = f"{args.outdir}/info_{mtype}_{loc}.yaml"
-            
-            d_module_info[mtype][loc] = utils.save_all_part_info(
-                parttype = mtype,
-                outyamlfile = fname_info,
-                inyamlfile = fname_info,
-                location_id = getattr(constants.LOCATION, loc),
-                ret = True
-            )
+            d_module_info[mtype][loc] = d_fetched_info[(mtype, loc)]
             
             d_module_info[mtype][LOC_ALL].update(d_module_info[mtype][loc])
         
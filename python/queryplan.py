@@ -0,0 +1,274 @@
+import dataclasses
+import heapq
+import math
+
+
+# Maximum number of values in an IN list (Oracle allows up to 1000)
+MAX_IN_LIST_SIZE = 1000
+
+# Maximum number of OR'ed barcode ranges in a single query
+MAX_RANGES_PER_QUERY = 100
+
+# Estimated cost of an additional query (qid, count and data round trips), in units of fetched rows
+QUERY_COST = 200
+
+# Estimated cost of a term in the selection, in units of fetched rows
+# A range needs two bind variables, an IN list value needs one
+RANGE_TERM_COST = 2
+IN_TERM_COST = 1
+
+
+@dataclasses.dataclass(init = True)
+class PlannedQuery :
+    
+    l_ranges: list = dataclasses.field(default_factory = list)
+    l_barcodes: list = dataclasses.field(default_factory = list)
+    nbarcodes: int = 0
+    noverfetch: int = 0
+    
+    def describe(self) :
+        
+        return f"{len(self.l_ranges)} range(s) + {len(self.l_barcodes)} listed barcode(s) for {self.nbarcodes} barcode(s) (over-fetch <= {self.noverfetch})"
+
+
+@dataclasses.dataclass(init = True)
+class QueryPlan :
+    
+    l_queries: list = dataclasses.field(default_factory = list)
+    nbarcodes: int = 0
+    noverfetch: int = 0
+    cost: float = 0
+    
+    def describe(self) :
+        
+        l_lines = [f"Query plan: {len(self.l_queries)} quer{'y' if len(self.l_queries) == 1 else 'ies'} for {self.nbarcodes} barcode(s), over-fetch <= {self.noverfetch}, estimated cost {self.cost:0.0f}"]
+        
+        for iquery, query in enumerate(self.l_queries) :
+            
+            l_lines.append(f"  Query {iquery+1}: {query.describe()}")
+        
+        return "\n".join(l_lines)
+
+
+@dataclasses.dataclass(init = True)
+class _Group :
+    
+    segment: int
+    start: int
+    end: int
+    count: int
+    prev: object = None
+    next: object = None
+    merged: bool = False
+    
+    def overfetch(self) :
+        
+        return (self.end - self.start + 1) - self.count
+    
+    def is_range(self) :
+        
+        return (RANGE_TERM_COST + self.overfetch()) < (IN_TERM_COST * self.count)
+    
+    def cost(self) :
+        
+        return min(RANGE_TERM_COST + self.overfetch(), IN_TERM_COST * self.count)
+
+
+def get_segment(barcode, l_allowed_ranges) :
+    """
+    Index of the allowed range that contains the barcode (-1 if none)
+    Groups of barcodes are never merged across segments
+    """
+    
+    for irange, (bc_min, bc_max) in enumerate(l_allowed_ranges) :
+        
+        if (int(bc_min) <= barcode <= int(bc_max)) :
+            
+            return irange
+    
+    return -1
+
+
+def get_nqueries(nranges, nin, max_ranges = MAX_RANGES_PER_QUERY, max_in_list = MAX_IN_LIST_SIZE) :
+    
+    return max(1, math.ceil(nranges / max_ranges), math.ceil(nin / max_in_list))
+
+
+def plan_barcode_queries(
+    l_barcodes,
+    l_allowed_ranges = None,
+    max_ranges = MAX_RANGES_PER_QUERY,
+    max_in_list = MAX_IN_LIST_SIZE,
+    query_cost = QUERY_COST,
+) :
+    """
+    Plan the queries to fetch a set of barcodes
+    Consecutive barcodes are grouped into (min, max) ranges and isolated ones are listed (IN list)
+    Groups separated by small gaps are merged when the extra fetched rows cost less than the saved terms/queries
+    Groups are never merged across the allowed ranges (e.g. the BARCODE_RANGES of a location)
+    Returns a QueryPlan with the minimum number of queries within these limits
+    """
+    
+    max_in_list = min(max_in_list, MAX_IN_LIST_SIZE)
+    l_allowed_ranges = l_allowed_ranges or []
+    
+    d_barcodes = {}
+    l_other_barcodes = []
+    
+    for barcode in set(str(_bc) for _bc in l_barcodes) :
+        
+        if barcode.isdigit() :
+            
+            d_barcodes[int(barcode)] = barcode
+        
+        else :
+            
+            l_other_barcodes.append(barcode)
+    
+    # Consecutive groups of barcodes (linked list, sorted by barcode)
+    l_groups = []
+    
+    for barcode in sorted(d_barcodes.keys()) :
+        
+        segment = get_segment(barcode, l_allowed_ranges)
+        
+        if l_groups and (l_groups[-1].segment == segment) and (barcode == l_groups[-1].end + 1) :
+            
+            l_groups[-1].end = barcode
+            l_groups[-1].count += 1
+        
+        else :
+            
+            group = _Group(segment = segment, start = barcode, end = barcode, count = 1, prev = l_groups[-1] if l_groups else None)
+            
+            if l_groups :
+                
+                l_groups[-1].next = group
+            
+            l_groups.append(group)
+    
+    l_initial_groups = [[_group.segment, _group.start, _group.end, _group.count] for _group in l_groups]
+    
+    nranges = sum(_group.is_range() for _group in l_groups)
+    nin = sum(_group.count for _group in l_groups if not _group.is_range()) + len(l_other_barcodes)
+    terms_cost = sum(_group.cost() for _group in l_groups) + IN_TERM_COST * len(l_other_barcodes)
+    
+    # Merge the groups in order of increasing gap and keep the number of merges with the lowest total cost
+    # Merging does not change the gaps to the neighbouring groups, so the order is fixed
+    l_gaps = [(_next.start - _group.end - 1, _igroup) for _igroup, (_group, _next) in enumerate(zip(l_groups[:-1], l_groups[1:])) if _group.segment == _next.segment]
+    heapq.heapify(l_gaps)
+    
+    best_cost = get_nqueries(nranges, nin, max_ranges, max_in_list) * query_cost + terms_cost
+    best_nmerges = 0
+    l_merges = []
+    
+    while l_gaps :
+        
+        _, igroup = heapq.heappop(l_gaps)
+        
+        # Find the current (merged) group and its next neighbour
+        group = l_groups[igroup]
+        
+        while group.merged :
+            
+            group = group.prev
+        
+        group_next = group.next
+        
+        for _group in [group, group_next] :
+            
+            if _group.is_range() :
+                nranges -= 1
+            else :
+                nin -= _group.count
+            
+            terms_cost -= _group.cost()
+        
+        group.end = group_next.end
+        group.count += group_next.count
+        group.next = group_next.next
+        group_next.merged = True
+        
+        if (group.next is not None) :
+            
+            group.next.prev = group
+        
+        if group.is_range() :
+            nranges += 1
+        else :
+            nin += group.count
+        
+        terms_cost += group.cost()
+        l_merges.append(igroup)
+        
+        cost = get_nqueries(nranges, nin, max_ranges, max_in_list) * query_cost + terms_cost
+        
+        if (cost < best_cost) :
+            
+            best_cost = cost
+            best_nmerges = len(l_merges)
+    
+    # Replay the best number of merges on the initial groups
+    l_final_groups = l_initial_groups
+    l_owner = list(range(len(l_final_groups)))
+    
+    def find(igroup) :
+        
+        while (l_owner[igroup] != igroup) :
+            
+            igroup = l_owner[igroup]
+        
+        return igroup
+    
+    for igroup in l_merges[:best_nmerges] :
+        
+        # Merge group igroup+1 (always the first of its block) into the block of igroup
+        iowner = find(igroup)
+        l_final_groups[iowner][2] = l_final_groups[igroup+1][2]
+        l_final_groups[iowner][3] += l_final_groups[igroup+1][3]
+        l_owner[igroup+1] = iowner
+    
+    l_ranges = []
+    l_in_barcodes = list(sorted(l_other_barcodes))
+    noverfetch = 0
+    
+    for igroup, (segment, start, end, count) in enumerate(l_final_groups) :
+        
+        if (l_owner[igroup] != igroup) :
+            
+            continue
+        
+        group = _Group(segment = segment, start = start, end = end, count = count)
+        
+        if group.is_range() :
+            
+            l_ranges.append((d_barcodes[start], d_barcodes[end], count, group.overfetch()))
+            noverfetch += group.overfetch()
+        
+        else :
+            
+            l_in_barcodes.extend(d_barcodes[_bc] for _bc in range(start, end+1) if _bc in d_barcodes)
+    
+    # Distribute the ranges and the listed barcodes over the queries
+    nqueries = get_nqueries(len(l_ranges), len(l_in_barcodes), max_ranges, max_in_list) if (l_ranges or l_in_barcodes) else 0
+    l_queries = [PlannedQuery() for _ in range(nqueries)]
+    
+    for irange, (bc_min, bc_max, count, overfetch) in enumerate(l_ranges) :
+        
+        query = l_queries[irange * nqueries // len(l_ranges)]
+        query.l_ranges.append((bc_min, bc_max))
+        query.nbarcodes += count
+        query.noverfetch += overfetch
+    
+    for ibarcode, barcode in enumerate(l_in_barcodes) :
+        
+        query = l_queries[ibarcode * nqueries // len(l_in_barcodes)]
+        query.l_barcodes.append(barcode)
+        query.nbarcodes += 1
+    
+    return QueryPlan(
+        l_queries = l_queries,
+        nbarcodes = len(d_barcodes) + len(l_other_barcodes),
+        noverfetch = noverfetch,
+        cost = best_cost if (l_ranges or l_in_barcodes) else 0,
+    )
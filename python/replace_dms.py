@@ -15,9 +15,9 @@ import sys
 import tqdm
 
 import constants
+import partgraph
 import utils
 from utils import logging
-from utils import yaml
 
 def main() :
     
@@ -45,6 +45,22 @@ def main() :
         default = [],
     )
     
+    parser.add_argument(
+        "--ruinfo",
+        help = "YAML file with the RU information, to print where the DMs to replace are mounted.\n",
+        type = str,
+        required = False,
+        default = None,
+    )
+    
+    parser.add_argument(
+        "--trayinfo",
+        help = "YAML file with the tray information, to also print the trays of the DMs to replace (requires --ruinfo).\n",
+        type = str,
+        required = False,
+        default = None,
+    )
+    
     parser.add_argument(
         "--location",
         help = "List of locations \n",
@@ -75,9 +91,21 @@ def main() :
     logging.info(f"Loading results from file: {args.dmresults} ...")
     with open(args.dmresults, "r") as fopen :
         
-        d_dm_results = yaml.load(fopen.read())["results"]
+        d_dm_results = utils.safe_load_yaml(fopen.read())["results"]
     
     l_dms_to_replace = utils.natural_sort(list(set(l_dms_to_replace)))
+    
+    d_stores = {}
+    
+    if (args.ruinfo) :
+        
+        d_stores[constants.RU.KIND_OF_PART] = utils.load_part_info(parttype = constants.RU.KIND_OF_PART, yamlfile = args.ruinfo)
+    
+    if (args.trayinfo) :
+        
+        d_stores[constants.TRAY.KIND_OF_PART] = utils.load_part_info(parttype = constants.TRAY.KIND_OF_PART, yamlfile = args.trayinfo)
+    
+    part_graph = partgraph.PartGraph.from_stores(d_stores)
     #print(l_dms_to_replace)
     
     l_avalable_dms = utils.run_db_query(
@@ -117,6 +145,12 @@ def main() :
         
         l_matched_dms = sorted(l_matched_dms, key = lambda _dm : _dm[1])
         
+        d_dm_location = part_graph.locate(dm1)
+        
+        if len(d_dm_location) :
+            
+            print(f"DM {dm1} is mounted in: " + ", ".join(f"{_type} {_barcode} (slot {_position})" for _type, (_barcode, _position) in d_dm_location.items()))
+        
         print(
             f"Found {len(l_matched_dms)} DMs matched to {dm1}"
             f" [category: {d_dm_results[dm1]['category']}, nfoamlayers: {d_dm_results[dm1]['nfoamlayers']}, grouping: {d_dm_results[dm1]['grouping']:.2f}]."
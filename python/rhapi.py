@@ -6,8 +6,14 @@ import requests
 import re
 import json
 import sys
+import collections
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+import weakref
 from requests.utils import requote_uri
-import xml.dom.minidom as minidom
 import importlib
 """
 Python object that enables connection to RestHub API.
@@ -16,8 +22,82 @@ website in GitHub: https://github.com/valdasraps/resthub
 """
 
 import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+DEFAULT_POOL_SIZE = 4
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+DEFAULT_TIMEOUT = (10, 600)
+RETRY_STATUS_CODES = (502, 503, 504)
+
+DEFAULT_SCHEMA_TTL = 3600
+
+class SchemaCache:
+    """
+    Local versioned cache of the folder/table/column metadata of RestHub servers (JSON file)
+    The metadata of a server is dropped when its info (version) changes;
+    the info is checked again after ttl seconds (0: on every use)
+    """
+
+    def __init__(self, filename, ttl = DEFAULT_SCHEMA_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as f:
+                    self._data = json.load(f)
+            except (OSError, ValueError):
+                self._data = {}
+
+    def entry(self, url):
+        with self._lock:
+            return self._data.setdefault(url, {"info": None, "checked": 0, "tables": None, "table": {}})
+
+    def is_fresh(self, url):
+        return self.entry(url)["info"] is not None and (time.time() - self.entry(url)["checked"]) < self.ttl
+
+    def validate(self, url, info):
+        """
+        Drop the metadata of the server if its info changed
+        """
+        entry = self.entry(url)
+        info = json.dumps(info, sort_keys = True)
+        with self._lock:
+            if entry["info"] != info:
+                entry.update({"info": info, "tables": None, "table": {}})
+            entry["checked"] = time.time()
+        self.save()
+
+    def get(self, url, key):
+        """
+        Cached catalogue (key None) or table metadata (key FOLDER.TABLE)
+        """
+        entry = self.entry(url)
+        return entry["tables"] if key is None else entry["table"].get(key)
+
+    def put(self, url, key, value):
+        entry = self.entry(url)
+        with self._lock:
+            if key is None:
+                entry["tables"] = value
+            else:
+                entry["table"][key] = value
+        self.save()
+
+    def save(self):
+        with self._lock:
+            cache_dir = os.path.dirname(self.filename)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok = True)
+            tmp = "%s.%d.tmp" % (self.filename, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(self._data, f)
+            os.replace(tmp, self.filename)
+
 class RhApiRowCountError(Exception):
     
     def __init__(self, totalRows, fetchedRows):
@@ -62,19 +142,57 @@ class RhApi:
     RestHub API object
     """
 
-    def __init__(self, url, debug = False, sso = False):
+    def __init__(self, url, debug = False, sso = False, pool_size = DEFAULT_POOL_SIZE, retries = DEFAULT_RETRIES, backoff = DEFAULT_BACKOFF, timeout = DEFAULT_TIMEOUT, workers = None, cache_file = None, request_hook = None, schema_cache = None, schema_ttl = DEFAULT_SCHEMA_TTL):
         """
         Construct API object.
         url: URL to RestHub endpoint, i.e. http://localhost:8080/api
         debug: should debug messages be printed out? Verbose!
         sso: use cookie provider from SSO_COOKIE_PROVIDER string
+        pool_size: number of keep-alive connections kept open to the server
+        retries: number of retries on connection errors and 502/503/504 responses
+        backoff: backoff factor (seconds) between retries
+        timeout: request timeout in seconds, or (connect, read) tuple
+        workers: number of pages fetched concurrently (default: pool_size)
+        cache_file: JSON file to keep the query -> qid map between runs (optional)
+        request_hook: function called after each request with (method, url, status code, response bytes, seconds) (optional)
+        schema_cache: JSON file to keep the folder/table metadata between runs (optional, see SchemaCache)
+        schema_ttl: seconds before the server version of the cached metadata is checked again
         """
         if re.match("/$", url) is None:
             url = url + "/"
         self.url = url
         self.debug = debug
+        self.timeout = timeout
+        self.workers = max(1, workers if workers is not None else pool_size)
         self.dprint("url = ", self.url)
 
+        retry = Retry(
+            total = retries,
+            connect = retries,
+            read = retries,
+            status = retries,
+            backoff_factor = backoff,
+            status_forcelist = RETRY_STATUS_CODES,
+            allowed_methods = None,
+            raise_on_status = False)
+        # pool_block: requests from concurrent threads wait for a free connection instead of opening more
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size, max_retries = retry, pool_block = True)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # Caches: query text -> qid, (qid, verbose) -> metadata, (qid, params) -> count
+        self._qids = {}
+        self._metadata = {}
+        self._counts = {}
+        self._unvalidated_qids = set()
+        self._cache_lock = threading.Lock()
+        self.cache_file = cache_file
+        self._load_cache()
+        self.request_hook = request_hook
+        self.schema = SchemaCache(schema_cache, ttl = schema_ttl) if schema_cache is not None else None
+        self._schema_checked = False
+
         self.cprov = None
         if sso and re.search("^https", url):
             mod_name, fun_name = SSO_COOKIE_PROVIDER.split(":")
@@ -89,7 +207,7 @@ class RhApi:
             if self.cprov is not None:
                 cookies = self.cprov(self.url, force_level = force_level)
 
-            r = action(url = url, headers = headers, data = data, cookies = cookies, verify = False)
+            r = action(url = url, headers = headers, data = data, cookies = cookies, verify = False, timeout = self.timeout)
 
             if r.status_code == 200 and r.url.startswith(SSO_LOGIN_URL):
                 if force_level < 2:
@@ -103,6 +221,66 @@ class RhApi:
 
             return r
 
+    def _load_cache(self):
+        """
+        Load the query -> qid map from the cache file
+        """
+        if self.cache_file is None or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r") as f:
+                qids = json.load(f).get(self.url, {})
+        except (OSError, ValueError) as e:
+            self.dprint("Could not read cache file ", self.cache_file, ": ", e)
+            return
+        self._qids.update(qids)
+        # qids from a previous run may have expired on the server: check them on first use
+        self._unvalidated_qids.update(qids.values())
+
+    def _save_cache(self):
+        """
+        Save the query -> qid map to the cache file
+        """
+        if self.cache_file is None:
+            return
+        with self._cache_lock:
+            d = {}
+            if os.path.exists(self.cache_file):
+                try:
+                    with open(self.cache_file, "r") as f:
+                        d = json.load(f)
+                except (OSError, ValueError):
+                    d = {}
+            d[self.url] = dict(self._qids)
+            cache_dir = os.path.dirname(self.cache_file)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok = True)
+            tmp = "%s.%d.tmp" % (self.cache_file, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(d, f)
+            os.replace(tmp, self.cache_file)
+
+    def clear_cache(self):
+        """
+        Forget all cached qids, metadata and counts
+        """
+        self._qids.clear()
+        self._metadata.clear()
+        self._counts.clear()
+        self._unvalidated_qids.clear()
+
+    def close(self):
+        """
+        Close the pooled connections
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def dprint(self, *args):
         """
         Print debug information
@@ -148,9 +326,12 @@ class RhApi:
         else:
             method = method.lower()
 
-        action = getattr(requests, method, None)
+        action = getattr(self.session, method, None)
         if action:
+            start = time.time()
             resp = self._action(action, headers = headers, url = callurl, data = data)
+            if self.request_hook is not None:
+                self.request_hook(method, callurl, resp.status_code, len(resp.content), time.time() - start)
         else:
             raise NameError('Unknown HTTP method: ' + method)
 
@@ -177,17 +358,40 @@ class RhApi:
         """
         return self.get(["info"], verbose = verbose)
     
+    def _cached_schema(self, key, parts, verbose = False):
+        """
+        Metadata from the schema cache (if any), fetched and stored if missing
+        Verbose metadata is never cached
+        """
+        if self.schema is None or verbose:
+            return self.get(parts, verbose = verbose)
+        if not self._schema_checked:
+            if not self.schema.is_fresh(self.url):
+                self.schema.validate(self.url, self.info())
+            self._schema_checked = True
+        value = self.schema.get(self.url, key)
+        if value is None:
+            value = self.get(parts)
+            self.schema.put(self.url, key, value)
+        return value
+
+    def catalogue(self, verbose = False):
+        """
+        Get the folders and their tables
+        """
+        return self._cached_schema(None, ["tables"], verbose = verbose)
+
     def folders(self, verbose = False):
         """
         Get list of folders
         """
-        return list(self.get(["tables"], verbose = verbose).keys())
+        return list(self.catalogue(verbose = verbose).keys())
 
     def tables(self, folder, verbose = False):
         """
         Get tables for folder or all
         """
-        raw = self.get(["tables"], verbose = verbose)
+        raw = self.catalogue(verbose = verbose)
         d = []
         for t in raw[folder].keys(): 
             d.append(t)
@@ -197,31 +401,66 @@ class RhApi:
         """
         Get info for table
         """
-        return self.get(["table", folder, table], verbose = verbose)
+        return self._cached_schema(folder + "." + table, ["table", folder, table], verbose = verbose)
+
+    def columns(self, folder, table):
+        """
+        Get the column names of a table
+        """
+        return [c["name"] for c in self.table(folder, table)["columns"]]
+
+    def cached_columns(self, folder):
+        """
+        Get the column names of the tables of a folder found in the schema cache, without any request
+        """
+        if self.schema is None:
+            return {}
+        entry = self.schema.entry(self.url)
+        return dict((key.split(".", 1)[1], [c["name"] for c in value["columns"]]) for key, value in entry["table"].items() if key.split(".", 1)[0] == folder)
 
     def qid(self, query):
         """
-        Create query based on [query] and return its ID
+        Create query based on [query] and return its ID (cached per query text)
         """
-        return self.get(["query"], query)
+        qid = self._qids.get(query)
+        if qid is not None and qid in self._unvalidated_qids:
+            self._unvalidated_qids.discard(qid)
+            try:
+                self.query(qid, verbose = True)
+            except Exception as e:
+                self.dprint("Cached qid ", qid, " is not valid anymore: ", e)
+                qid = None
+        if qid is None:
+            qid = self.get(["query"], query)
+            self._qids[query] = qid
+            self._save_cache()
+        return qid
 
     def query(self, qid, verbose = False):
         """
         Return qid metadata (assuming it exists..)
         """
-        return self.get(["query", qid], verbose = verbose)
+        key = (qid, bool(verbose))
+        if key not in self._metadata:
+            self._metadata[key] = self.get(["query", qid], verbose = verbose)
+        return self._metadata[key]
 
     def clean(self, qid, verbose = False):
         """
         Remove cache for query (assuming it exists..)
         """
+        for key in [k for k in self._counts.keys() if k[0] == qid]:
+            self._counts.pop(key, None)
         return self.get(["query", qid, "cache"], verbose = verbose, method = 'DELETE')
 
-    def count(self, qid, params = None, verbose = False):
+    def count(self, qid, params = None, verbose = False, refresh = False):
         """
-        Get number of rows in a query 
+        Get number of rows in a query (cached per qid and parameters, unless refresh)
         """
-        return int(self.get(["query", qid, "count"], params = params, verbose = verbose))
+        key = (qid, tuple(sorted((str(k), str(v)) for k, v in (params or {}).items())))
+        if refresh or key not in self._counts:
+            self._counts[key] = int(self.get(["query", qid, "count"], params = dict(params) if params else None, verbose = verbose))
+        return self._counts[key]
 
     def data(self, qid, params = None, form = 'text/csv', pagesize = None, page = None, verbose = False, cols = False, inline_clobs = False):
         """
@@ -229,21 +468,58 @@ class RhApi:
         """
 
         rowsLimit = self.query(qid, verbose = True)["rowsLimit"]
-        count = int(self.count(qid))
-        
-        ps = ["query", qid]
+        count = int(self.count(qid, params))
+
         if pagesize is None or page is None:
             if count > rowsLimit:
                 raise RhApiRowLimitError(count, rowsLimit)
         else:
             if pagesize > rowsLimit:
                 raise RhApiPageSizeError(count, rowsLimit, pagesize)
-            else:
-                ps.extend(["page", pagesize, page]);
-                
+
+        return self._data(qid, params, form, pagesize, page, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
+
+    def _data(self, qid, params = None, form = 'text/csv', pagesize = None, page = None, verbose = False, cols = False, inline_clobs = False):
+        """
+        Get data rows without checking the row limits
+        """
+        ps = ["query", qid]
+        if pagesize is not None and page is not None:
+            ps.extend(["page", pagesize, page])
         ps.append("data")
+        # get() fills in the _verbose/_cols flags, so do not share the params dict between threads
+        params = dict(params) if params else None
         return self.get(ps, None, { "Accept": form }, params, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
 
+    def pager(self, qid, params = None, refresh = False):
+        """
+        Get (rowsLimit, count, pages) needed to fetch all rows of a query page by page
+        """
+        rowsLimit = self.query(qid, verbose = True)["rowsLimit"]
+        count = int(self.count(qid, params, refresh = refresh))
+        pages = max(1, -(-count // rowsLimit))
+        return rowsLimit, count, pages
+
+    def pages(self, qid, pages, pagesize, params = None, form = 'application/json', verbose = False, cols = False, inline_clobs = False):
+        """
+        Fetch pages 1..pages concurrently (at most self.workers at a time) and yield them in order
+        """
+        workers = min(self.workers, pages)
+        with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+            futures = collections.deque()
+            try:
+                for page in range(1, (pages + 1)):
+                    # Run in a copy of the caller context, so that the request hook sees the context variables of the caller
+                    futures.append(executor.submit(contextvars.copy_context().run, self._data, qid, params, form, pagesize, page, verbose = verbose, cols = cols, inline_clobs = inline_clobs))
+                    # Keep a bounded number of pages in flight
+                    if len(futures) >= 2 * workers:
+                        yield futures.popleft().result()
+                while futures:
+                    yield futures.popleft().result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
     def csv(self, query, params = None, pagesize = None, page = None, verbose = False, inline_clobs = False):
         """
         Get rows in CSV format 
@@ -269,22 +545,37 @@ class RhApi:
         """
         Get all rows in JSON format (array of arrays)
         """
-        
-        rows = []
-        
-        qid = self.qid(query)     
-        rowsLimit = self.query(qid, verbose = True)["rowsLimit"]
-        count = int(self.count(qid, params))
-        pages = int(count/rowsLimit) + 1
-        
-        for page in range(1, (pages + 1)):
-            data = self.data(qid, params, form="application/json", page = page, pagesize = rowsLimit, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
-            rows.extend(data["data"])
-        
-        if count != len(rows):
-            raise RhApiRowCountError(count, len(rows))
-        
-        return rows
+        return self._rows_all(query, params, 'application/json', verbose = verbose, cols = cols, inline_clobs = inline_clobs)
+
+    def _rows_all(self, query, params = None, form = 'application/json', verbose = False, cols = False, inline_clobs = False):
+        """
+        Get all rows in JSON or JSON2 format, fetching the pages concurrently
+        """
+        return list(self.iter_rows(query, params, form = form, verbose = verbose, cols = cols, inline_clobs = inline_clobs))
+
+    def iter_rows(self, query, params = None, form = 'application/json2', verbose = False, cols = False, inline_clobs = False, refresh = False):
+        """
+        Iterate over all rows of a query in JSON (arrays) or JSON2 (objects) format
+        Pages are fetched concurrently and decoded one at a time, so only a few pages are held in memory
+        If refresh, the count of the rows is fetched again (not taken from the count cache)
+        Raises RhApiRowCountError at the end if the number of rows does not match the count
+        """
+
+        if form not in ['application/json', 'application/json2']:
+            raise ValueError('Rows can only be iterated in application/json or application/json2 format, not ' + form)
+
+        qid = self.qid(query)
+        rowsLimit, count, pages = self.pager(qid, params, refresh = refresh)
+
+        fetched = 0
+        for data in self.pages(qid, pages, rowsLimit, params, form = form, verbose = verbose, cols = cols, inline_clobs = inline_clobs):
+            rows = data["data"]
+            del data
+            fetched = fetched + len(rows)
+            yield from rows
+
+        if count != fetched:
+            raise RhApiRowCountError(count, fetched)
     
     def json2(self, query, params = None, pagesize = None, page = None, verbose = False, cols = False, inline_clobs = False):
         """
@@ -293,6 +584,86 @@ class RhApi:
         qid = self.qid(query)
         return self.data(qid, params, 'application/json2', pagesize, page, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
 
+    def json2_all(self, query, params = None, verbose = False, cols = False, inline_clobs = False):
+        """
+        Get all rows in JSON2 format (array of objects)
+        """
+        return self._rows_all(query, params, 'application/json2', verbose = verbose, cols = cols, inline_clobs = inline_clobs)
+
+# Maximum number of AsyncRhApi calls running at the same time (all instances of an event loop)
+DEFAULT_ASYNC_LIMIT = DEFAULT_POOL_SIZE
+
+_async_semaphores = weakref.WeakKeyDictionary()
+
+def async_limit(limit = DEFAULT_ASYNC_LIMIT):
+    """
+    Semaphore limiting the concurrent AsyncRhApi calls of the running event loop
+    The limit is set by the first call in the loop
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if loop not in _async_semaphores:
+        _async_semaphores[loop] = asyncio.Semaphore(limit)
+    return _async_semaphores[loop]
+
+class AsyncRhApi:
+    """
+    Asyncio facade over RhApi: the blocking calls run in worker threads, so calls can overlap with asyncio.gather
+    The calls of all instances in an event loop share a global limit (see async_limit),
+    and the requests of a RhApi instance share its connection pool, for e.g.:
+        api = AsyncRhApi(utils.get_rhapi())
+        l_results = await asyncio.gather(*[api.json2_all(_query) for _query in l_queries])
+    """
+
+    def __init__(self, api = None, limit = DEFAULT_ASYNC_LIMIT, **kwargs):
+        """
+        api: RhApi instance to use, or None to create one with kwargs (url, ...)
+        limit: maximum number of concurrent calls (global, set by the first call in the event loop)
+        """
+        self.api = api if api is not None else RhApi(**kwargs)
+        self.limit = limit
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Run a blocking function in a worker thread within the global limit
+        """
+        import asyncio
+        async with async_limit(self.limit):
+            return await asyncio.to_thread(function, *args, **kwargs)
+
+    async def info(self, verbose = False):
+        return await self.run(self.api.info, verbose = verbose)
+
+    async def table(self, folder, table, verbose = False):
+        return await self.run(self.api.table, folder, table, verbose = verbose)
+
+    async def qid(self, query):
+        return await self.run(self.api.qid, query)
+
+    async def count(self, qid, params = None, verbose = False):
+        return await self.run(self.api.count, qid, params = params, verbose = verbose)
+
+    async def data(self, qid, params = None, form = 'text/csv', pagesize = None, page = None, verbose = False, cols = False, inline_clobs = False):
+        return await self.run(self.api.data, qid, params = params, form = form, pagesize = pagesize, page = page, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
+
+    async def csv(self, query, params = None, pagesize = None, page = None, verbose = False, inline_clobs = False):
+        return await self.run(self.api.csv, query, params = params, pagesize = pagesize, page = page, verbose = verbose, inline_clobs = inline_clobs)
+
+    async def xml(self, query, params = None, pagesize = None, page = None, verbose = False, inline_clobs = False):
+        return await self.run(self.api.xml, query, params = params, pagesize = pagesize, page = page, verbose = verbose, inline_clobs = inline_clobs)
+
+    async def json(self, query, params = None, pagesize = None, page = None, verbose = False, cols = False, inline_clobs = False):
+        return await self.run(self.api.json, query, params = params, pagesize = pagesize, page = page, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
+
+    async def json_all(self, query, params = None, verbose = False, cols = False, inline_clobs = False):
+        return await self.run(self.api.json_all, query, params = params, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
+
+    async def json2(self, query, params = None, pagesize = None, page = None, verbose = False, cols = False, inline_clobs = False):
+        return await self.run(self.api.json2, query, params = params, pagesize = pagesize, page = page, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
+
+    async def json2_all(self, query, params = None, verbose = False, cols = False, inline_clobs = False):
+        return await self.run(self.api.json2_all, query, params = params, verbose = verbose, cols = cols, inline_clobs = inline_clobs)
+
 from optparse import OptionParser
 import pprint
 
@@ -304,6 +675,96 @@ FORMATS = [ "csv", "xml", "json", "json2", "root" ]
 SSO_COOKIE_PROVIDER = "cern_sso_api:cern_sso_cookies"
 SSO_LOGIN_URL = "https://login.cern.ch/"
 
+ROOT_CHUNK_SIZE = 50000
+
+ROOT_FILL_HELPER = '''
+void rhapi_fill_tree(TTree *tree, Long64_t nrows, const std::vector<TBranch*> &branches, const std::vector<ULong64_t> &addresses, const std::vector<Long64_t> &strides) {
+    for (Long64_t i = 0; i < nrows; ++i) {
+        for (size_t b = 0; b < branches.size(); ++b) {
+            branches[b]->SetAddress((void*) (addresses[b] + i * strides[b]));
+        }
+        tree->Fill();
+    }
+}
+'''
+
+class RootWriter:
+    """
+    Columnar writer of query results (json format with cols) into a ROOT TTree.
+    Each chunk of rows is converted column by column into NumPy arrays in a single pass
+    and the tree is filled from the array buffers by a compiled loop.
+    Branch types follow the column metadata: NUMBER columns become Long64_t (L) if their scale is 0,
+    Double_t (D) otherwise, other columns variable length strings (C).
+    """
+
+    def __init__(self, filename, treename = 'data', title = 'data from RHAPI', chunksize = ROOT_CHUNK_SIZE):
+        import ROOT
+        self.ROOT = ROOT
+        if not hasattr(ROOT, 'rhapi_fill_tree'):
+            ROOT.gInterpreter.Declare(ROOT_FILL_HELPER)
+        self.file = ROOT.TFile(filename, 'RECREATE')
+        self.tree = ROOT.TTree(treename, title)
+        self.chunksize = chunksize
+        self.cols = None
+        self.types = None
+        self.branches = None
+        self.entries = 0
+
+    def _branch_type(self, col):
+        """
+        Branch type of a column from its metadata: NUMBER columns with a zero scale are Long64_t (L),
+        other NUMBER columns Double_t (D), so that no chunk can be truncated; the rest are strings (C)
+        """
+        if col['type'] != 'NUMBER':
+            return 'C'
+        return 'L' if col.get('scale', None) == 0 else 'D'
+
+    def _column(self, rows, ci, bt):
+        import numpy as np
+        if bt == 'L':
+            return np.array([-1 if r[ci] is None else r[ci] for r in rows], dtype = np.int64)
+        if bt == 'D':
+            return np.array([-1 if r[ci] is None else r[ci] for r in rows], dtype = np.float64)
+        values = np.array([b'' if r[ci] is None else str(r[ci]).encode('utf-8') for r in rows], dtype = bytes)
+        # One more byte for the terminating null character
+        return values.astype('S%d' % (values.dtype.itemsize + 1))
+
+    def _book(self, arrays):
+        self.branches = self.ROOT.std.vector('TBranch*')()
+        for c, bt, values in zip(self.cols, self.types, arrays):
+            self.branches.push_back(self.tree.Branch(c['name'], values, '%s/%s' % (c['name'], bt)))
+
+    def fill(self, data):
+        """
+        Fill the tree with the rows of a result (json format with cols), chunksize rows at a time
+        """
+        import numpy as np
+        if self.cols is None:
+            self.cols = data['cols']
+            self.types = [ self._branch_type(c) for c in self.cols ]
+        rows = data['data']
+        for start in range(0, max(len(rows), 1), self.chunksize):
+            chunk = rows[start:(start + self.chunksize)]
+            columns = [ self._column(chunk, i, bt) for i, bt in enumerate(self.types) ]
+            arrays = [ values if len(values) > 0 else np.zeros(1, dtype = values.dtype) for values in columns ]
+            if self.branches is None:
+                self._book(arrays)
+            if len(chunk) == 0:
+                continue
+            addresses = self.ROOT.std.vector('ULong64_t')([ values.ctypes.data for values in arrays ])
+            strides = self.ROOT.std.vector('Long64_t')([ values.strides[0] for values in arrays ])
+            self.ROOT.rhapi_fill_tree(self.tree, len(chunk), self.branches, addresses, strides)
+            # Do not keep pointers to the chunk buffers
+            self.tree.ResetBranchAddresses()
+            self.entries += len(chunk)
+
+    def close(self, verbose = True):
+        if verbose:
+            self.tree.Print()
+        self.file.cd()
+        self.tree.Write()
+        self.file.Close()
+
 class CLIClient:
     
     def __init__(self):
@@ -325,6 +786,12 @@ class CLIClient:
         self.parser.add_option("-n", "--clean",    dest = "clean",    help = "clean cache before executing query (new results). Default: False", action = "store_true", default = False)
         self.parser.add_option("-p",               dest = "param",    help = "parameter for QUERY in form -pNAME=VALUE", metavar = "PARAM", action="append")
         self.parser.add_option("-r", "--root",     dest = "root",     help = "ROOT file name, if format set to root. Default: " + DEFAULT_ROOT_FILE, metavar = "ROOT", default=DEFAULT_ROOT_FILE)
+        self.parser.add_option("-t", "--timeout",  dest = "timeout",  help = "read timeout per request in seconds. Default: %d" % DEFAULT_TIMEOUT[1], metavar = "TIMEOUT", default = DEFAULT_TIMEOUT[1], type="float")
+        self.parser.add_option("-y", "--retries",  dest = "retries",  help = "number of retries on connection errors. Default: %d" % DEFAULT_RETRIES, metavar = "RETRIES", default = DEFAULT_RETRIES, type="int")
+        self.parser.add_option("-k", "--qidcache", dest = "qidcache", help = "JSON file to cache query IDs between calls. Default: None", metavar = "FILE", default = None)
+        self.parser.add_option("-O", "--output",   dest = "output",   help = "file to write the csv or xml QUERY data to, pages are written as they arrive with --all. Default: stdout", metavar = "FILE", default = None)
+        self.parser.add_option("-d", "--schemacache", dest = "schemacache", help = "JSON file to cache the folder/table metadata between calls. Default: None", metavar = "FILE", default = None)
+        self.parser.add_option("-w", "--workers",  dest = "workers",  help = "number of pages fetched concurrently with --all. Default: %d" % DEFAULT_POOL_SIZE, metavar = "WORKERS", default = DEFAULT_POOL_SIZE, type="int")
 
     def pprint(self, data):
         self.pp.pprint(data)
@@ -401,7 +868,7 @@ class CLIClient:
 
             (options, args) = self.parser.parse_args()
 
-            api = RhApi(options.url, debug = options.verbose, sso = options.sso)
+            api = RhApi(options.url, debug = options.verbose, sso = options.sso, retries = options.retries, timeout = (DEFAULT_TIMEOUT[0], options.timeout), pool_size = options.workers, cache_file = options.qidcache, schema_cache = options.schemacache)
 
             # Info
             if options.info:
@@ -470,38 +937,26 @@ class CLIClient:
                         if options.size and options.page and options.all:
                             self.parser.error('Wrong combination of options: ALL and SIZE both can not be defined')
                         
-                        if options.format == 'csv':
-                            try:
-                                print(api.csv(arg, params = params, pagesize = options.size, page = options.page, verbose = options.verbose, inline_clobs = options.inclob))
-                            except RhApiRowLimitError as e:
-                                if options.all:
-                                    page = 0
-                                    while (page * e.rowsLimit) < e.count:
-                                        page = page + 1
-                                        res = api.csv(arg, params = params, pagesize = e.rowsLimit, page = page, verbose = options.verbose, inline_clobs = options.inclob)
-                                        if page == 1:
-                                            print(res, end = '')
-                                        else:
-                                            print('\n'.join(res.split('\n')[1:]), end = '')
-                                else:
-                                    raise e
-
-                        if options.format == 'xml':
+                        if options.format in ['csv', 'xml']:
+                            out = open(options.output, 'w', encoding = 'utf-8') if options.output else sys.stdout
                             try:
-                                print(api.xml(arg, params = params, pagesize = options.size, page = options.page, verbose = options.verbose, inline_clobs = options.inclob))
+                                method = getattr(api, options.format)
+                                print(method(arg, params = params, pagesize = options.size, page = options.page, verbose = options.verbose, inline_clobs = options.inclob), file = out)
                             except RhApiRowLimitError as e:
                                 if options.all:
-                                    page = 0
-                                    print('<?xml version="1.0" encoding="UTF-8" standalone="no"?><data>', end = '')
-                                    while (page * e.rowsLimit) < e.count:
-                                        page = page + 1
-                                        res = api.xml(arg, params = params, pagesize = e.rowsLimit, page = page, verbose = options.verbose, inline_clobs = options.inclob)
-                                        root = minidom.parseString(res).documentElement
-                                        for row in root.getElementsByTagName('row'):
-                                            print(row.toxml(), end = '')
-                                    print('</data>')
+                                    qid = api.qid(arg)
+                                    rowsLimit, count, pages = api.pager(qid, params)
+                                    form = 'text/csv' if options.format == 'csv' else 'text/xml'
+                                    res = api.pages(qid, pages, rowsLimit, params, form = form, verbose = options.verbose, inline_clobs = options.inclob)
+                                    if options.format == 'csv':
+                                        self._write_csv_pages(res, out)
+                                    else:
+                                        self._write_xml_pages(res, out)
                                 else:
                                     raise e
+                            finally:
+                                if out is not sys.stdout:
+                                    out.close()
 
                         if options.format in ['json','json2','root']:
                             try:
@@ -511,15 +966,26 @@ class CLIClient:
                                 data = method(arg, params = params, pagesize = options.size, page = options.page, verbose = options.verbose, cols = in_cols, inline_clobs = options.inclob)
                             except RhApiRowLimitError as e:
                                 if options.all:
-                                    page = 0
+                                    qid = api.qid(arg)
+                                    rowsLimit, count, pages = api.pager(qid, params)
+                                    form = 'application/json2' if options.format == 'json2' else 'application/json'
+                                    if options.format == 'root':
+                                        # Write the pages into the tree as they arrive
+                                        writer = RootWriter(options.root)
+                                        for res in api.pages(qid, pages, rowsLimit, params, form = form, verbose = options.verbose, cols = in_cols, inline_clobs = options.inclob):
+                                            writer.fill(res)
+                                        writer.close()
+                                        if count != writer.entries:
+                                            raise RhApiRowCountError(count, writer.entries)
+                                        return 0
                                     data = None
-                                    while (page * e.rowsLimit) < e.count:
-                                        page = page + 1
-                                        res = method(arg, params = params, pagesize = e.rowsLimit, page = page, verbose = options.verbose, cols = in_cols, inline_clobs = options.inclob)
+                                    for res in api.pages(qid, pages, rowsLimit, params, form = form, verbose = options.verbose, cols = in_cols, inline_clobs = options.inclob):
                                         if data is None:
                                             data = res
                                         else:
                                             data['data'].extend(res['data'])
+                                    if count != len(data['data']):
+                                        raise RhApiRowCountError(count, len(data['data']))
                                 else:
                                     raise e
 
@@ -546,60 +1012,36 @@ class CLIClient:
             import traceback
             traceback.print_exc()
 
-    def _root_column(self, data, ci, ct, cn):
-
-        type_mapping = {
-            str:   'Char_t',
-            int:   'Int_t',
-            float: 'Float_t'
-        }
+    def _write_csv_pages(self, pages, out):
+        """
+        Write CSV pages as they arrive, keeping only the header of the first page
+        """
+        for page, res in enumerate(pages, 1):
+            if page == 1:
+                out.write(res)
+            else:
+                start = res.find('\n') + 1
+                if start > 0:
+                    out.write(res[start:])
 
-        if ct == 'NUMBER':
-            t = int
-            for r in data['data']:
-                if r[ci] is not None and type(r[ci]) == float:
-                    t = float
-                    break
-            return type_mapping[t] + ' ' + cn
-        else:
-            l = 1
-            for r in data['data']:
-                if r[ci] is None:
-                    r[ci] = ''
-                elif len(r[ci]) > l:
-                    l = len(r[ci])
-            return type_mapping[str] + ' ' + cn + '[' + str(l) + ']'
+    def _write_xml_pages(self, pages, out):
+        """
+        Write the rows of XML pages as they arrive, between the first <row> and the closing </data> of each page
+        """
+        out.write('<?xml version="1.0" encoding="UTF-8" standalone="no"?><data>')
+        for res in pages:
+            start = res.find('<row')
+            if start < 0:
+                continue
+            end = res.rfind('</data>')
+            out.write(res[start:end] if end > start else res[start:])
+        out.write('</data>\n')
 
     def _to_root(self, data, filename):
 
-        import ROOT
-        from ROOT import TFile, TTree, gROOT, AddressOf
-
-        columns = [ self._root_column(data, i, c['type'], c['name']) for i,c in enumerate(data['cols']) ]
-        header = 'struct data_t { ' + ';'.join(columns) + '; };'
-
-        gROOT.ProcessLine(header)
-        row = ROOT.data_t()
-        f = TFile(filename, 'RECREATE')
-        tree = TTree('data', 'data from RHAPI')
-        tree.Branch('data', row)
-
-        for r in data['data']:
-            for i, c in enumerate(data['cols']):
-                v = r[i]
-                if v is None:
-                    if c['type'] == 'NUMBER': v = -1
-                    else: v = ''
-                try:
-                    setattr(row, c['name'], v)
-                except Exception as e:
-                    print(c['name'], '=', v)
-                    print(c, v)
-                    print(e)
-            tree.Fill()
-
-        tree.Print()
-        tree.Write()
+        writer = RootWriter(filename)
+        writer.fill(data)
+        writer.close()
 
 if __name__ == '__main__':
 
@@ -0,0 +1,781 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the RestHub server used through rhapi.RhApi
+Serves either a synthetic dataset of parts (parts, p-tables and c-tables) or a recorded response archive
+Can be used to test and benchmark the database code without a tunnel, for e.g.:
+    ./python/rhapi_server.py --port 8114 --trays 4 --latency 0.05
+    ./python/rhapi_server.py --port 8115 --record archive.json --upstream http://localhost:8113
+    ./python/rhapi_server.py --port 8114 --replay archive.json
+Set BTL_DB_PORT=8114 to query it through the database helpers of utils.py (or pass port = 8114 to the query functions)
+"""
+
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import math
+import random
+import re
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+# Not the port of the tunnel (TUNNEL_PORT), so that a forgotten stand-in never answers the scripts meant for the database
+DEFAULT_PORT = 8114
+TUNNEL_PORT = 8113
+
+# Maximum number of rows of a single (non-paged) result
+DEFAULT_ROWS_LIMIT = 1000
+
+# Location of the synthetic parts (constants.LOCATION.CIT)
+DEFAULT_LOCATION_ID = 5023
+
+# First barcodes of the synthetic parts (within the BARCODE_RANGES of constants.py for CIT)
+FIRST_BARCODES = {
+    "SiPMArray": 32110010000001,
+    "SensorModule": 32110020008401,
+    "LYSOMatrix #1": 32110030000001,
+    "DetectorModule": 32110040004201,
+    "FE": 32110050000001,
+    "RU": 32110060000500,
+    "Tray": 32110070000039,
+    "Cold Tray": 32110080000001,
+    "CC": 32110090000001,
+    "PCCIv1.2": 32110100000001,
+    "PCCIv2.5": 32110110000001,
+}
+
+# Position tables (table, position column) of the daughter parts
+POSITION_TABLES = {
+    "SiPMArray": ("p3", "APOSITION_IN_SENSORMODULE"),
+    "SensorModule": ("p11", "APOSITION_IN_DETECTORMODULE"),
+    "DetectorModule": ("p10", "APOSITION_IN_RU"),
+    "RU": ("p100", "APOSITION_IN_TRAY"),
+}
+
+NRUS_PER_TRAY = 6
+NDMS_PER_RU = 12
+NCHANNELS_PER_SIPM = 16
+
+
+def to_camel(column) :
+    """
+    Column name as returned in the JSON2 format, for e.g. PART_PARENT_ID -> partParentId
+    """
+    
+    l_words = column.lower().split("_")
+    
+    return l_words[0] + "".join(_word.capitalize() for _word in l_words[1:])
+
+
+class StdDev :
+    """
+    Sample standard deviation aggregate (as Oracle STDDEV) for SQLite
+    """
+    
+    def __init__(self) :
+        
+        self.l_values = []
+    
+    def step(self, value) :
+        
+        if (value is not None) :
+            
+            self.l_values.append(float(value))
+    
+    def finalize(self) :
+        
+        if not len(self.l_values) :
+            
+            return None
+        
+        if (len(self.l_values) == 1) :
+            
+            return 0.0
+        
+        mean = sum(self.l_values) / len(self.l_values)
+        
+        return math.sqrt(sum((_val - mean)**2 for _val in self.l_values) / (len(self.l_values) - 1))
+
+
+def regexp_like(value, pattern) :
+    """
+    Oracle REGEXP_LIKE for SQLite
+    """
+    
+    return None if (value is None) else int(re.search(pattern, str(value)) is not None)
+
+
+def to_number(value) :
+    """
+    Oracle TO_NUMBER for SQLite (raises on values that are not numbers, as Oracle does)
+    """
+    
+    return None if (value is None) else float(value)
+
+
+class SyntheticDataset :
+    """
+    In-memory SQLite database with the mtd_cmsr tables used by utils.py
+    Trays are fully assembled (RUs, DMs, SMs, SiPMs, LYSOs, FEs, ...); free SMs have no parent
+    """
+    
+    def __init__(self, ntrays = 1, nfree_sms = 50, location_id = DEFAULT_LOCATION_ID, seed = 1) :
+        
+        self.conn = sqlite3.connect(":memory:", check_same_thread = False)
+        self.conn.create_aggregate("STDDEV", 1, StdDev)
+        self.conn.create_function("REGEXP_LIKE", 2, regexp_like, deterministic = True)
+        self.conn.create_function("TO_NUMBER", 1, to_number, deterministic = True)
+        self.conn.execute("attach ':memory:' as mtd_cmsr")
+        self.conn.execute("create table mtd_cmsr.parts (ID integer primary key, BARCODE text, SERIAL_NUMBER text, KIND_OF_PART text, LOCATION_ID integer, PRODUCTION_DATE text, PART_PARENT_ID integer, RECORD_INSERTION_USER text)")
+        self.conn.execute("create index mtd_cmsr.parts_barcode on parts (BARCODE)")
+        self.conn.execute("create index mtd_cmsr.parts_parent on parts (PART_PARENT_ID)")
+        
+        for table, column in POSITION_TABLES.values() :
+            
+            self.conn.execute(f"create table mtd_cmsr.{table} (BARCODE text, {column} text)")
+            self.conn.execute(f"create index mtd_cmsr.{table}_barcode on {table} (BARCODE)")
+        
+        self.conn.execute("create table mtd_cmsr.c3000 (PART_BARCODE text, CHANNEL integer, VBRRT real)")
+        self.conn.execute("create table mtd_cmsr.c3060 (PART_BARCODE text, RAC real)")
+        self.conn.execute("create index mtd_cmsr.c3000_barcode on c3000 (PART_BARCODE)")
+        self.conn.execute("create index mtd_cmsr.c3060_barcode on c3060 (PART_BARCODE)")
+        
+        self.location_id = location_id
+        self.rng = random.Random(seed)
+        self.last_id = 1000
+        self.d_barcodes = dict(FIRST_BARCODES)
+        
+        for _ in range(ntrays) :
+            
+            self.add_tray()
+        
+        for _ in range(nfree_sms) :
+            
+            self.add_sm()
+        
+        self.conn.commit()
+    
+    def get_tables(self) :
+        
+        return [_row[0] for _row in self.conn.execute("select name from mtd_cmsr.sqlite_master where type = 'table' order by name")]
+    
+    def get_columns(self, table) :
+        """
+        Column metadata of a table, as RestHub returns it (name and type)
+        """
+        
+        l_info = self.conn.execute(f"pragma mtd_cmsr.table_info({table})").fetchall()
+        
+        return [{"name": _info[1], "type": "NUMBER" if _info[2].lower() in ["integer", "real"] else "VARCHAR2"} for _info in l_info]
+    
+    def add_part(self, parttype, parent_id = None, position = None) :
+        
+        self.last_id += 1
+        barcode = str(self.d_barcodes[parttype])
+        self.d_barcodes[parttype] += 1
+        
+        self.conn.execute("insert into mtd_cmsr.parts values (?, ?, ?, ?, ?, ?, ?, ?)", (
+            self.last_id,
+            barcode,
+            barcode,
+            parttype,
+            self.location_id,
+            f"2025-{self.rng.randint(1, 12):02d}-{self.rng.randint(1, 28):02d} 10:00:00",
+            parent_id,
+            "rhapi_server",
+        ))
+        
+        if (parttype in POSITION_TABLES and position is not None) :
+            
+            table, column = POSITION_TABLES[parttype]
+            self.conn.execute(f"insert into mtd_cmsr.{table} values (?, ?)", (barcode, str(position)))
+        
+        return self.last_id, barcode
+    
+    def add_sipm(self, parent_id = None, position = None) :
+        
+        _, barcode = self.add_part("SiPMArray", parent_id, position)
+        
+        self.conn.execute("insert into mtd_cmsr.c3060 values (?, ?)", (barcode, self.rng.uniform(5, 10)))
+        self.conn.executemany("insert into mtd_cmsr.c3000 values (?, ?, ?)", [(barcode, _ich, self.rng.uniform(37, 39)) for _ich in range(NCHANNELS_PER_SIPM)])
+    
+    def add_sm(self, parent_id = None, position = None) :
+        
+        sm_id, _ = self.add_part("SensorModule", parent_id, position)
+        
+        self.add_part("LYSOMatrix #1", sm_id)
+        
+        for sipm_position in ["Left", "Right"] :
+            
+            self.add_sipm(sm_id, sipm_position)
+    
+    def add_dm(self, parent_id = None, position = None) :
+        
+        dm_id, _ = self.add_part("DetectorModule", parent_id, position)
+        
+        self.add_part("FE", dm_id)
+        
+        for sm_position in ["Top", "Bottom"] :
+            
+            self.add_sm(dm_id, sm_position)
+    
+    def add_ru(self, parent_id = None, position = None) :
+        
+        ru_id, _ = self.add_part("RU", parent_id, position)
+        
+        for parttype in ["CC", "PCCIv1.2", "PCCIv2.5"] :
+            
+            self.add_part(parttype, ru_id)
+        
+        for dm_position in range(NDMS_PER_RU) :
+            
+            self.add_dm(ru_id, dm_position)
+    
+    def add_tray(self) :
+        
+        tray_id, _ = self.add_part("Tray")
+        
+        self.add_part("Cold Tray", tray_id)
+        
+        for ru_position in range(NRUS_PER_TRAY) :
+            
+            self.add_ru(tray_id, ru_position)
+
+
+class ResponseArchive :
+    """
+    Recorded responses, keyed by the request (method, path, parameters, Accept header and body)
+    Query IDs are replaced by a hash of the query text, so the keys do not depend on the server that recorded them
+    """
+    
+    def __init__(self, fname) :
+        
+        self.fname = fname
+        self.d_responses = {}
+        self.d_qids = {}
+        self.lock = threading.Lock()
+    
+    def load(self) :
+        
+        with open(self.fname, "r") as fopen :
+            
+            d_archive = json.load(fopen)
+        
+        self.d_responses = d_archive["responses"]
+        self.d_qids = d_archive["qids"]
+        
+        logger.info(f"Loaded {len(self.d_responses)} responses from {self.fname}")
+    
+    def save(self) :
+        
+        with self.lock :
+            
+            with open(self.fname, "w") as fopen :
+                
+                json.dump({"qids": self.d_qids, "responses": self.d_responses}, fopen, indent = 1, sort_keys = True)
+        
+        logger.info(f"Saved {len(self.d_responses)} responses to {self.fname}")
+    
+    def key(self, method, path, params, accept, body) :
+        
+        l_parts = [_part for _part in path.split("/") if _part]
+        
+        # Replace the query ID by the hash of the query
+        if (len(l_parts) >= 2 and l_parts[0] == "query") :
+            
+            l_parts[1] = self.d_qids.get(l_parts[1], l_parts[1])
+        
+        if (method == "POST") :
+            
+            body = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        
+        params_str = "&".join(f"{_key}={_val}" for _key, _val in sorted(params.items()))
+        
+        return f"{method} /{'/'.join(l_parts)}?{params_str} {accept or ''} {body or ''}"
+    
+    def add_qid(self, qid, query) :
+        
+        with self.lock :
+            
+            self.d_qids[qid] = hashlib.sha1(query.encode("utf-8")).hexdigest()
+    
+    def get(self, key) :
+        
+        return self.d_responses.get(key, None)
+    
+    def put(self, key, status, content_type, body) :
+        
+        with self.lock :
+            
+            self.d_responses[key] = {"status": status, "content_type": content_type, "body": body}
+
+
+class RhApiHandler(http.server.BaseHTTPRequestHandler) :
+    
+    protocol_version = "HTTP/1.1"
+    
+    # Avoid the delayed ACKs on keep-alive connections
+    disable_nagle_algorithm = True
+    
+    def log_message(self, format, *args) :
+        
+        logger.debug(format % args)
+    
+    def setup(self) :
+        
+        self.server.count("connections")
+        super().setup()
+    
+    def send(self, status, body, content_type = "text/plain") :
+        
+        body = body.encode("utf-8") if isinstance(body, str) else body
+        
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        
+        self.server.count("bytes", len(body))
+    
+    def handle_request(self, method) :
+        
+        self.server.count("requests")
+        self.server.delay()
+        
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+        accept = self.headers.get("Accept", None)
+        
+        try :
+            
+            status, content_type, response = self.server.respond(method, url.path, params, accept, body)
+        
+        except Exception as err :
+            
+            logger.error(f"Error handling {method} {self.path}: {err}")
+            status, content_type, response = 500, "text/plain", str(err)
+        
+        self.send(status, response, content_type)
+    
+    def do_GET(self) :
+        
+        self.handle_request("GET")
+    
+    def do_POST(self) :
+        
+        self.handle_request("POST")
+    
+    def do_DELETE(self) :
+        
+        self.handle_request("DELETE")
+
+
+class RhApiServer(http.server.ThreadingHTTPServer) :
+    """
+    Serves the RestHub endpoints used by rhapi.RhApi:
+    POST query, GET query/<qid>, query/<qid>/count, query/<qid>[/page/<size>/<n>]/data, info, tables, table/<folder>/<table>, DELETE query/<qid>/cache
+    Responses come from the synthetic dataset, the replayed archive, or the upstream server (recording)
+    """
+    
+    daemon_threads = True
+    
+    def __init__(
+        self,
+        port = DEFAULT_PORT,
+        dataset = None,
+        archive = None,
+        upstream = None,
+        latency = 0,
+        jitter = 0,
+        rows_limit = DEFAULT_ROWS_LIMIT,
+    ) :
+        
+        super().__init__(("localhost", port), RhApiHandler)
+        
+        self.dataset = dataset
+        self.archive = archive
+        self.upstream = upstream
+        self.latency = latency
+        self.jitter = jitter
+        self.rows_limit = rows_limit
+        self.d_queries = {}
+        self.d_stats = {"connections": 0, "requests": 0, "bytes": 0, "replay_misses": 0}
+        self.lock = threading.Lock()
+        self.session = None
+        
+        if (upstream is not None) :
+            
+            import requests
+            self.session = requests.Session()
+    
+    def count(self, name, value = 1) :
+        
+        with self.lock :
+            
+            self.d_stats[name] += value
+    
+    def stats(self) :
+        
+        with self.lock :
+            
+            return dict(self.d_stats)
+    
+    def delay(self) :
+        
+        latency = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        
+        if (latency > 0) :
+            
+            time.sleep(latency)
+    
+    def start(self) :
+        """
+        Serve in a background thread
+        """
+        
+        thread = threading.Thread(target = self.serve_forever, daemon = True)
+        thread.start()
+        
+        return thread
+    
+    def respond(self, method, path, params, accept, body) :
+        
+        if (self.upstream is not None) :
+            
+            return self.respond_upstream(method, path, params, accept, body)
+        
+        if (self.dataset is None) :
+            
+            return self.respond_archive(method, path, params, accept, body)
+        
+        return self.respond_dataset(method, path, params, accept, body)
+    
+    def respond_upstream(self, method, path, params, accept, body) :
+        """
+        Forward the request to the upstream server and record the response
+        """
+        
+        headers = {"Accept": accept} if accept else {}
+        resp = self.session.request(method, f"{self.upstream.rstrip('/')}{path}", params = params, headers = headers, data = body.encode("utf-8") if body else None, timeout = 600)
+        content_type = resp.headers.get("Content-Type", "text/plain")
+        
+        if (method == "POST" and resp.status_code == 200) :
+            
+            self.archive.add_qid(resp.text.strip(), body)
+        
+        key = self.archive.key(method, path, params, accept, body)
+        self.archive.put(key, resp.status_code, content_type, resp.text)
+        
+        return resp.status_code, content_type, resp.text
+    
+    def respond_archive(self, method, path, params, accept, body) :
+        
+        key = self.archive.key(method, path, params, accept, body)
+        response = self.archive.get(key)
+        
+        if (response is None) :
+            
+            self.count("replay_misses")
+            logger.error(f"Request not found in the archive: {key}")
+            
+            return 404, "text/plain", f"Request not found in the archive: {method} {path}"
+        
+        return response["status"], response["content_type"], response["body"]
+    
+    def run_query(self, qid, params) :
+        
+        query = self.d_queries[qid]
+        d_binds = {_key: _val for _key, _val in params.items() if not _key.startswith("_")}
+        
+        with self.lock :
+            
+            cursor = self.dataset.conn.execute(query, d_binds)
+            l_columns = [_desc[0].upper() for _desc in cursor.description]
+            l_rows = cursor.fetchall()
+        
+        return l_columns, l_rows
+    
+    def respond_dataset(self, method, path, params, accept, body) :
+        
+        l_parts = [_part for _part in path.split("/") if _part]
+        
+        if (l_parts == ["info"]) :
+            
+            return 200, "application/json", json.dumps({"version": "rhapi_server", "rowsLimit": self.rows_limit})
+        
+        if (l_parts == ["tables"]) :
+            
+            with self.lock :
+                
+                l_tables = self.dataset.get_tables()
+            
+            return 200, "application/json", json.dumps({"mtd_cmsr": {_table: {} for _table in l_tables}})
+        
+        if (len(l_parts) == 3 and l_parts[0] == "table" and l_parts[1] == "mtd_cmsr") :
+            
+            with self.lock :
+                
+                l_columns = self.dataset.get_columns(l_parts[2]) if (l_parts[2] in self.dataset.get_tables()) else None
+            
+            if (l_columns is None) :
+                
+                return 404, "text/plain", f"Unknown table: {l_parts[1]}.{l_parts[2]}"
+            
+            return 200, "application/json", json.dumps({"name": l_parts[2], "columns": l_columns})
+        
+        if (not l_parts or l_parts[0] != "query") :
+            
+            return 404, "text/plain", f"Unknown resource: {path}"
+        
+        if (method == "POST") :
+            
+            qid = hashlib.sha1(body.encode("utf-8")).hexdigest()[:12]
+            self.d_queries[qid] = body
+            
+            return 200, "text/plain", qid
+        
+        qid = l_parts[1] if (len(l_parts) >= 2) else None
+        
+        if (qid not in self.d_queries) :
+            
+            return 404, "text/plain", f"Unknown query: {qid}"
+        
+        if (method == "DELETE") :
+            
+            return 204, "text/plain", ""
+        
+        if (len(l_parts) == 2) :
+            
+            return 200, "application/json", json.dumps({"qid": qid, "query": self.d_queries[qid], "rowsLimit": self.rows_limit})
+        
+        l_columns, l_rows = self.run_query(qid, params)
+        
+        if (l_parts[2] == "count") :
+            
+            return 200, "text/plain", str(len(l_rows))
+        
+        if (l_parts[2] == "page" and len(l_parts) == 6 and l_parts[5] == "data") :
+            
+            size, page = int(l_parts[3]), int(l_parts[4])
+            
+            if (size > self.rows_limit) :
+                
+                return 400, "text/plain", f"Page size {size} is larger than the rows limit {self.rows_limit}"
+            
+            l_rows = l_rows[(page-1)*size: page*size]
+        
+        elif (l_parts[2] == "data") :
+            
+            if (len(l_rows) > self.rows_limit) :
+                
+                return 400, "text/plain", f"Rows count {len(l_rows)} is larger than the rows limit {self.rows_limit}"
+        
+        else :
+            
+            return 404, "text/plain", f"Unknown resource: {path}"
+        
+        return format_rows(l_columns, l_rows, accept, cols = params.get("_cols", False))
+
+
+def get_column_type(l_rows, icol) :
+    
+    return "NUMBER" if all(isinstance(_row[icol], (int, float)) for _row in l_rows if _row[icol] is not None) else "VARCHAR2"
+
+
+def format_rows(l_columns, l_rows, accept, cols = False) :
+    """
+    Format the rows as RestHub does for the Accept header
+    Returns (status, content type, body)
+    """
+    
+    if (accept == "application/json2") :
+        
+        l_keys = [to_camel(_col) for _col in l_columns]
+        
+        return 200, "application/json", json.dumps({"data": [dict(zip(l_keys, _row)) for _row in l_rows]})
+    
+    if (accept == "application/json") :
+        
+        d_data = {"data": [list(_row) for _row in l_rows]}
+        
+        if cols :
+            
+            d_data["cols"] = [{"name": _col, "type": get_column_type(l_rows, _icol)} for _icol, _col in enumerate(l_columns)]
+        
+        return 200, "application/json", json.dumps(d_data)
+    
+    if (accept == "text/xml") :
+        
+        l_xml_rows = ["<row>" + "".join(f"<{to_camel(_col)}>{'' if _val is None else _val}</{to_camel(_col)}>" for _col, _val in zip(l_columns, _row)) + "</row>" for _row in l_rows]
+        
+        return 200, "text/xml", '<?xml version="1.0" encoding="UTF-8"?><data>' + "".join(l_xml_rows) + "</data>"
+    
+    l_csv_rows = [",".join(l_columns)] + [",".join("" if _val is None else str(_val) for _val in _row) for _row in l_rows]
+    
+    return 200, "text/csv", "\n".join(l_csv_rows) + "\n"
+
+
+def main() :
+    
+    # Argument parser
+    parser = argparse.ArgumentParser(
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter,
+        description = "Local stand-in for the RestHub server (synthetic dataset, or record/replay of a real server)",
+    )
+    
+    parser.add_argument(
+        "--port",
+        help = "Port to listen on",
+        type = int,
+        default = DEFAULT_PORT,
+    )
+    
+    parser.add_argument(
+        "--trays",
+        help = "Number of fully assembled trays in the synthetic dataset",
+        type = int,
+        default = 1,
+    )
+    
+    parser.add_argument(
+        "--freesms",
+        help = "Number of SMs without a parent in the synthetic dataset",
+        type = int,
+        default = 50,
+    )
+    
+    parser.add_argument(
+        "--locationid",
+        help = "Location ID of the synthetic parts",
+        type = int,
+        default = DEFAULT_LOCATION_ID,
+    )
+    
+    parser.add_argument(
+        "--seed",
+        help = "Random seed of the synthetic dataset",
+        type = int,
+        default = 1,
+    )
+    
+    parser.add_argument(
+        "--rowslimit",
+        help = "Maximum number of rows of a single result (page)",
+        type = int,
+        default = DEFAULT_ROWS_LIMIT,
+    )
+    
+    parser.add_argument(
+        "--latency",
+        help = "Delay (in seconds) added to every request",
+        type = float,
+        default = 0,
+    )
+    
+    parser.add_argument(
+        "--jitter",
+        help = "Random delay (in seconds) between 0 and this value added to every request",
+        type = float,
+        default = 0,
+    )
+    
+    group = parser.add_mutually_exclusive_group()
+    
+    group.add_argument(
+        "--record",
+        help = "Record the responses of the --upstream server into this archive file",
+        type = str,
+        default = None,
+    )
+    
+    group.add_argument(
+        "--replay",
+        help = "Serve the responses recorded in this archive file",
+        type = str,
+        default = None,
+    )
+    
+    parser.add_argument(
+        "--upstream",
+        help = "URL of the server to record (for e.g. the tunnel: http://localhost:8113)",
+        type = str,
+        default = None,
+    )
+    
+    # Parse arguments
+    args = parser.parse_args()
+    
+    logging.basicConfig(format = "[%(levelname)s] [%(asctime)s] %(message)s", level = logging.INFO)
+    
+    assert (bool(args.record) == bool(args.upstream)), "--record and --upstream must be used together"
+    
+    if (args.port == TUNNEL_PORT) :
+        
+        logger.warning(f"Serving on the tunnel port {TUNNEL_PORT}: the scripts and helpers meant for the database will query this stand-in instead")
+    
+    dataset = None
+    archive = None
+    
+    if (args.record) :
+        
+        archive = ResponseArchive(args.record)
+    
+    elif (args.replay) :
+        
+        archive = ResponseArchive(args.replay)
+        archive.load()
+    
+    else :
+        
+        logger.info(f"Building synthetic dataset with {args.trays} tray(s) and {args.freesms} free SM(s) ...")
+        dataset = SyntheticDataset(ntrays = args.trays, nfree_sms = args.freesms, location_id = args.locationid, seed = args.seed)
+    
+    server = RhApiServer(
+        port = args.port,
+        dataset = dataset,
+        archive = archive,
+        upstream = args.upstream,
+        latency = args.latency,
+        jitter = args.jitter,
+        rows_limit = args.rowslimit,
+    )
+    
+    # Stop cleanly (and save the recorded archive) on kill as well
+    signal.signal(signal.SIGTERM, lambda *args : sys.exit(0))
+    
+    logger.info(f"Serving on http://localhost:{args.port} (Ctrl+C to stop)")
+    
+    try :
+        
+        server.serve_forever()
+    
+    except KeyboardInterrupt :
+        
+        pass
+    
+    finally :
+        
+        server.server_close()
+        logger.info(f"Server statistics: {server.stats()}")
+        
+        if (args.record) :
+            
+            archive.save()
+    
+    return 0
+
+
+if __name__ == "__main__" :
+    
+    main()
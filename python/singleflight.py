@@ -0,0 +1,152 @@
+import concurrent.futures
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Call :
+    """
+    A call in flight: the future of its results ({item: result}) and the number of other requests waiting for it
+    """
+    
+    def __init__(self) :
+        
+        self.future = concurrent.futures.Future()
+        self.nwaiters = 0
+
+
+class SingleFlight :
+    """
+    Process-wide coalescing of fetches ("single-flight")
+    Concurrent requests for the same key share one call; the results are only kept while the call is in flight
+    (repeated requests after it are fetched again, e.g. through the query cache)
+    get_many coalesces item by item, so concurrent requests for overlapping sets of items only fetch each item once
+    """
+    
+    def __init__(self) :
+        
+        self.lock = threading.Lock()
+        
+        # key -> {item: call fetching it}
+        self.d_inflight = {}
+        
+        self.d_stats = {"calls": 0, "items": 0, "shared": 0}
+    
+    def get(self, key, func, refresh = False, copy = None) :
+        """
+        Result of func(), shared by the concurrent requests with the same key
+        See get_many for refresh and copy
+        """
+        
+        return self.get_many(key, [None], lambda _l_items: {None: func()}, refresh = refresh, copy = copy).get(None)
+    
+    def get_many(self, key, l_items, func, refresh = False, copy = None) :
+        """
+        Results of the items as a dictionary; func(l_items) must return a dictionary {item: result} (missing items are not found)
+        Only the items that are not in flight are passed to func
+        If refresh, the calls in flight are not joined (all the items are passed to func)
+        Results shared with other requests are returned through copy (e.g. copy.deepcopy) if provided, so that the requests can modify them
+        """
+        
+        l_items = list(dict.fromkeys(l_items))
+        
+        if refresh :
+            
+            return {_item: _res for _item, _res in func(l_items).items() if _res is not None}
+        
+        call = None
+        l_fetch = []
+        d_wait = {}
+        
+        with self.lock :
+            
+            d_inflight = self.d_inflight.setdefault(key, {})
+            
+            for item in l_items :
+                
+                if (item in d_inflight) :
+                    
+                    d_wait[item] = d_inflight[item]
+                
+                else :
+                    
+                    l_fetch.append(item)
+            
+            for call_wait in set(d_wait.values()) :
+                
+                call_wait.nwaiters += 1
+            
+            if len(l_fetch) :
+                
+                call = _Call()
+                
+                for item in l_fetch :
+                    
+                    d_inflight[item] = call
+                
+                self.d_stats["calls"] += 1
+                self.d_stats["items"] += len(l_fetch)
+            
+            self.d_stats["shared"] += len(d_wait)
+        
+        d_fetched = {}
+        shared = False
+        
+        if (call is not None) :
+            
+            try :
+                
+                d_fetched = func(l_fetch)
+            
+            except BaseException as e :
+                
+                with self.lock :
+                    
+                    for item in l_fetch :
+                        
+                        d_inflight.pop(item, None)
+                
+                call.future.set_exception(e)
+                raise
+            
+            # No request can join the call once it is out of flight
+            with self.lock :
+                
+                for item in l_fetch :
+                    
+                    d_inflight.pop(item, None)
+                
+                shared = call.nwaiters > 0
+            
+            call.future.set_result(d_fetched)
+        
+        # Items fetched by this call first, in the order returned by func
+        set_fetch = set(l_fetch)
+        d_results = {_item: _res for _item, _res in d_fetched.items() if (_item in set_fetch and _res is not None)}
+        
+        if (shared and copy is not None) :
+            
+            d_results = {_item: copy(_res) for _item, _res in d_results.items()}
+        
+        # Raises the exception of a failed call
+        for item, call_wait in d_wait.items() :
+            
+            result = call_wait.future.result().get(item, None)
+            
+            if (result is not None) :
+                
+                d_results[item] = result if (copy is None) else copy(result)
+        
+        l_order = [_item for _item in d_fetched if _item in set_fetch] + [_item for _item in l_items if _item not in set_fetch]
+        
+        return {_item: d_results[_item] for _item in l_order if _item in d_results}
+    
+    def print_stats(self) :
+        
+        if not (self.d_stats["calls"] or self.d_stats["shared"]) :
+            
+            return
+        
+        logger.info(f"Coalesced fetches: {self.d_stats['calls']} calls for {self.d_stats['items']} items, {self.d_stats['shared']} requested items shared")
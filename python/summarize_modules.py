@@ -14,6 +14,7 @@ import tqdm
 from ruamel.yaml.scalarstring import DoubleQuotedScalarString
 
 import constants
+import partgraph
 import utils
 from utils import logging
 from utils import yaml
@@ -304,9 +305,15 @@ def main() :
         required = True,
     )
     
+    utils.add_db_cache_arguments(parser)
+    utils.add_db_profile_arguments(parser)
+    
     # Parse arguments
     args = parser.parse_args()
     
+    utils.configure_db_cache(args)
+    utils.configure_db_profile(args)
+    
     rnd = random.Random(args.seed)
     
     l_location_ids = [vars(constants.LOCATION)[_loc] for _loc in args.location]
@@ -341,11 +348,7 @@ def main() :
         d_loaded_part_info[constants.DM.KIND_OF_PART] = utils.load_part_info(parttype = constants.DM.KIND_OF_PART, yamlfile = args.dminfo, extrainfo = args.dminfoextra)
     
     logging.info("Combining parts ...")
-    utils.combine_parts(
-        d_sipms = d_loaded_part_info[constants.SIPM.KIND_OF_PART],
-        d_sms = d_loaded_part_info[constants.SM.KIND_OF_PART],
-        d_dms = d_loaded_part_info[constants.DM.KIND_OF_PART],
-    )
+    part_graph = partgraph.PartGraph.from_stores(d_loaded_part_info)
     logging.info("Combined parts.")
     
     ## Load SM results if provided
@@ -484,7 +487,7 @@ def main() :
             #    run = run,
             #    fname = fname
             #)
-            d_modules[barcode] = SensorModule(**{"run": run, "fname": fname, **d_loaded_part_info[constants.SM.KIND_OF_PART][barcode].__dict__})
+            d_modules[barcode] = SensorModule(**{"run": run, "fname": fname, **part_graph.linked(barcode).__dict__})
         
         elif (args.moduletype == constants.DM.KIND_OF_PART) :
             
@@ -502,7 +505,7 @@ def main() :
             #d_modules[barcode].category = None
             
             #d_modules[barcode] = DetectorModule(**{"run": run, "fname": fname, **d_loaded_part_info[constants.DM.KIND_OF_PART][barcode].dict()})
-            d_modules[barcode] = DetectorModule(**{"run": run, "fname": fname, **d_loaded_part_info[constants.DM.KIND_OF_PART][barcode].__dict__})
+            d_modules[barcode] = DetectorModule(**{"run": run, "fname": fname, **part_graph.linked(barcode).__dict__})
             
     
     logging.info(f"Skipped {len(l_skipped_modules)} modules:")
@@ -524,9 +527,10 @@ def main() :
         
         with open(args.plotcfg, "r") as fopen :
             
-            d_plotcfgs = yaml.load(fopen.read())
+            d_plotcfgs = utils.safe_load_yaml(fopen.read())
     
     # Read the category config yaml
+    # Round-trip load: the categories are written back to the categorization file
     d_catcfgs = None
     
     with open(args.catcfg, "r") as fopen :
@@ -540,7 +544,7 @@ def main() :
         
         with open(args.defcfg, "r") as fopen :
             
-            d_defs = yaml.load(fopen.read())
+            d_defs = utils.safe_load_yaml(fopen.read())
     
     d_cat_results = {
         "categories": d_catcfgs["categories"],
@@ -929,13 +933,21 @@ def main() :
         
         #d_cat_pairs = {}
         
+        # The DMs loaded from --dminfo above are not parsed again; their extra info (--dminfoextra) is not saved into the file
+        d_loaded_dms = d_loaded_part_info[constants.DM.KIND_OF_PART] if (args.dminfo) else None
+        
+        if (d_loaded_dms is not None and args.dminfoextra) :
+            
+            d_loaded_dms = {_key: dataclasses.replace(_dm, extra = {}) for _key, _dm in d_loaded_dms.items()}
+        
         d_produced_dms = utils.save_all_part_info(
             parttype = constants.DM.KIND_OF_PART,
             outyamlfile = args.dminfo,
             inyamlfile = args.dminfo,
             location_id = l_location_ids,
             ret = True,
-            nodb = args.nodb
+            nodb = args.nodb,
+            d_inparts = d_loaded_dms,
         )
         
         l_used_sms = list(itertools.chain(*[[_dm.sm1, _dm.sm2] for _dm in d_produced_dms.values()]))
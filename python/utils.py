@@ -1,5 +1,7 @@
 import argparse
 import ast
+import atexit
+import concurrent.futures
 import copy
 import dataclasses
 import glob
@@ -15,7 +17,10 @@ import re
 import socket
 import subprocess
 import sys
+import threading
+import time
 import tqdm
+import urllib.parse
 
 from ruamel.yaml import YAML
 yaml = YAML()
@@ -23,20 +28,86 @@ yaml.preserve_quotes = True
 yaml.width = 1024
 yaml.boolean_representation = ["False", "True"]
 
+# The YAML instance cannot load/dump from several threads at the same time (see gather_all_part_info)
+yaml_lock = threading.Lock()
+
 HAS_ROOT = "ROOT" in sys.modules or importlib.util.find_spec("ROOT") is not None
+HAS_REQUESTS = "requests" in sys.modules or importlib.util.find_spec("requests") is not None
+HAS_PYYAML = "yaml" in sys.modules or importlib.util.find_spec("yaml") is not None
 
 
 if HAS_ROOT :
     import ROOT
     ROOT.gROOT.SetBatch(1)
 
+# Loader of the YAML files that are only read (see safe_load_yaml): the libyaml C safe loader of PyYAML if available,
+# with the YAML 1.2 rules of the round-trip instance (for e.g. "yes" and "on" are strings, 0123 is 123)
+if HAS_PYYAML :
+    
+    import ruamel.yaml.resolver
+    import yaml as pyyaml
+    
+    class FastSafeLoader(getattr(pyyaml, "CSafeLoader", pyyaml.SafeLoader)) :
+        
+        def construct_yaml_int(self, node) :
+            
+            value = self.construct_scalar(node).replace("_", "")
+            sign = -1 if value.startswith("-") else 1
+            value = value.lstrip("+-")
+            
+            for prefix, base in [("0b", 2), ("0o", 8), ("0x", 16)] :
+                
+                if value.startswith(prefix) :
+                    
+                    return sign*int(value[2:], base)
+            
+            return sign*int(value)
+    
+    FastSafeLoader.yaml_implicit_resolvers = {}
+    
+    for l_versions, tag, regexp, l_first in ruamel.yaml.resolver.implicit_resolvers :
+        
+        if ((1, 2) in l_versions and (tag in FastSafeLoader.yaml_constructors or tag.endswith(":merge"))) :
+            
+            FastSafeLoader.add_implicit_resolver(tag, regexp, l_first)
+    
+    FastSafeLoader.add_constructor("tag:yaml.org,2002:int", FastSafeLoader.construct_yaml_int)
+
+else :
+    
+    yaml_safe = YAML(typ = "safe")
+
+
+def safe_load_yaml(stream) :
+    """
+    Load YAML (string or file) that is only read, much faster than the round-trip yaml instance
+    The values are plain Python objects: comments, quotes and styles are not kept, so do not use it for files that are written back
+    """
+    
+    if HAS_PYYAML :
+        
+        return pyyaml.load(stream, Loader = FastSafeLoader)
+    
+    return yaml_safe.load(stream)
+
+
 #sys.path.append(f"{os.getcwd()}/scripts")
 sys.path.append(os.path.split(os.path.realpath(__file__))[0])
 
 import constants
 import cms_lumi
+import dbcache
+import dbprofile
+import dbschema
+import infostore
+import parttable
+import queryplan
+import singleflight
 import tdrstyle
 
+if HAS_REQUESTS :
+    import rhapi
+
 
 logging.basicConfig(format = "[%(levelname)s] [%(asctime)s] %(message)s", level = logging.INFO)
 logger = logging.getLogger(__name__)
@@ -67,8 +138,13 @@ class SiPMArray :
     id: str = None
     location_id: int = None
     tec_res: float = None
+    # None if only the statistics were fetched (BTL_SIPM_VBR_AGGREGATE), the per-channel Vbrs are then fetched by a later run (see needs_fetch)
     vbrs: list = None
     vbr_avg: float = None
+    vbr_count: int = None
+    vbr_min: float = None
+    vbr_max: float = None
+    vbr_std: float = None
     
     def dict(self) :
         
@@ -174,14 +250,26 @@ class Tray :
         return dataclasses.asdict(self)
 
 
+# Part class of each part type
+PART_CLASSES = {
+    constants.LYSO.KIND_OF_PART: Lyso,
+    constants.SIPM.KIND_OF_PART: SiPMArray,
+    constants.SM.KIND_OF_PART: SensorModule,
+    constants.DM.KIND_OF_PART: DetectorModule,
+    constants.RU.KIND_OF_PART: ReadoutUnit,
+    constants.COLDTRAY.KIND_OF_PART: ColdTray,
+    constants.TRAY.KIND_OF_PART: Tray,
+}
+
+
 class DictClass:
-     
+    
     def __init__(self, dict):
         self.__dict__.update(dict)
 
 
 def dict_to_obj(dict):
-     
+    
     return json.loads(json.dumps(dict), object_hook = DictClass)
 
 def run_cmd_list(l_cmd, debug = False) :
@@ -252,22 +340,263 @@ def get_file_list(
     return l_fnames, l_ret_regexps
 
 
-def is_tunnel_open(port = 8113) :
+# Local port of the database server: the tunnel (see scripts/start_db_tunnel.sh)
+# Set BTL_DB_PORT=<port> to use another server by default, for e.g. BTL_DB_PORT=8114 for the stand-in server (see rhapi_server.py)
+DB_PORT = int(os.environ.get("BTL_DB_PORT", "8113"))
+
+
+def is_tunnel_open(port = DB_PORT) :
     
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         
         return s.connect_ex(("localhost", port)) == 0
 
 
-def run_db_query(query, port = 8113) :
+# Shared RhApi instances (one per tunnel port)
+d_rhapi_instances = {}
+
+# Guards the creation of the shared RhApi instances and query cache (queries run in threads)
+shared_instances_lock = threading.Lock()
+
+# Set BTL_RHAPI_SUBPROCESS=1 to run the queries through the rhapi.py command line instead
+USE_RHAPI_SUBPROCESS = os.environ.get("BTL_RHAPI_SUBPROCESS", "0") not in ["", "0"]
+
+# Number of database queries run concurrently (RhApi also fetches the pages of each query concurrently)
+DB_QUERY_WORKERS = 4
+
+# Maximum number of values in an IN list of a query (Oracle allows up to 1000)
+DB_IN_LIST_SIZE = 500
+
+# Number of query rows converted at a time into a pandas.DataFrame (see get_sipm_vbr_stats)
+DB_ROWS_CHUNK_SIZE = 50000
+
+# Maximum size (in bytes) of the bind variables of a query in the URL
+# RhApi sends them in the query string of every count/data request, and servers/proxies reject long request lines (~8 KB)
+# Above it, the values are written into the (POSTed) query text instead (see inline_db_binds)
+DB_BIND_URL_SIZE = 2000
+
+# Columns of the parts table read by the helpers (see dbschema.TABLE_COLUMNS)
+PART_INFO_COLUMNS = ["ID", "BARCODE", "LOCATION_ID", "PRODUCTION_DATE"]
+DAUGHTER_INFO_COLUMNS = ["ID", "BARCODE", "KIND_OF_PART", "PART_PARENT_ID"]
+
+# Set BTL_INCREMENTAL_SYNC=1 to update the part info files incrementally by default (see sync_all_part_info)
+INCREMENTAL_SYNC = os.environ.get("BTL_INCREMENTAL_SYNC", "0") not in ["", "0"]
+
+# Set BTL_SYNC_CHECK_CHANGES=1 to also look for changed parts (location, daughters, positions) in the incremental updates by default
+# This reads the snapshot of all the selected parts; otherwise only the parts added since the last update are read
+SYNC_CHECK_CHANGES = os.environ.get("BTL_SYNC_CHECK_CHANGES", "0") not in ["", "0"]
+
+# Set BTL_SIPM_VBR_AGGREGATE=1 to aggregate the SiPM Vbrs on the server by default (one row per SiPM, no per-channel list)
+SIPM_VBR_AGGREGATE = os.environ.get("BTL_SIPM_VBR_AGGREGATE", "0") not in ["", "0"]
+
+# Set BTL_PART_COALESCE=0 to not share the part fetches between the requests for the same parts (see part_flight)
+PART_COALESCE = os.environ.get("BTL_PART_COALESCE", "1") not in ["", "0"]
+
+# Process-wide coalescing of the part barcode lists, part info and positions fetched from the database
+# Concurrent requests for the same parts share one query and one parse (not in the "refresh" cache mode); nothing is kept after the fetch
+part_flight = singleflight.SingleFlight()
+atexit.register(part_flight.print_stats)
+
+# Set BTL_RHAPI_QID_CACHE=<file> to keep the query IDs between runs
+RHAPI_QID_CACHE = os.environ.get("BTL_RHAPI_QID_CACHE", None)
+
+# Set BTL_INFO_STORE=0 to not use the binary stores of the part info files (see infostore)
+INFO_STORE = os.environ.get("BTL_INFO_STORE", "1") not in ["", "0"]
+
+# Set BTL_INFO_YAML=0 to only save the part info into the binary stores (the YAML files are then a human-readable export left as is)
+INFO_YAML = os.environ.get("BTL_INFO_YAML", "1") not in ["", "0"]
+
+# Set BTL_DBPROFILE=1 to profile the database queries (summary at the end of the run, trace in dbprofile.DEFAULT_TRACE_FILE)
+# or BTL_DBPROFILE=<file> to write the trace to another file; see also --dbprofile (add_db_profile_arguments)
+DB_PROFILE = os.environ.get("BTL_DBPROFILE", "0")
+
+if (DB_PROFILE not in ["", "0"]) :
     
-    assert is_tunnel_open(port = port), "Open tunnel to database first."
+    dbprofile.enable(tracefile = dbprofile.DEFAULT_TRACE_FILE if (DB_PROFILE == "1") else DB_PROFILE)
+
+# Set BTL_RHAPI_SCHEMA_CACHE=<file> to keep the table metadata between runs and check the queried columns against it (see load_db_schema)
+RHAPI_SCHEMA_CACHE = os.environ.get("BTL_RHAPI_SCHEMA_CACHE", None)
+
+# Local cache of the query results; see dbcache.MODES for the modes
+# Set with BTL_DBCACHE=<mode> and BTL_DBCACHE_FILE=<file>, or use set_db_cache_mode()
+db_cache = None
+
+
+def get_db_cache() :
+    """
+    Get the shared query result cache
+    """
+    
+    global db_cache
+    
+    with shared_instances_lock :
+        
+        if (db_cache is None) :
+            
+            db_cache = dbcache.QueryCache(
+                fname = os.environ.get("BTL_DBCACHE_FILE", dbcache.DEFAULT_CACHE_FILE),
+                mode = os.environ.get("BTL_DBCACHE", "on"),
+            )
+            atexit.register(db_cache.print_stats)
+    
+    return db_cache
+
+
+def is_db_refresh(refresh = False) :
+    """
+    Whether the cached results (query cache and part_flight) are bypassed: refresh requested, or the "refresh" cache mode
+    """
+    
+    return refresh or (get_db_cache().mode == "refresh")
+
+
+def set_db_cache_mode(mode) :
+    """
+    Set the query result cache mode (on, refresh, offline, off)
+    """
+    
+    assert (mode in dbcache.MODES), f"Invalid cache mode {mode}. Must be one of: {dbcache.MODES}"
+    
+    cache = get_db_cache()
+    
+    if (cache.mode == "off" and mode != "off") :
+        
+        global db_cache
+        cache.close()
+        db_cache = dbcache.QueryCache(fname = cache.fname, mode = mode)
+        atexit.register(db_cache.print_stats)
+    
+    else :
+        
+        cache.mode = mode
+
+
+def add_db_cache_arguments(parser) :
+    """
+    Add the --refresh and --offline database cache options to an argument parser
+    """
+    
+    group = parser.add_mutually_exclusive_group()
+    
+    group.add_argument(
+        "--refresh",
+        help = "Ignore the cached database query results and fetch them again \n",
+        action = "store_true",
+        default = False,
+    )
+    
+    group.add_argument(
+        "--offline",
+        help = "Only use the cached database query results (no database tunnel needed) \n",
+        action = "store_true",
+        default = False,
+    )
+
+
+def configure_db_cache(args) :
+    """
+    Set the database cache mode from the --refresh and --offline options
+    """
+    
+    if (args.refresh) :
+        
+        set_db_cache_mode("refresh")
+    
+    elif (args.offline) :
+        
+        set_db_cache_mode("offline")
+
+
+def add_db_profile_arguments(parser) :
+    """
+    Add the --dbprofile option to an argument parser
+    """
+    
+    parser.add_argument(
+        "--dbprofile",
+        help = f"Profile the database queries and write the trace to this file (default: {dbprofile.DEFAULT_TRACE_FILE}) \n",
+        type = str,
+        nargs = "?",
+        const = dbprofile.DEFAULT_TRACE_FILE,
+        default = None,
+    )
+
+
+def configure_db_profile(args) :
+    """
+    Enable the database query profile from the --dbprofile option
+    """
+    
+    if (args.dbprofile is not None) :
+        
+        dbprofile.enable(tracefile = args.dbprofile)
+
+
+def load_db_schema(api) :
+    """
+    Check the queried columns (dbschema.TABLE_COLUMNS) against the table metadata of the server
+    The metadata is read from the rhapi schema cache, only the tables missing from it are fetched (once)
+    """
+    
+    d_columns = api.cached_columns("mtd_cmsr")
+    
+    for table in dbschema.TABLE_COLUMNS.keys() :
+        
+        if (table in d_columns) :
+            
+            continue
+        
+        try :
+            
+            d_columns[table] = api.columns("mtd_cmsr", table)
+        
+        except Exception as e :
+            
+            logger.warning(f"Could not get the metadata of table mtd_cmsr.{table}: {e}")
+    
+    dbschema.set_server_columns(d_columns)
+
+
+def get_db_url(port = DB_PORT) :
+    """
+    URL of the RestHub server of the tunnel on the given port
+    """
+    
+    return f"http://localhost:{port}"
+
+
+def get_rhapi(port = DB_PORT) :
+    """
+    Get the shared in-process RhApi instance for the tunnel on the given port
+    """
+    
+    with shared_instances_lock :
+        
+        if (port not in d_rhapi_instances) :
+            
+            d_rhapi_instances[port] = rhapi.RhApi(get_db_url(port = port), cache_file = RHAPI_QID_CACHE, request_hook = dbprofile.on_request, schema_cache = RHAPI_SCHEMA_CACHE)
+            
+            if (RHAPI_SCHEMA_CACHE is not None) :
+                
+                load_db_schema(d_rhapi_instances[port])
+        
+        return d_rhapi_instances[port]
+
+
+def run_db_query_subprocess(query, port = DB_PORT, params = None) :
+    """
+    Run the query through a separate rhapi.py process (fallback when requests is not available)
+    """
+    
+    l_param_args = [f"-p{_key}={_val}" for _key, _val in (params or {}).items()]
     
     dbquery_output = subprocess.run([
-        "./python/rhapi.py",
-        "-u", "http://localhost:8113",
+        sys.executable,
+        f"{os.path.split(os.path.realpath(__file__))[0]}/rhapi.py",
+        "-u", get_db_url(port = port),
         "-a",
         "-f", "json2",
+        *l_param_args,
         query
     ], stdout = subprocess.PIPE, check = True)
     
@@ -277,19 +606,166 @@ def run_db_query(query, port = 8113) :
     return dbquery_output
 
 
-def get_barcode_query(l_barcode_ranges, l_barcodes = []) :
+def iter_db_query(query, port = DB_PORT, params = None, refresh = False) :
+    """
+    Run the query and iterate over the rows (as dictionaries), page by page
+    params are the values of the bind variables (":name") in the query
+    The results are read from/stored in the local query cache (see get_db_cache); if refresh, they are only stored
+    The query is recorded in the database profile if enabled (see dbprofile)
+    """
+    
+    rows = _iter_db_query(query, port = port, params = params, refresh = refresh)
+    
+    profiler = dbprofile.get_profiler()
+    
+    if (profiler is None) :
+        
+        return rows
+    
+    # The calling helper is taken here, not when the rows are first consumed (for e.g. by more_itertools.chunked)
+    return profiler.profile(query, params, rows, helper = dbprofile.get_caller())
+
+
+def get_db_bind_url_size(params) :
+    """
+    Size (in bytes) of the bind variables in the query string of a request
+    """
+    
+    return sum(len(urllib.parse.quote(str(_key))) + len(urllib.parse.quote(str(_val))) + 2 for _key, _val in (params or {}).items())
+
+
+def inline_db_binds(query, params) :
+    """
+    Write the values of the bind variables (":name") into the query as quoted literals
+    Quoted strings of the query are left as is
+    """
+    
+    def replace(match) :
+        
+        name = match.group(1)
+        
+        if (name not in params) :
+            
+            return match.group(0)
+        
+        value = str(params[name]).replace("'", "''")
+        
+        return f"'{value}'"
+    
+    l_tokens = re.split(r"('(?:[^']|'')*')", query)
+    l_tokens = [_tok if _tok.startswith("'") else re.sub(r":(\w+)", replace, _tok) for _tok in l_tokens]
+    
+    return "".join(l_tokens)
+
+
+def _iter_db_query(query, port = DB_PORT, params = None, refresh = False) :
+    
+    cache = get_db_cache()
+    
+    # The offline mode can only read the cache
+    cache_key = cache.lookup(query, params, server = get_db_url(port = port)) if (not refresh or cache.mode == "offline") else None
+    
+    if (cache_key is not None) :
+        
+        dbprofile.set_cache_status("hit")
+        yield from cache.iter_rows(cache_key)
+        return
+    
+    dbprofile.set_cache_status("miss" if (cache.mode != "off") else "off")
+    
+    assert is_tunnel_open(port = port), "Open tunnel to database first."
+    
+    # Too many bind values for the URL (for e.g. long IN lists): send them in the query text
+    query_db, params_db = query, params
+    
+    if (get_db_bind_url_size(params) > DB_BIND_URL_SIZE) :
+        
+        query_db, params_db = inline_db_binds(query, params), None
+    
+    if (not HAS_REQUESTS or USE_RHAPI_SUBPROCESS) :
+        
+        rows = run_db_query_subprocess(query_db, port = port, params = params_db)
+    
+    else :
+        
+        rows = get_rhapi(port = port).iter_rows(query_db, params = params_db, refresh = refresh)
+    
+    yield from cache.store(query, params, rows, server = get_db_url(port = port))
+
+
+def run_db_query(query, port = DB_PORT, params = None, refresh = False) :
+    """
+    Run the query and return the list of rows (as dictionaries)
+    See iter_db_query
+    """
+    
+    return list(iter_db_query(query, port = port, params = params, refresh = refresh))
+
+
+def run_db_queries(l_queries, port = DB_PORT, refresh = False) :
+    """
+    Run a list of (query, params) concurrently
+    Returns the list of results (lists of rows) in the same order as the queries
+    """
+    
+    if (len(l_queries) <= 1) :
+        
+        return [run_db_query(_query, port = port, params = _params, refresh = refresh) for _query, _params in l_queries]
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers = min(DB_QUERY_WORKERS, len(l_queries))) as executor :
+        
+        l_futures = [dbprofile.submit(executor, run_db_query, _query, port, _params, refresh) for _query, _params in l_queries]
+        
+        return [_future.result() for _future in l_futures]
+
+
+def get_bind_list(l_values, prefix, d_params) :
+    """
+    Add the values to d_params as bind variables prefix0, prefix1, ...
+    Returns the bind list string for an IN clause: (:prefix0, :prefix1, ...)
+    """
+    
+    l_names = []
+    
+    for idx, val in enumerate(l_values) :
+        
+        name = f"{prefix}{idx}"
+        d_params[name] = str(val)
+        l_names.append(f":{name}")
+    
+    return f"({', '.join(l_names)})"
+
+
+def get_barcode_query(l_barcode_ranges, l_barcodes = [], d_params = None, column = "s.BARCODE") :
+    """
+    Get the barcode selection for a list of (min, max) barcode ranges and/or a list of barcodes
+    If d_params is a dict, the barcodes are passed as bind variables (added to d_params)
+    instead of being written into the query, so that the query text can be reused
+    Long barcode lists are split into several IN lists (at most queryplan.MAX_IN_LIST_SIZE values each)
+    """
     
     query = None
     l_barcode_queries = []
     
-    for bc_min, bc_max in l_barcode_ranges :
+    for irange, (bc_min, bc_max) in enumerate(l_barcode_ranges) :
         
         l_tmp = []
         
         if (bc_min is not None) :
-            l_tmp.append(f"s.BARCODE >= '{bc_min}'")
+            
+            if (d_params is None) :
+                l_tmp.append(f"{column} >= '{bc_min}'")
+            else :
+                d_params[f"bcmin{irange}"] = str(bc_min)
+                l_tmp.append(f"{column} >= :bcmin{irange}")
+        
         if (bc_max is not None) :
-            l_tmp.append(f"s.BARCODE <= '{bc_max}'")
+            
+            if (d_params is None) :
+                l_tmp.append(f"{column} <= '{bc_max}'")
+            else :
+                d_params[f"bcmax{irange}"] = str(bc_max)
+                l_tmp.append(f"{column} <= :bcmax{irange}")
         
         if len(l_tmp) :
             
@@ -300,66 +776,61 @@ def get_barcode_query(l_barcode_ranges, l_barcodes = []) :
         
         query = f"({' OR '.join(l_barcode_queries)})"
     
-    if len(l_barcodes) :
+    for ichunk, l_barcodes_tmp in enumerate(more_itertools.chunked(l_barcodes, queryplan.MAX_IN_LIST_SIZE)) :
+        
+        if (d_params is None) :
+            query_tmp = f"({column} in {str(tuple(l_barcodes_tmp)).replace(',)', ')')})"
+        else :
+            query_tmp = f"({column} in {get_bind_list(l_barcodes_tmp, 'bc' if (ichunk == 0) else f'bc{ichunk}_', d_params)})"
         
-        query_tmp = f"(s.BARCODE in {str(tuple(l_barcodes)).replace(',)', ')')})"
         query = f"({query} OR {query_tmp})" if query else query_tmp
     
     return query
 
 
-def get_part_ids(barcode_min, barcode_max, l_barcode_ranges = []) :
+def get_part_ids(barcode_min, barcode_max, l_barcode_ranges = [], l_barcodes = [], l_columns = PART_INFO_COLUMNS, refresh = False) :
     """
-    Get part IDs for a range of barcodes
+    Get part IDs (and the other l_columns of the parts table) for a range of barcodes
     """
     
-    assert is_tunnel_open(port = 8113), "Open tunnel to database first."
-    
-    barcode_query = get_barcode_query(l_barcode_ranges = l_barcode_ranges + [(barcode_min, barcode_max)])
-    query = f"select s.* from mtd_cmsr.parts s where ({barcode_query})"
+    d_params = {}
+    barcode_query = get_barcode_query(l_barcode_ranges = l_barcode_ranges + [(barcode_min, barcode_max)], l_barcodes = l_barcodes, d_params = d_params)
+    query = f"select {dbschema.get_projection('parts', l_columns)} from mtd_cmsr.parts s where ({barcode_query})"
     print(query)
     
-    dbquery_output = subprocess.run([
-        "./python/rhapi.py",
-        "-u", "http://localhost:8113",
-        "-a",
-        "-f", "json2",
-        #f"select s.ID,s.BARCODE from mtd_cmsr.parts s where s.BARCODE >= '{barcode_min}' and s.BARCODE <='{barcode_max}'"
-        #f"select s.* from mtd_cmsr.parts s where s.BARCODE >= '{barcode_min}' AND s.BARCODE <='{barcode_max}'"
-        query
-    ], stdout = subprocess.PIPE, check = True)
-    
-    dbquery_output = dbquery_output.stdout.decode("utf-8")
-    l_infodicts = ast.literal_eval(dbquery_output)["data"]
+    l_infodicts = run_db_query(query, params = d_params, refresh = refresh)
     
     return l_infodicts
 
 
-def get_part_barcodes(
+def get_part_selection_query(
     parttype,
     location_id = None,
     barcode_min = None,
     barcode_max = None,
     l_barcode_ranges = [],
+    l_columns = ["BARCODE"],
+    min_id = None,
     ) :
     """
-    Get list of part barcodes
+    Get the query (and its bind variables) selecting l_columns of the parts of a type at the location(s) and in the barcode ranges
+    If min_id is provided, only the parts with a larger ID (i.e. added since) are selected
     """
     
-    assert is_tunnel_open(port = 8113), "Open tunnel to database first."
-    
-    query = f"select s.BARCODE from mtd_cmsr.parts s where s.KIND_OF_PART = '{parttype}'"
+    d_params = {"kind": parttype}
+    query = f"select {dbschema.get_projection('parts', l_columns)} from mtd_cmsr.parts s where s.KIND_OF_PART = :kind"
     #query = f"select s.* from mtd_cmsr.parts s where s.KIND_OF_PART = '{parttype}'"
     
     if (location_id is not None) :
         
         if (isinstance(location_id, list) or isinstance(location_id, tuple)) :
             
-            query = f"{query} AND s.LOCATION_ID in {str(tuple(location_id)).replace(',)', ')')}"
-            
+            query = f"{query} AND s.LOCATION_ID in {get_bind_list(location_id, 'loc', d_params)}"
+        
         elif (isinstance(location_id, int)) :
             
-            query = f"{query} AND s.LOCATION_ID = {location_id}"
+            d_params["loc"] = str(location_id)
+            query = f"{query} AND s.LOCATION_ID = :loc"
     
     #if (barcode_min is not None) :
     #    
@@ -369,89 +840,114 @@ def get_part_barcodes(
     #    
     #    query = f"{query} AND s.BARCODE <= '{barcode_max}'"
     
-    barcode_query = get_barcode_query(l_barcode_ranges = l_barcode_ranges + [(barcode_min, barcode_max)])
+    barcode_query = get_barcode_query(l_barcode_ranges = l_barcode_ranges + [(barcode_min, barcode_max)], d_params = d_params)
     query = f"{query} AND ({barcode_query})" if (barcode_query is not None) else query
     
+    if (min_id is not None) :
+        
+        d_params["minid"] = str(min_id)
+        query = f"{query} AND s.ID > :minid"
+    
+    return query, d_params
+
+
+def get_part_barcodes(
+    parttype,
+    location_id = None,
+    barcode_min = None,
+    barcode_max = None,
+    l_barcode_ranges = [],
+    refresh = False,
+    ) :
+    """
+    Get list of part barcodes
+    """
+    
+    query, d_params = get_part_selection_query(
+        parttype = parttype,
+        location_id = location_id,
+        barcode_min = barcode_min,
+        barcode_max = barcode_max,
+        l_barcode_ranges = l_barcode_ranges,
+    )
+    
     print(query)
-    dbquery_output = subprocess.run([
-        "./python/rhapi.py",
-        "-u", "http://localhost:8113",
-        "-a",
-        query
-    ], stdout = subprocess.PIPE, check = True)
     
-    l_part_barcode = dbquery_output.stdout.decode("utf-8").split()[1:]
-    l_part_barcode = [_barcode.strip() for _barcode in l_part_barcode]
+    def fetch() :
+        
+        return [str(_info["barcode"]).strip() for _info in iter_db_query(query, params = d_params, refresh = refresh)]
+    
+    if (not PART_COALESCE) :
+        
+        return fetch()
+    
+    l_part_barcode = part_flight.get(("barcodes", dbcache.normalize_query(query), tuple(sorted(d_params.items()))), fetch, refresh = is_db_refresh(refresh))
     
-    return l_part_barcode
+    return list(l_part_barcode)
 
 
 def get_daughter_info(
     parent_barcode_min,
     parent_barcode_max,
-    l_parent_barcode_ranges = []
+    l_parent_barcode_ranges = [],
+    l_parent_barcodes = [],
+    refresh = False,
     ) :
     """
     Get list of daughter information dictionaries for a range of parent barcodes
     """
     
-    assert is_tunnel_open(port = 8113), "Open tunnel to database first."
-    
     l_parent_infodicts = get_part_ids(
         barcode_min = parent_barcode_min,
         barcode_max = parent_barcode_max,
         l_barcode_ranges = l_parent_barcode_ranges,
+        l_barcodes = l_parent_barcodes,
+        refresh = refresh,
     )
     
-    l_parent_ids = [_info["id"] for _info in l_parent_infodicts]
-    l_parent_id_groups = list(more_itertools.chunked(l_parent_ids, 500))
-    l_daughter_infodicts = []
-    d_daughter_positions = {}
+    # Index the parents by id
+    d_parent_infodicts = {_info["id"]: _info for _info in l_parent_infodicts}
     
-    for l_parent_ids_tmp in l_parent_id_groups :
+    # Fetch the daughters of all parent id chunks concurrently
+    l_queries = []
+    
+    for l_parent_ids_tmp in more_itertools.chunked(list(d_parent_infodicts.keys()), DB_IN_LIST_SIZE) :
         
-        query = f"select s.* from mtd_cmsr.parts s where s.PART_PARENT_ID in {str(tuple(l_parent_ids_tmp)).replace(',)', ')')}" # Remove the trailing comma in a single element tuple: (X,)
+        d_params = {}
+        query = f"select {dbschema.get_projection('parts', DAUGHTER_INFO_COLUMNS)} from mtd_cmsr.parts s where s.PART_PARENT_ID in {get_bind_list(l_parent_ids_tmp, 'pid', d_params)}"
         print(query)
         
-        dbquery_output = subprocess.run([
-            "./python/rhapi.py",
-            "-u", "http://localhost:8113",
-            "-a",
-            "-f", "json2",
-            #f"select s.PART_PARENT_ID,s.BARCODE,s.KIND_OF_PART from mtd_cmsr.parts s where s.PART_PARENT_ID in {str(tuple(l_parent_ids)).replace(',)', ')')}" # Remove the trailing comma in a single element tuple: (X,)
-            query
-        ], stdout = subprocess.PIPE, check = True)
-        
-        # position in RU: apositionInRu
-        # ./python/rhapi.py -u http://localhost:8113 -a -f json2 "select c.* from mtd_cmsr.p10 c where c.BARCODE in ('32110040004706', '32110040004595')"
+        l_queries.append((query, d_params))
+    
+    # position in RU: apositionInRu
+    # ./python/rhapi.py -u http://localhost:8113 -a -f json2 "select c.* from mtd_cmsr.p10 c where c.BARCODE in ('32110040004706', '32110040004595')"
+    
+    l_daughter_infodicts = list(itertools.chain(*run_db_queries(l_queries, refresh = refresh)))
+    
+    # Fetch the positions per position table for all daughters at once
+    d_daughter_barcodes = {_parttype: [] for _parttype in [constants.SIPM.KIND_OF_PART, constants.SM.KIND_OF_PART, constants.DM.KIND_OF_PART, constants.RU.KIND_OF_PART]}
+    
+    for infodict in l_daughter_infodicts :
         
-        dbquery_output = dbquery_output.stdout.decode("utf-8")
+        if (infodict["kindOfPart"] in d_daughter_barcodes) :
+            
+            d_daughter_barcodes[infodict["kindOfPart"]].append(str(infodict["barcode"]))
+    
+    d_daughter_positions = {}
+    
+    for parttype, l_parts in d_daughter_barcodes.items() :
         
-        l_daughter_infodicts_tmp = ast.literal_eval(dbquery_output)["data"]
+        if not len(l_parts) :
+            continue
         
-        for parttype in [constants.SIPM.KIND_OF_PART, constants.SM.KIND_OF_PART, constants.DM.KIND_OF_PART, constants.RU.KIND_OF_PART] :
-            
-            l_parts = [str(_info["barcode"]) for _info in l_daughter_infodicts_tmp if (_info["kindOfPart"] == parttype)]
-            
-            if not len(l_parts) :
-                continue
-            
-            d_part_positions = get_part_position(
-                barcode_min = None,
-                barcode_max = None,
-                parttype = parttype,
-                l_barcode_ranges = [],
-                l_barcodes = l_parts,
-            )
-            
-            d_daughter_positions.update(d_part_positions)
+        d_part_positions = get_part_positions(parttype = parttype, l_barcodes = l_parts, refresh = refresh)
         
-        l_daughter_infodicts.extend(l_daughter_infodicts_tmp)
+        d_daughter_positions.update(d_part_positions)
     
     # Insert the parent barcode in each daughter part dictionary
     for infodict in l_daughter_infodicts :
         
-        parent_info = next((_pinfo for _pinfo in l_parent_infodicts if _pinfo["id"] == infodict["partParentId"]), None)
+        parent_info = d_parent_infodicts.get(infodict["partParentId"], None)
         assert (parent_info is not None), "Could not find parent"
         infodict["parentBarcode"] = parent_info["barcode"]
         infodict["positionInParent"] = d_daughter_positions.get(infodict["barcode"], None)
@@ -482,21 +978,18 @@ def get_used_sm_barcodes(location_id = None, yamlfile = None, d_dms = None) :
 
 def get_sipm_tec_res(
     barcode_min,
-    barcode_max
+    barcode_max,
+    l_barcode_ranges = [],
+    l_barcodes = [],
+    refresh = False,
 ) :
-    assert is_tunnel_open(port = 8113), "Open tunnel to database first."
-    
-    dbquery_output = subprocess.run([
-        "./python/rhapi.py",
-        "-u", "http://localhost:8113",
-        "-a",
-        "-f", "json2",
-        f"select s.part_barcode,s.rac from mtd_cmsr.c3060 s where s.part_barcode >= '{barcode_min}' and s.part_barcode <= '{barcode_max}'"
-    ], stdout = subprocess.PIPE, check = True)
-    
-    dbquery_output = dbquery_output.stdout.decode("utf-8")
-    
-    l_tecdicts = ast.literal_eval(dbquery_output)["data"]
+    d_params = {}
+    barcode_query = get_barcode_query(l_barcode_ranges = l_barcode_ranges + [(barcode_min, barcode_max)], l_barcodes = l_barcodes, d_params = d_params, column = "s.part_barcode")
+    l_tecdicts = iter_db_query(
+        f"select {dbschema.get_projection('c3060', ['PART_BARCODE', 'RAC'])} from mtd_cmsr.c3060 s where ({barcode_query})",
+        params = d_params,
+        refresh = refresh,
+    )
     
     d_tec_res = {}
     
@@ -518,45 +1011,116 @@ def get_sipm_tec_res(
     return d_tec_res
 
 
-def get_sipm_vbrs(
+def get_sipm_vbr_stats(
     barcode_min,
-    barcode_max
+    barcode_max,
+    l_barcode_ranges = [],
+    l_barcodes = [],
+    keep_vbrs = True,
+    aggregate = False,
+    refresh = False,
 ) :
-    assert is_tunnel_open(port = 8113), "Open tunnel to database first."
-    
-    dbquery_output = subprocess.run([
-        "./python/rhapi.py",
-        "-u", "http://localhost:8113",
-        "-a",
-        "-f", "json2",
-        f"select s.part_barcode,s.VBRRT from mtd_cmsr.c3000 s where s.part_barcode >= '{barcode_min}' and s.part_barcode <= '{barcode_max}'"
-    ], stdout = subprocess.PIPE, check = True)
-    
-    dbquery_output = dbquery_output.stdout.decode("utf-8")
-    
-    l_vbrdicts = ast.literal_eval(dbquery_output)["data"]
+    """
+    Get the Vbr statistics of the SiPMs, aggregated per barcode in one vectorized group-by
+    Returns a pandas.DataFrame indexed by barcode with the columns vbr_avg, vbr_count, vbr_min, vbr_max, vbr_std
+    and vbrs (list of the per-channel Vbrs) if keep_vbrs
+    If aggregate, the statistics are computed by the database (one row per SiPM is transferred) and keep_vbrs is ignored
+    """
     
-    d_vbrs = {}
+    d_params = {}
+    barcode_query = get_barcode_query(l_barcode_ranges = l_barcode_ranges + [(barcode_min, barcode_max)], l_barcodes = l_barcodes, d_params = d_params, column = "s.part_barcode")
     
-    for vbrdict in l_vbrdicts :
+    if aggregate :
+        
+        # The Vbrs that are not numbers are left out of the statistics (and counted in VBR_INVALID)
+        barcode_column = dbschema.get_projection("c3000", ["PART_BARCODE"])
+        vbr_column = dbschema.get_projection("c3000", ["VBRRT"])
+        vbr_numeric = dbschema.get_numeric("c3000", "VBRRT")
         
-        barcode = vbrdict["partBarcode"]
+        l_statdicts = iter_db_query(
+            f"select {barcode_column},AVG({vbr_numeric}) as VBR_AVG,COUNT({vbr_numeric}) as VBR_COUNT,MIN({vbr_numeric}) as VBR_MIN,MAX({vbr_numeric}) as VBR_MAX,STDDEV({vbr_numeric}) as VBR_STD,"
+            f"COUNT({vbr_column}) - COUNT({vbr_numeric}) as VBR_INVALID "
+            f"from mtd_cmsr.c3000 s where ({barcode_query}) group by {barcode_column}",
+            params = d_params,
+            refresh = refresh,
+        )
         
-        if (barcode not in d_vbrs) :
-            d_vbrs[barcode] = []
+        d_columns = {
+            "vbrAvg": "vbr_avg",
+            "vbrCount": "vbr_count",
+            "vbrMin": "vbr_min",
+            "vbrMax": "vbr_max",
+            "vbrStd": "vbr_std",
+            "vbrInvalid": "vbr_invalid",
+        }
         
-        try :
+        df_vbr_stats = pandas.DataFrame(list(l_statdicts), columns = ["partBarcode"] + list(d_columns.keys())).rename(columns = d_columns)
+        df_vbr_stats = df_vbr_stats.set_index("partBarcode").apply(pandas.to_numeric, errors = "coerce")
+        
+        for barcode, ninvalid in df_vbr_stats["vbr_invalid"][df_vbr_stats["vbr_invalid"] > 0].items() :
             
-            d_vbrs[barcode].append(float(vbrdict["vbrrt"]))
+            logger.error(f"Error getting VBR of: {barcode} ({int(ninvalid)} value(s) not a number)")
         
-        except Exception as err:
+        return df_vbr_stats.drop(columns = ["vbr_invalid"])
+    
+    l_vbrdicts = iter_db_query(
+        f"select {dbschema.get_projection('c3000', ['PART_BARCODE', 'VBRRT'])} from mtd_cmsr.c3000 s where ({barcode_query})",
+        params = d_params,
+        refresh = refresh,
+    )
+    
+    # The rows are converted chunk by chunk into slim (barcode, vbr) frames, so that the row dictionaries are never all held at once
+    l_df_vbrs = []
+    
+    for l_vbrdicts_chunk in more_itertools.chunked(l_vbrdicts, DB_ROWS_CHUNK_SIZE) :
+        
+        df_chunk = pandas.DataFrame.from_records(l_vbrdicts_chunk, columns = ["partBarcode", "vbrrt"])
+        df_chunk["vbr"] = pandas.to_numeric(df_chunk["vbrrt"], errors = "coerce")
+        
+        for vbrdict in df_chunk[df_chunk["vbr"].isna()][["partBarcode", "vbrrt"]].to_dict("records") :
             
             logger.error(f"Error getting VBR of: {vbrdict}")
-            print(err)
-            #d_vbrs[barcode] = None
-            continue
+        
+        l_df_vbrs.append(df_chunk.dropna(subset = ["vbr"])[["partBarcode", "vbr"]])
+    
+    df_vbrs = pandas.concat(l_df_vbrs, ignore_index = True) if l_df_vbrs else pandas.DataFrame({"partBarcode": pandas.Series(dtype = object), "vbr": pandas.Series(dtype = float)})
     
-    return d_vbrs
+    d_aggs = {
+        "vbr_avg": "mean",
+        "vbr_count": "count",
+        "vbr_min": "min",
+        "vbr_max": "max",
+        "vbr_std": "std",
+    }
+    
+    if keep_vbrs :
+        
+        d_aggs["vbrs"] = lambda _vbrs: _vbrs.tolist()
+    
+    df_vbr_stats = df_vbrs.groupby("partBarcode", sort = False)["vbr"].agg(**d_aggs)
+    
+    return df_vbr_stats
+
+
+def get_sipm_vbrs(
+    barcode_min,
+    barcode_max,
+    l_barcode_ranges = [],
+    l_barcodes = [],
+) :
+    """
+    Get the per-channel Vbrs of the SiPMs: {barcode: [vbr, ...]}
+    """
+    
+    df_vbr_stats = get_sipm_vbr_stats(
+        barcode_min = barcode_min,
+        barcode_max = barcode_max,
+        l_barcode_ranges = l_barcode_ranges,
+        l_barcodes = l_barcodes,
+        keep_vbrs = True,
+    )
+    
+    return df_vbr_stats["vbrs"].to_dict()
 
 
 def check_parttype(parttype) :
@@ -588,74 +1152,231 @@ def get_part_position(
     parttype,
     l_barcode_ranges = [],
     l_barcodes = [],
+    refresh = False,
 ) :
     
     d_part_db_info = {}
     
     d_part_db_info[constants.SIPM.KIND_OF_PART] = {
         "db": "p3",
-        "position_key": "apositionInSensormodule",
+        "position_column": "APOSITION_IN_SENSORMODULE",
     }
     
     d_part_db_info[constants.SM.KIND_OF_PART] = {
         "db": "p11",
-        "position_key": "apositionInDetectormodule",
+        "position_column": "APOSITION_IN_DETECTORMODULE",
     }
     
     d_part_db_info[constants.DM.KIND_OF_PART] = {
         "db": "p10",
-        "position_key": "apositionInRu",
+        "position_column": "APOSITION_IN_RU",
     }
     
     d_part_db_info[constants.RU.KIND_OF_PART] = {
         "db": "p100",
-        "position_key": "apositionInTray",
+        "position_column": "APOSITION_IN_TRAY",
     }
     
     d_part_db = d_part_db_info[parttype]
     
-    barcode_query = get_barcode_query(l_barcode_ranges = l_barcode_ranges + [(barcode_min, barcode_max)], l_barcodes = l_barcodes)
-    query = f"select s.* from mtd_cmsr.{d_part_db['db']} s where ({barcode_query})"
-    print(query)
+    # Split long barcode lists into several queries (run concurrently)
+    l_queries = []
+    l_barcode_chunks = list(more_itertools.chunked(l_barcodes, DB_IN_LIST_SIZE)) or [[]]
     
-    dbquery_output = subprocess.run([
-        "./python/rhapi.py",
-        "-u", "http://localhost:8113",
-        "-a",
-        "-f", "json2",
-        query
-    ], stdout = subprocess.PIPE, check = True)
+    for ichunk, l_barcodes_tmp in enumerate(l_barcode_chunks) :
+        
+        d_params = {}
+        l_barcode_ranges_tmp = (l_barcode_ranges + [(barcode_min, barcode_max)]) if (ichunk == 0) else []
+        barcode_query = get_barcode_query(l_barcode_ranges = l_barcode_ranges_tmp, l_barcodes = l_barcodes_tmp, d_params = d_params)
+        query = f"select {dbschema.get_projection(d_part_db['db'], ['BARCODE', d_part_db['position_column']])} from mtd_cmsr.{d_part_db['db']} s where ({barcode_query})"
+        print(query)
+        
+        l_queries.append((query, d_params))
     
-    dbquery_output = dbquery_output.stdout.decode("utf-8")
-    l_infodicts = ast.literal_eval(dbquery_output)["data"]
+    l_infodicts = itertools.chain(*run_db_queries(l_queries, refresh = refresh))
     
     d_part_positions = {}
     
     for infodict in l_infodicts :
         
         barcode = str(infodict["barcode"])
-        position = infodict.get(d_part_db["position_key"], None)
+        position = infodict.get(dbschema.to_key(d_part_db["position_column"]), None)
         d_part_positions[barcode] = int(position) if (position is not None and position.isdigit()) else position
     
     return d_part_positions
 
 
+def get_part_positions(parttype, l_barcodes, refresh = False) :
+    """
+    Get the positions of a list of parts in their parents
+    Positions being fetched for the same parts are shared (see part_flight)
+    """
+    
+    def fetch(l_barcodes_fetch) :
+        
+        return get_part_position(
+            barcode_min = None,
+            barcode_max = None,
+            parttype = parttype,
+            l_barcode_ranges = [],
+            l_barcodes = l_barcodes_fetch,
+            refresh = refresh,
+        )
+    
+    if (not PART_COALESCE) :
+        
+        return fetch(l_barcodes)
+    
+    return part_flight.get_many(("position", parttype), l_barcodes, fetch, refresh = is_db_refresh(refresh))
+
+
+# Daughters of the part types assembled from their daughters (see assemble_part)
+#   label: name in the error messages
+#   count: expected number of daughters, the part is not assembled otherwise (None: not checked)
+#   attr: attribute of a single daughter (barcode string), or if several, of the {position: barcode} dictionary
+#   attrs, positions: attributes of a pair of daughters, sorted by their position names
+PART_ASSEMBLY = {
+    constants.SM.KIND_OF_PART: {
+        "class": SensorModule,
+        "daughters": [
+            {"kind": constants.LYSO.KIND_OF_PART, "label": "LYSO", "count": 1, "attr": "lyso"},
+            {"kind": constants.SIPM.KIND_OF_PART, "label": "SiPM", "count": 2, "attrs": ["sipm1", "sipm2"], "positions": ["Left", "Right"]},
+        ],
+    },
+    constants.DM.KIND_OF_PART: {
+        "class": DetectorModule,
+        "daughters": [
+            {"kind": constants.FE.KIND_OF_PART, "label": "FEB", "count": 1, "attr": "feb"},
+            {"kind": constants.SM.KIND_OF_PART, "label": "SM", "count": 2, "attrs": ["sm1", "sm2"], "positions": ["Top", "Bottom"]},
+        ],
+    },
+    constants.RU.KIND_OF_PART: {
+        "class": ReadoutUnit,
+        "daughters": [
+            {"kind": constants.CC.KIND_OF_PART, "label": "CC", "count": None, "attr": "cc"},
+            {"kind": constants.PCC1P2.KIND_OF_PART, "label": "PCC1P2", "count": None, "attr": "pcc1p2"},
+            {"kind": constants.PCC2P5.KIND_OF_PART, "label": "PCC2P5", "count": None, "attr": "pcc2p5"},
+            {"kind": constants.DM.KIND_OF_PART, "label": "DM", "count": 12, "attr": "dms", "several": True},
+        ],
+    },
+    constants.TRAY.KIND_OF_PART: {
+        "class": Tray,
+        "daughters": [
+            {"kind": constants.RU.KIND_OF_PART, "label": "RU", "count": 6, "attr": "rus", "several": True},
+            {"kind": constants.COLDTRAY.KIND_OF_PART, "label": "Cold tray", "count": 1, "attr": "coldtray"},
+        ],
+    },
+}
+
+
+def index_daughters(l_daughter_infodicts) :
+    """
+    Group the daughters by parent id and kind of part: {parent id: {kind of part: [infodict, ...]}}
+    """
+    
+    d_index = {}
+    
+    for infodict in l_daughter_infodicts :
+        
+        d_index.setdefault(infodict["partParentId"], {}).setdefault(infodict["kindOfPart"], []).append(infodict)
+    
+    return d_index
+
+
+def sort_daughter_pair(l_daughters, l_position_names) :
+    """
+    Sort a pair of daughters by their position names
+    If only one position is known, the other daughter takes the other position; if none is known, sort by barcode
+    """
+    
+    l_positions = [_info["positionInParent"] for _info in l_daughters]
+    l_known = [_pos in l_position_names for _pos in l_positions]
+    
+    if not any(l_known) :
+        
+        return sorted(l_daughters, key = lambda _x: str(_x["barcode"]))
+    
+    if not all(l_known) :
+        
+        known = l_positions[l_known.index(True)]
+        l_positions = [_pos if _known else l_position_names[1 - l_position_names.index(known)] for _pos, _known in zip(l_positions, l_known)]
+    
+    return [_info for _pos, _info in sorted(zip(l_positions, l_daughters), key = lambda _x: l_position_names.index(_x[0]))]
+
+
+def assemble_part(parttype, pinfodict, d_daughters) :
+    """
+    Build a part from its database info and its daughters ({kind of part: [infodict, ...]}, see index_daughters)
+    Returns None if a daughter count is not the expected one
+    """
+    
+    d_assembly = PART_ASSEMBLY[parttype]
+    barcode = pinfodict["barcode"]
+    
+    l_bad = [_d for _d in d_assembly["daughters"] if (_d["count"] is not None and len(d_daughters.get(_d["kind"], [])) != _d["count"])]
+    
+    if len(l_bad) :
+        
+        print(f"Error fetching parts for {parttype} {barcode} :")
+        
+        for d_daughter in d_assembly["daughters"] :
+            
+            if (d_daughter["count"] is not None) :
+                
+                print(f"  {d_daughter['label']}: {d_daughters.get(d_daughter['kind'], [])}")
+        
+        return None
+    
+    d_kwargs = {}
+    
+    for d_daughter in d_assembly["daughters"] :
+        
+        l_infos = d_daughters.get(d_daughter["kind"], [])
+        
+        if ("attrs" in d_daughter) :
+            
+            l_infos = sort_daughter_pair(l_infos, d_daughter["positions"])
+            d_kwargs.update({_attr: _info["barcode"] for _attr, _info in zip(d_daughter["attrs"], l_infos)})
+        
+        elif d_daughter.get("several", False) :
+            
+            d_kwargs[d_daughter["attr"]] = {_x["positionInParent"]: _x["barcode"] for _x in sorted(l_infos, key = lambda _x: _x["positionInParent"])}
+        
+        else :
+            
+            d_kwargs[d_daughter["attr"]] = str(l_infos[0]["barcode"] if len(l_infos) else None)
+    
+    return d_assembly["class"](
+        id = str(pinfodict["id"]),
+        barcode = str(barcode),
+        prod_datime = pinfodict["productionDate"],
+        location_id = pinfodict["locationId"],
+        **d_kwargs,
+    )
+
+
 def get_part_info(
     barcode_min,
     barcode_max,
     parttype,
-    l_barcode_ranges = []
+    l_barcode_ranges = [],
+    l_barcodes = [],
+    aggregate_vbrs = None,
+    refresh = False,
 ) :
     """
     Get part information
+    For SiPMs, if aggregate_vbrs (default: BTL_SIPM_VBR_AGGREGATE), only the Vbr statistics are fetched (see get_sipm_vbr_stats)
+    If refresh, the cached query results are not used
     """
     
     check_parttype(parttype)
+    aggregate_vbrs = SIPM_VBR_AGGREGATE if (aggregate_vbrs is None) else aggregate_vbrs
     d_parts = {}
     
     if (parttype == constants.LYSO.KIND_OF_PART) :
         
-        l_infodicts = get_part_ids(barcode_min = barcode_min, barcode_max = barcode_max, l_barcode_ranges = l_barcode_ranges)
+        l_infodicts = get_part_ids(barcode_min = barcode_min, barcode_max = barcode_max, l_barcode_ranges = l_barcode_ranges, l_barcodes = l_barcodes, refresh = refresh)
         
         print(f"Fetched information for {len(l_infodicts)} {parttype}(s) from the database. Processing ...")
         for infodict in tqdm.tqdm(l_infodicts) :
@@ -674,246 +1395,167 @@ def get_part_info(
     
     elif (parttype == constants.SIPM.KIND_OF_PART) :
         
-        l_infodicts = get_part_ids(barcode_min = barcode_min, barcode_max = barcode_max)
-        d_tec_res = get_sipm_tec_res(barcode_min = barcode_min, barcode_max = barcode_max)
-        d_vbrs = get_sipm_vbrs(barcode_min = barcode_min, barcode_max = barcode_max)
+        # The ids, TEC resistances and Vbrs are fetched concurrently
+        d_kwargs = {
+            "barcode_min": barcode_min,
+            "barcode_max": barcode_max,
+            "l_barcode_ranges": l_barcode_ranges,
+            "l_barcodes": l_barcodes,
+            "refresh": refresh,
+        }
         
-        print(f"Fetched information for {len(l_infodicts)} {parttype}(s) from the database. Processing ...")
-        for infodict in tqdm.tqdm(l_infodicts) :
-            
-            id = infodict["id"]
-            barcode = infodict["barcode"]
-            tec_res = d_tec_res.get(barcode, 0)
-            vbrs = d_vbrs.get(barcode, [])
-            location_id = infodict["locationId"]
+        with concurrent.futures.ThreadPoolExecutor(max_workers = 3) as executor :
             
-            part = SiPMArray(
-                id = str(id),
-                barcode = str(barcode),
-                location_id = location_id,
-                tec_res = tec_res,
-                vbrs = vbrs,
-                vbr_avg = float(numpy.mean(vbrs))
-            )
+            future_infodicts = executor.submit(get_part_ids, **d_kwargs)
+            future_tec_res = executor.submit(get_sipm_tec_res, **d_kwargs)
+            future_vbr_stats = executor.submit(get_sipm_vbr_stats, **d_kwargs, aggregate = aggregate_vbrs)
             
-            d_parts[barcode] = part
-    
-    elif (parttype == constants.SM.KIND_OF_PART) :
+            l_infodicts = future_infodicts.result()
+            d_tec_res = future_tec_res.result()
+            df_vbr_stats = future_vbr_stats.result()
         
-        l_parent_infodicts, l_daughter_infodicts = get_daughter_info(
-            parent_barcode_min = barcode_min,
-            parent_barcode_max = barcode_max,
-            l_parent_barcode_ranges = l_barcode_ranges
-        )
+        print(f"Fetched information for {len(l_infodicts)} {parttype}(s) from the database. Processing ...")
         
-        print(f"Fetched information for {len(l_parent_infodicts)} {parttype}(s) from the database. Processing ...")
-        for pinfodict in tqdm.tqdm(l_parent_infodicts) :
-            
-            id = pinfodict["id"]
-            barcode = pinfodict["barcode"]
-            prod_datime = pinfodict["productionDate"]
-            location_id = pinfodict["locationId"]
-            
-            lyso = next((_info["barcode"] for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.LYSO.KIND_OF_PART and _info["partParentId"] == id)), None)
-            l_sipms = [_info for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.SIPM.KIND_OF_PART and _info["partParentId"] == id)]
-            part = None
-            
-            if (lyso is None or len(l_sipms) != 2) :
-                
-                print(f"Error fetching parts for {parttype} {barcode} :")
-                print(f"  LYSO: {lyso}")
-                print(f"  SiPM: {l_sipms}")
-            
-            else :
-                
-                l_position_names = ["Left", "Right"]
-                l_sipm_barcodes = sorted([str(_sipm["barcode"]) for _sipm in l_sipms])
-                
-                # Sort by barcode if both positions are missing
-                if l_sipms[0]["positionInParent"] not in l_position_names and l_sipms[1]["positionInParent"] not in l_position_names :
-                    
-                    l_sipms[0]["positionInParent"] = l_sipms[0]["barcode"]
-                    l_sipms[1]["positionInParent"] = l_sipms[1]["barcode"]
-                
-                elif l_sipms[0]["positionInParent"] in l_position_names and l_sipms[1]["positionInParent"] not in l_position_names :
-                    
-                    l_sipms[1]["positionInParent"] = "Left" if l_sipms[0]["positionInParent"] == "Right" else "Right"
-                
-                elif l_sipms[0]["positionInParent"] not in l_position_names and l_sipms[1]["positionInParent"] in l_position_names :
-                    
-                    l_sipms[0]["positionInParent"] = "Left" if l_sipms[1]["positionInParent"] == "Right" else "Right"
-                
-                l_sipms = sorted(l_sipms, key = lambda _x: l_position_names.index(_x["positionInParent"]))
-                
-                part = SensorModule(
-                    id = str(id),
-                    barcode = str(barcode),
-                    lyso = str(lyso),
-                    sipm1 = l_sipms[0]["barcode"],
-                    sipm2 = l_sipms[1]["barcode"],
-                    prod_datime = prod_datime,
-                    location_id = location_id
-                )
-            
-            d_parts[barcode] = part
-    
-    
-    elif (parttype == constants.DM.KIND_OF_PART) :
+        # Join the TEC resistances and the Vbr statistics by barcode
+        df_sipms = pandas.DataFrame(l_infodicts, columns = ["id", "barcode", "locationId"], dtype = object)
+        df_tec_res = pandas.DataFrame({"tec_res": pandas.Series(d_tec_res, dtype = object)})
+        df_sipms = df_sipms.join(df_tec_res, on = "barcode").join(df_vbr_stats, on = "barcode")
         
-        l_parent_infodicts, l_daughter_infodicts = get_daughter_info(
-            parent_barcode_min = barcode_min,
-            parent_barcode_max = barcode_max,
-            l_parent_barcode_ranges = l_barcode_ranges
-        )
+        # SiPMs without a TEC resistance get 0, and without Vbrs get no statistics
+        df_sipms["tec_res"] = df_sipms["tec_res"].where(df_sipms["barcode"].isin(df_tec_res.index), 0)
+        df_sipms["vbr_count"] = df_sipms["vbr_count"].fillna(0)
         
-        print(f"Fetched information for {len(l_parent_infodicts)} {parttype}(s) from the database. Processing ...")
-        for pinfodict in tqdm.tqdm(l_parent_infodicts) :
-            
-            id = pinfodict["id"]
-            barcode = pinfodict["barcode"]
-            prod_datime = pinfodict["productionDate"]
-            location_id = pinfodict["locationId"]
-            
-            feb = next((_info["barcode"] for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.FE.KIND_OF_PART and _info["partParentId"] == id)), None)
-            l_sms = [_info for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.SM.KIND_OF_PART and _info["partParentId"] == id)]
-            part = None
+        for row in tqdm.tqdm(df_sipms.itertuples(index = False), total = len(df_sipms)) :
             
-            if (feb is None or len(l_sms) != 2) :
-                
-                print(f"Error fetching parts for {parttype} {barcode} :")
-                print(f"  FEB: {feb}")
-                print(f"  SM: {l_sms}")
-            
-            else :
-                
-                l_position_names = ["Top", "Bottom"]
-                
-                # Sort by barcode if both positions are missing
-                if l_sms[0]["positionInParent"] not in l_position_names and l_sms[1]["positionInParent"] not in l_position_names :
-                    
-                    l_sms[0]["positionInParent"] = l_sms[0]["barcode"]
-                    l_sms[1]["positionInParent"] = l_sms[1]["barcode"]
-                
-                elif l_sms[0]["positionInParent"] in l_position_names and l_sms[1]["positionInParent"] not in l_position_names :
-                    
-                    l_sms[1]["positionInParent"] = "Top" if l_sms[0]["positionInParent"] == "Bottom" else "Bottom"
-                
-                elif l_sms[0]["positionInParent"] not in l_position_names and l_sms[1]["positionInParent"] in l_position_names :
-                    
-                    l_sms[0]["positionInParent"] = "Top" if l_sms[1]["positionInParent"] == "Bottom" else "Bottom"
-                
-                l_sms = sorted(l_sms, key = lambda _x: l_position_names.index(_x["positionInParent"]))
-                
-                part = DetectorModule(
-                    id = str(id),
-                    barcode = str(barcode),
-                    feb = str(feb),
-                    sm1 = l_sms[0]["barcode"],
-                    sm2 = l_sms[1]["barcode"],
-                    prod_datime = prod_datime,
-                    location_id = location_id
-                )
+            part = SiPMArray(
+                id = str(row.id),
+                barcode = str(row.barcode),
+                location_id = row.locationId,
+                tec_res = row.tec_res,
+                vbrs = None if aggregate_vbrs else (row.vbrs if isinstance(row.vbrs, list) else []),
+                vbr_avg = float(row.vbr_avg),
+                vbr_count = int(row.vbr_count),
+                vbr_min = float(row.vbr_min) if row.vbr_count else None,
+                vbr_max = float(row.vbr_max) if row.vbr_count else None,
+                vbr_std = float(row.vbr_std) if (row.vbr_count and not pandas.isna(row.vbr_std)) else None,
+            )
             
-            d_parts[barcode] = part
+            d_parts[row.barcode] = part
     
-    elif (parttype == constants.RU.KIND_OF_PART) :
+    elif (parttype in PART_ASSEMBLY) :
         
         l_parent_infodicts, l_daughter_infodicts = get_daughter_info(
             parent_barcode_min = barcode_min,
             parent_barcode_max = barcode_max,
-            l_parent_barcode_ranges = l_barcode_ranges
+            l_parent_barcode_ranges = l_barcode_ranges,
+            l_parent_barcodes = l_barcodes,
+            refresh = refresh,
         )
         
+        # Group the daughters once instead of scanning them for every parent
+        d_daughter_index = index_daughters(l_daughter_infodicts)
+        
         print(f"Fetched information for {len(l_parent_infodicts)} {parttype}(s) from the database. Processing ...")
         for pinfodict in tqdm.tqdm(l_parent_infodicts) :
             
-            id = pinfodict["id"]
-            barcode = pinfodict["barcode"]
-            prod_datime = pinfodict["productionDate"]
-            location_id = pinfodict["locationId"]
-            
-            cc = next((_info["barcode"] for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.CC.KIND_OF_PART and _info["partParentId"] == id)), None)
-            pcc1p2 = next((_info["barcode"] for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.PCC1P2.KIND_OF_PART and _info["partParentId"] == id)), None)
-            pcc2p5 = next((_info["barcode"] for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.PCC2P5.KIND_OF_PART and _info["partParentId"] == id)), None)
-            l_dms = [_info for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.DM.KIND_OF_PART and _info["partParentId"] == id)]
-            
-            #print(l_daughter_infodicts)
-            part = None
-            
-            if (len(l_dms) != 12) :
-                
-                print(f"Error fetching parts for {parttype} {barcode} :")
-                print(f"  DM: {l_dms}")
-            
-            else :
-                
-                l_dms = sorted(l_dms, key = lambda _x: _x["positionInParent"])
-                d_part_positions = {_x["positionInParent"]: _x["barcode"] for _x in l_dms}
-                
-                part = ReadoutUnit(
-                    id = str(id),
-                    barcode = str(barcode),
-                    cc = str(cc),
-                    pcc1p2 = str(pcc1p2),
-                    pcc2p5 = str(pcc2p5),
-                    dms = d_part_positions,
-                    prod_datime = prod_datime,
-                    location_id = location_id
-                )
-            
-            d_parts[barcode] = part
+            d_parts[pinfodict["barcode"]] = assemble_part(parttype, pinfodict, d_daughter_index.get(pinfodict["id"], {}))
     
-    
-    elif (parttype == constants.TRAY.KIND_OF_PART) :
+    else :
         
-        l_parent_infodicts, l_daughter_infodicts = get_daughter_info(
-            parent_barcode_min = barcode_min,
-            parent_barcode_max = barcode_max,
-            l_parent_barcode_ranges = l_barcode_ranges
-        )
+        logger.error(f"Part type {parttype} not recognized.")
+        sys.exit(1)
+    
+    return d_parts
+
+
+def fetch_part_info(parttype, l_barcodes, location_id = None, refresh = False) :
+    """
+    Fetch the information of a list of parts from the database
+    Parts being fetched by other requests are shared (see part_flight) and returned as copies
+    If refresh, the fetches in flight and the cached query results are not used
+    """
+    
+    if (not PART_COALESCE) :
         
-        print(f"Fetched information for {len(l_parent_infodicts)} {parttype}(s) from the database. Processing ...")
-        for pinfodict in tqdm.tqdm(l_parent_infodicts) :
-            
-            id = pinfodict["id"]
-            barcode = pinfodict["barcode"]
-            prod_datime = pinfodict["productionDate"]
-            location_id = pinfodict["locationId"]
-            
-            l_rus = [_info for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.RU.KIND_OF_PART and _info["partParentId"] == id)]
-            ctray = [_info["barcode"] for _info in l_daughter_infodicts if (_info["kindOfPart"] == constants.COLDTRAY.KIND_OF_PART and _info["partParentId"] == id)][0]
-            part = None
-            
-            if (len(l_rus) != 6) :
-                
-                print(f"Error fetching parts for {parttype} {barcode} :")
-                print(f"  RU: {l_rus}")
-            
-            else :
-                
-                l_rus = sorted(l_rus, key = lambda _x: _x["positionInParent"])
-                d_part_positions = {_x["positionInParent"]: _x["barcode"] for _x in l_rus}
-                
-                part = Tray(
-                    id = str(id),
-                    barcode = str(barcode),
-                    rus = d_part_positions,
-                    coldtray = str(ctray),
-                    prod_datime = prod_datime,
-                    location_id = location_id
-                )
-            
-            d_parts[barcode] = part
+        return fetch_part_info_uncoalesced(parttype = parttype, l_barcodes = l_barcodes, location_id = location_id, refresh = refresh)
+    
+    # The location only shapes the query plan, the information of a part does not depend on it (but on the SiPM Vbr mode)
+    d_parts = part_flight.get_many(
+        ("part_info", parttype, SIPM_VBR_AGGREGATE),
+        [str(_bc) for _bc in l_barcodes],
+        lambda _l_barcodes: fetch_part_info_uncoalesced(parttype = parttype, l_barcodes = _l_barcodes, location_id = location_id, refresh = refresh),
+        refresh = is_db_refresh(refresh),
+        # The callers modify the parts (e.g. combine_parts), so the parts shared with other requests are copies
+        copy = copy.deepcopy,
+    )
+    
+    return d_parts
+
+
+def fetch_part_info_uncoalesced(parttype, l_barcodes, location_id = None, refresh = False) :
+    """
+    Fetch the information of a list of parts from the database (see fetch_part_info)
+    """
+    
+    # Plan the queries: ranges for (nearly) consecutive barcodes and IN lists for the others
+    # Ranges are never merged across the barcode ranges allocated to the locations
+    # Additional barcodes fetched by the ranges (such as those not at the desired location) are filtered out later
+    plan = queryplan.plan_barcode_queries(
+        l_barcodes = l_barcodes,
+        l_allowed_ranges = get_location_barcode_range(parttype = parttype, location_id = location_id),
+        max_in_list = DB_IN_LIST_SIZE,
+    )
+    print(plan.describe())
     
+    set_barcodes = set(l_barcodes)
+    d_parts = {}
     
-    else :
+    for iquery, planned_query in enumerate(plan.l_queries) :
         
-        logger.error(f"Part type {parttype} not recognized.")
-        sys.exit(1)
+        print(f"Fetching barcode group {iquery+1}/{len(plan.l_queries)} having {planned_query.nbarcodes} {parttype}(s) ...")
+        
+        d_parts_fetched = get_part_info(
+            barcode_min = None,
+            barcode_max = None,
+            parttype = parttype,
+            l_barcode_ranges = planned_query.l_ranges,
+            l_barcodes = planned_query.l_barcodes,
+            refresh = refresh,
+        )
+        
+        # Filter out the additional barcodes
+        d_parts_fetched = {_key: _val for _key, _val in d_parts_fetched.items() if _key in set_barcodes}
+        
+        d_parts.update(d_parts_fetched)
     
     return d_parts
 
 
+def needs_fetch(parttype, part) :
+    """
+    Whether a part loaded from a part info file has to be fetched from the database (again):
+    not in the file, or a SiPM saved with its Vbr statistics only (aggregate mode) when the per-channel Vbrs are wanted
+    """
+    
+    if not part :
+        
+        return True
+    
+    return (parttype == constants.SIPM.KIND_OF_PART and part.vbrs is None and not SIPM_VBR_AGGREGATE)
+
+
+def get_input_parts(parttype, yamlfile, d_inparts = None) :
+    """
+    Parts to update: a copy of d_inparts if provided (so it is not parsed again), otherwise the parts loaded from yamlfile (if any)
+    """
+    
+    if (d_inparts is not None) :
+        
+        return dict(d_inparts)
+    
+    return load_part_info(parttype = parttype, yamlfile = yamlfile) if yamlfile else {}
+
+
 def get_all_part_info(
     parttype,
     location_id = None,
@@ -921,20 +1563,22 @@ def get_all_part_info(
     nodb = False,
     barcode_min = None,
     barcode_max = None,
-    l_barcode_ranges = []
+    l_barcode_ranges = [],
+    d_inparts = None,
 ) :
     """
     Get the information for all parts
     If yamlfile is provided, will load the information from there
+    (or use d_inparts if provided: the parts already loaded from yamlfile, for e.g. by load_part_info; the dictionary is not modified)
     Will fetch the information of addtional SMs from the database if they are not in the file
     """
     
     check_parttype(parttype)
     
-    d_parts = load_part_info(parttype = parttype, yamlfile = yamlfile) if yamlfile else {}
+    d_parts = get_input_parts(parttype = parttype, yamlfile = yamlfile, d_inparts = d_inparts)
     
     if (not nodb) :
-         
+        
         print(f"Fetching {parttype} information from the database ... ")
         l_part_barcodes = get_part_barcodes(
             parttype = parttype,
@@ -946,59 +1590,252 @@ def get_all_part_info(
         print(f"Found {len(l_part_barcodes)} {parttype}(s) on the database.")
         
         # Only fetch the ones that have not already been loaded
-        l_part_barcodes = list(set(l_part_barcodes) - set(list(d_parts.keys())))
+        l_part_barcodes = [_bc for _bc in set(l_part_barcodes) if needs_fetch(parttype, d_parts.get(_bc, None))]
         print(f"Fetching {len(l_part_barcodes)} {parttype}(s) from the database ...")
         
-        # Group the barcodes and then use ranges to fetch from database
-        # Significantly faster than looping over barcodes
-        l_part_barcodes_int = sorted([int(_bc) for _bc in l_part_barcodes if _bc.isdigit()])
-        l_barcode_groups_tmp = [list(group) for group in more_itertools.consecutive_groups(l_part_barcodes_int)]
+        d_parts.update(fetch_part_info(parttype = parttype, l_barcodes = l_part_barcodes, location_id = location_id))
+    
+    print(f"Found information for {len(d_parts)} {parttype}(s) in total.")
+    
+    return d_parts
+
+
+def get_sync_state_file(yamlfile) :
+    """
+    Sidecar file with the incremental sync state of a part info file
+    """
+    
+    return f"{os.path.splitext(yamlfile)[0]}_sync.json"
+
+
+def get_part_snapshot(
+    parttype,
+    location_id = None,
+    barcode_min = None,
+    barcode_max = None,
+    l_barcode_ranges = [],
+    min_id = None,
+    refresh = True,
+) :
+    """
+    Get a slim snapshot of the parts from the database:
+    {barcode: {"id": id, "location_id": location id, "daughters": [[daughter barcode, position], ...]}}
+    Only the columns needed to detect new, relocated or reparented parts are fetched
+    If min_id is provided, only the parts with a larger ID (added since) and their daughters are read
+    By default (refresh), the cached query results are not used
+    """
+    
+    query, d_params = get_part_selection_query(
+        parttype = parttype,
+        location_id = location_id,
+        barcode_min = barcode_min,
+        barcode_max = barcode_max,
+        l_barcode_ranges = l_barcode_ranges,
+        l_columns = ["ID", "BARCODE", "LOCATION_ID"],
+        min_id = min_id,
+    )
+    print(query)
+    
+    d_snapshot = {}
+    d_id_barcodes = {}
+    
+    for infodict in iter_db_query(query, params = d_params, refresh = refresh) :
+        
+        barcode = str(infodict["barcode"]).strip()
+        d_snapshot[barcode] = {"id": str(infodict["id"]), "location_id": infodict["locationId"], "daughters": []}
+        d_id_barcodes[infodict["id"]] = barcode
+    
+    if (parttype not in [constants.SM.KIND_OF_PART, constants.DM.KIND_OF_PART, constants.RU.KIND_OF_PART, constants.TRAY.KIND_OF_PART]) :
         
-        # Merge groups if they span < 1000
-        # Otherwise there can be too many groups which takes a long time to query
-        # However, this may add additional barcodes that are not needed (such as those not at the desired location)
-        # Filter them out later
-        # N.B. Do not do this for RUs and Trays as their barcodes are not always sequential
-        l_barcode_groups = []
-        for igroup, group in enumerate(l_barcode_groups_tmp) :
-            
-            if (not l_barcode_groups) :
-                
-                l_barcode_groups.append(group)
-            
-            else :
-                
-                barcode_min = l_barcode_groups[-1][0]
-                barcode_max = group[-1] if (len(group) > 1) else group[0]
-                
-                if parttype not in [constants.RU.KIND_OF_PART, constants.TRAY.KIND_OF_PART] and (barcode_max-barcode_min) < 1000 :
-                    
-                    l_barcode_groups[-1].extend(group)
-                
-                else :
-                    
-                    l_barcode_groups.append(group)
+        return d_snapshot
+    
+    l_queries = []
+    
+    for l_parent_ids_tmp in more_itertools.chunked(list(d_id_barcodes.keys()), DB_IN_LIST_SIZE) :
+        
+        d_params = {}
+        query = f"select {dbschema.get_projection('parts', DAUGHTER_INFO_COLUMNS)} from mtd_cmsr.parts s where s.PART_PARENT_ID in {get_bind_list(l_parent_ids_tmp, 'pid', d_params)}"
+        print(query)
+        
+        l_queries.append((query, d_params))
+    
+    l_daughter_infodicts = list(itertools.chain(*run_db_queries(l_queries, refresh = refresh)))
+    
+    # Positions of the daughters in their parents
+    d_daughter_barcodes = {_parttype: [] for _parttype in [constants.SIPM.KIND_OF_PART, constants.SM.KIND_OF_PART, constants.DM.KIND_OF_PART, constants.RU.KIND_OF_PART]}
+    
+    for infodict in l_daughter_infodicts :
         
-        for igroup, group in enumerate(l_barcode_groups) :
+        if (infodict["kindOfPart"] in d_daughter_barcodes) :
             
-            #print(group)
-            barcode_min = group[0]
-            barcode_max = group[-1] if (len(group) > 1) else group[0]
+            d_daughter_barcodes[infodict["kindOfPart"]].append(str(infodict["barcode"]))
+    
+    d_daughter_positions = {}
+    
+    for daughter_parttype, l_parts in d_daughter_barcodes.items() :
+        
+        if len(l_parts) :
             
-            print(f"Fetching barcode group {igroup+1}/{len(l_barcode_groups)} having {len(group)} {parttype}(s) ...")
+            d_daughter_positions.update(get_part_position(barcode_min = None, barcode_max = None, parttype = daughter_parttype, l_barcodes = l_parts, refresh = refresh))
+    
+    for infodict in l_daughter_infodicts :
+        
+        barcode = str(infodict["barcode"])
+        d_snapshot[d_id_barcodes[infodict["partParentId"]]]["daughters"].append([barcode, d_daughter_positions.get(barcode, None)])
+    
+    for snapshot in d_snapshot.values() :
+        
+        snapshot["daughters"].sort(key = lambda _x: _x[0])
+    
+    return d_snapshot
+
+
+def sync_all_part_info(
+    parttype,
+    yamlfile,
+    statefile,
+    location_id = None,
+    barcode_min = None,
+    barcode_max = None,
+    l_barcode_ranges = [],
+    check_changes = None,
+    d_inparts = None,
+) :
+    """
+    Incrementally update the part information loaded from yamlfile
+    Fetches the parts added since the last sync (ID above its high-water mark) and the ones that are not in yamlfile
+    If check_changes (default: BTL_SYNC_CHECK_CHANGES), also fetches the parts whose location, daughters or daughter positions changed,
+    found by comparing a slim snapshot of all the parts (see get_part_snapshot) with the one of the last sync
+    Without a previous sync state, the snapshot of all the parts is read and only the parts that are not in yamlfile are fetched
+    d_inparts are the parts already loaded from yamlfile, if any (see get_all_part_info)
+    The database is always queried (the cached query results may be older than the last sync)
+    Returns the dictionary of parts and the new sync state (to be saved with save_sync_state)
+    """
+    
+    check_parttype(parttype)
+    
+    check_changes = SYNC_CHECK_CHANGES if (check_changes is None) else check_changes
+    
+    d_parts = get_input_parts(parttype = parttype, yamlfile = yamlfile, d_inparts = d_inparts)
+    
+    d_selection = {
+        "location_id": location_id,
+        "barcode_min": barcode_min,
+        "barcode_max": barcode_max,
+        "barcode_ranges": [list(_range) for _range in l_barcode_ranges],
+    }
+    
+    d_state_prev = {}
+    
+    if (os.path.exists(statefile)) :
+        
+        with open(statefile, "r") as fopen :
             
-            d_parts_fetched = get_part_info(
-                barcode_min = str(barcode_min),
-                barcode_max = str(barcode_max),
-                parttype = parttype
-            )
+            d_state_prev = json.load(fopen)
+        
+        # The previous snapshot cannot be compared if the selection changed
+        if (d_state_prev.get("parttype") != parttype or d_state_prev.get("selection") != json.loads(json.dumps(d_selection))) :
             
-            # Filter out the additional barcodes
-            d_parts_fetched = {_key: _val for _key, _val in d_parts_fetched.items() if _key in l_part_barcodes}
+            print(f"Sync state {statefile} is for a different selection; ignoring it.")
+            d_state_prev = {}
+    
+    d_snapshot_prev = d_state_prev.get("parts", {})
+    max_id_prev = d_state_prev.get("max_id", None)
+    
+    # Only the parts added since the last sync are read, unless the changes are checked (or there is no previous sync)
+    check_changes = check_changes or (max_id_prev is None)
+    
+    print(f"Fetching {parttype} snapshot from the database{'' if check_changes else f' (parts with ID > {max_id_prev})'} ... ")
+    d_snapshot_db = get_part_snapshot(
+        parttype = parttype,
+        location_id = location_id,
+        barcode_min = barcode_min,
+        barcode_max = barcode_max,
+        l_barcode_ranges = l_barcode_ranges,
+        min_id = None if check_changes else max_id_prev,
+        refresh = True,
+    )
+    print(f"Found {len(d_snapshot_db)} {parttype}(s) on the database.")
+    
+    d_snapshot = d_snapshot_db if check_changes else {**d_snapshot_prev, **d_snapshot_db}
+    
+    l_new = [_bc for _bc, _snap in d_snapshot.items() if (needs_fetch(parttype, d_parts.get(_bc, None)) or (max_id_prev is not None and int(_snap["id"]) > max_id_prev))]
+    l_changed = []
+    l_removed = []
+    
+    if check_changes :
+        
+        l_changed = [_bc for _bc, _snap in d_snapshot.items() if (_bc in d_snapshot_prev and _snap != d_snapshot_prev[_bc] and _bc not in l_new)]
+        
+        # Parts that left the selection (e.g. moved to another location) are updated as well
+        l_removed = [_bc for _bc in d_snapshot_prev if (_bc not in d_snapshot and d_parts.get(_bc))]
+    
+    print(f"Sync {parttype}: {len(l_new)} new, {len(l_changed)} changed, {len(l_removed)} left the selection.")
+    
+    l_part_barcodes = l_new + l_changed + l_removed
+    d_parts_fetched = fetch_part_info(parttype = parttype, l_barcodes = l_part_barcodes, location_id = location_id, refresh = True)
+    
+    # Parts that could not be fetched (e.g. incomplete assembly) are dropped
+    for barcode in l_part_barcodes :
+        
+        d_parts[barcode] = d_parts_fetched.get(barcode, None)
+    
+    d_state = {
+        "parttype": parttype,
+        "selection": d_selection,
+        "max_id": max([int(_snap["id"]) for _snap in d_snapshot.values()], default = max_id_prev),
+        "synced": time.time(),
+        "checked": time.time() if check_changes else d_state_prev.get("checked", None),
+        "parts": d_snapshot,
+    }
+    
+    print(f"Found information for {len([_val for _val in d_parts.values() if _val])} {parttype}(s) in total.")
+    
+    return d_parts, d_state
+
+
+def save_sync_state(d_state, statefile) :
+    
+    with open(f"{statefile}.tmp", "w") as fopen :
+        
+        json.dump(d_state, fopen)
+    
+    os.replace(f"{statefile}.tmp", statefile)
+
+
+def part_info_exists(yamlfile) :
+    """
+    Whether there is part info for yamlfile: the YAML file or its binary store (see infostore)
+    """
+    
+    return os.path.exists(yamlfile) or (INFO_STORE and infostore.is_fresh(yamlfile))
+
+
+def read_part_info_file(parttype, yamlfile) :
+    """
+    Read the part dictionaries of yamlfile ({barcode: dict})
+    The binary store of the file is read instead if the file did not change since the store was saved (see infostore); otherwise the store is (re)created from the YAML file
+    """
+    
+    if INFO_STORE :
+        
+        d_parts = infostore.load(yamlfile)
+        
+        if (d_parts is not None) :
             
-            d_parts.update(d_parts_fetched)
+            print(f"Loading {parttype} information from file: {infostore.get_store_file(yamlfile)} ...")
+            return d_parts
     
-    print(f"Found information for {len(d_parts)} {parttype}(s) in total.")
+    print(f"Loading {parttype} information from file: {yamlfile} ...")
+    
+    # Plain values: the part info files are written back from the part objects (see write_part_info), not from the loaded YAML
+    with open(yamlfile, "r") as fopen :
+        
+        d_parts = safe_load_yaml(fopen.read()) or {}
+    
+    if INFO_STORE :
+        
+        infostore.save(yamlfile, d_parts, parttype = parttype)
     
     return d_parts
 
@@ -1024,18 +1861,18 @@ def load_part_info(parttype, yamlfile, resultsyaml = None, extrainfo = None) :
         print(f"Loading results from file: {resultsyaml} ...")
         with open(resultsyaml, "r") as fopen :
             
-            d_results = yaml.load(fopen.read())["results"]
+            d_results = safe_load_yaml(fopen.read())["results"]
     
-    if (os.path.exists(yamlfile)) :
+    if (part_info_exists(yamlfile)) :
         
-        print(f"Loading {parttype} information from file: {yamlfile} ...")
+        d_parts = read_part_info_file(parttype = parttype, yamlfile = yamlfile)
         
-        with open(yamlfile, "r") as fopen :
+        # Convert dict to object
+        if (parttype == constants.LYSO.KIND_OF_PART) :
             
-            d_parts = yaml.load(fopen.read())
+            d_parts = {_key: Lyso(**_val) for _key, _val in d_parts.items()}
         
-        # Convert dict to object
-        if (parttype == constants.SIPM.KIND_OF_PART) :
+        elif (parttype == constants.SIPM.KIND_OF_PART) :
             
             d_parts = {_key: SiPMArray(**_val) for _key, _val in d_parts.items()}
         
@@ -1108,7 +1945,7 @@ def load_part_info(parttype, yamlfile, resultsyaml = None, extrainfo = None) :
                         
                         logger.error(f"Found {len(col_val)} occurences of barcode {barcode} in {extrafname}; needs to exactly one occurence.")
                         sys.exit(1)
-                        
+                    
                     #setattr(d_parts[barcode], col_name, col_val)
                     d_parts[barcode].extra[col_name] = col_val
     
@@ -1119,6 +1956,30 @@ def load_part_info(parttype, yamlfile, resultsyaml = None, extrainfo = None) :
     return d_parts
 
 
+def load_part_table(parttype, yamlfile) :
+    """
+    Load part info from yamlfile into a columnar table (see parttable.PartTable)
+    Same parts as load_part_info, but the part objects are only created for the barcodes that are accessed
+    """
+    
+    check_parttype(parttype)
+    
+    d_dicts = {}
+    
+    if (part_info_exists(yamlfile)) :
+        
+        d_dicts = read_part_info_file(parttype = parttype, yamlfile = yamlfile)
+    
+    else :
+        
+        print(f"{parttype} information file ({yamlfile}) does not exist. No {parttype} information loaded.")
+    
+    table = parttable.PartTable(PART_CLASSES[parttype], d_dicts or {})
+    print(f"Loaded information for {len(table)} {parttype}(s).")
+    
+    return table
+
+
 def combine_parts(d_sipms = {}, d_sms = {}, d_dms = {}, d_rus = {}, d_trays = {}) :
     
     if (d_sipms) :
@@ -1151,6 +2012,13 @@ def combine_parts(d_sipms = {}, d_sms = {}, d_dms = {}, d_rus = {}, d_trays = {}
 
 
 def get_location_barcode_range(parttype, location_id) :
+    """
+    Get the list of (min, max) barcode ranges allocated to the location(s) for a part type
+    All locations are used if location_id is None
+    """
+    
+    if (location_id is None) :
+        location_id = list(check_parttype(parttype).BARCODE_RANGES.keys())
     
     location_id = [location_id] if isinstance(location_id, int) else location_id
     
@@ -1185,40 +2053,88 @@ def save_all_part_info(
     nodb = False,
     barcode_min = None,
     barcode_max = None,
-    l_barcode_ranges = []
+    l_barcode_ranges = [],
+    incremental = None,
+    check_changes = None,
+    d_inparts = None,
 ) :
     """
-    Load existing part info from inyamlfile
+    Load existing part info from inyamlfile (or use d_inparts, the parts already loaded from it; see get_all_part_info)
     Fetch additional part info from database
     Save all part info into outyamlfile
+    If incremental (default: BTL_INCREMENTAL_SYNC), only fetch the parts added since the last sync,
+    and if check_changes (default: BTL_SYNC_CHECK_CHANGES) also the ones that changed (see sync_all_part_info)
     """
     
     check_parttype(parttype)
     
+    incremental = INCREMENTAL_SYNC if (incremental is None) else incremental
+    
     if (barcode_min is not None and barcode_max is not None) :
         l_barcode_ranges = l_barcode_ranges + [(barcode_min, barcode_max)]
     
     if use_location_barcode_range :
         
-        l_barcode_ranges.extend(get_location_barcode_range(
+        l_barcode_ranges = l_barcode_ranges + get_location_barcode_range(
             parttype = parttype,
             location_id = location_id
-        ))
+        )
         
         location_id = None
     
-    d_parts_orig = get_all_part_info(
-        parttype = parttype,
-        yamlfile = inyamlfile,
-        location_id = location_id,
-        nodb = nodb,
-        barcode_min = barcode_min,
-        barcode_max = barcode_max,
-        l_barcode_ranges = l_barcode_ranges
-    )
+    d_sync_state = None
+    
+    if (incremental and not nodb) :
+        
+        d_parts_orig, d_sync_state = sync_all_part_info(
+            parttype = parttype,
+            yamlfile = inyamlfile,
+            statefile = get_sync_state_file(outyamlfile),
+            location_id = location_id,
+            barcode_min = barcode_min,
+            barcode_max = barcode_max,
+            l_barcode_ranges = l_barcode_ranges,
+            check_changes = check_changes,
+            d_inparts = d_inparts,
+        )
+    
+    else :
+        
+        d_parts_orig = get_all_part_info(
+            parttype = parttype,
+            yamlfile = inyamlfile,
+            location_id = location_id,
+            nodb = nodb,
+            barcode_min = barcode_min,
+            barcode_max = barcode_max,
+            l_barcode_ranges = l_barcode_ranges,
+            d_inparts = d_inparts,
+        )
+    
+    d_parts = write_part_info(d_parts = d_parts_orig, parttype = parttype, outyamlfile = outyamlfile)
+    
+    # Only save the sync state once the part info is saved
+    if (d_sync_state is not None) :
+        
+        save_sync_state(d_sync_state, get_sync_state_file(outyamlfile))
+    
+    if ret :
+        
+        return d_parts_orig
+    
+    elif ret_dict :
+        
+        return d_parts
+
+
+def write_part_info(d_parts, parttype, outyamlfile) :
+    """
+    Save the part info (objects) into outyamlfile and its binary store (see BTL_INFO_YAML and BTL_INFO_STORE)
+    Returns the saved dictionaries
+    """
     
     # Convert objects to dicts
-    d_parts = {_key: _val.dict() for _key, _val in d_parts_orig.items() if _val}
+    d_parts = {_key: _val.dict() for _key, _val in d_parts.items() if _val}
     
     outdir = os.path.dirname(outyamlfile)
     
@@ -1226,21 +2142,113 @@ def save_all_part_info(
         
         os.system(f"mkdir -p {outdir}")
     
-    print(f"Saving {parttype} information to file: {outyamlfile} ...")
+    # The YAML file is written first, so that the store is newer
+    if (INFO_YAML or not INFO_STORE) :
+        
+        print(f"Saving {parttype} information to file: {outyamlfile} ...")
+        
+        with open(outyamlfile, "w") as fopen :
+            
+            with yaml_lock :
+                
+                yaml.dump(d_parts, fopen)
     
-    with open(outyamlfile, "w") as fopen :
+    if INFO_STORE :
         
-        yaml.dump(d_parts, fopen)
+        print(f"Saving {parttype} information to file: {infostore.get_store_file(outyamlfile)} ...")
+        infostore.save(outyamlfile, d_parts, parttype = parttype)
     
     print(f"Saved information for {len(d_parts)} {parttype}(s).")
     
-    if ret :
+    return d_parts
+
+
+# Levels of the tray hierarchy followed by sync_tray_hierarchy: part type and the daughter barcodes of a part for each daughter type
+TRAY_HIERARCHY = [
+    (constants.TRAY.KIND_OF_PART, {constants.RU.KIND_OF_PART: lambda _tray: _tray.rus.values() if _tray.rus else []}),
+    (constants.RU.KIND_OF_PART, {constants.DM.KIND_OF_PART: lambda _ru: _ru.dms.values() if _ru.dms else []}),
+    (constants.DM.KIND_OF_PART, {constants.SM.KIND_OF_PART: lambda _dm: [_dm.sm1, _dm.sm2]}),
+    (constants.SM.KIND_OF_PART, {constants.SIPM.KIND_OF_PART: lambda _sm: [_sm.sipm1, _sm.sipm2], constants.LYSO.KIND_OF_PART: lambda _sm: [_sm.lyso]}),
+    (constants.SIPM.KIND_OF_PART, {}),
+    (constants.LYSO.KIND_OF_PART, {}),
+]
+
+
+def sync_tray_hierarchy(
+    location_id = None,
+    l_tray_barcodes = None,
+    d_yamlfiles = {},
+    nodb = False,
+) :
+    """
+    Get the trays and the parts mounted in them, top-down: Tray -> RU -> DM -> SM -> SiPM/LYSO
+    The trays are the ones at location_id, or l_tray_barcodes if provided
+    Each level is fetched at once (see fetch_part_info) for the daughters of the level above, so only the mounted parts are fetched
+    d_yamlfiles ({part type: yaml file}) are the part info files of each type:
+    the parts found there are not fetched again, and the files are saved (once) with the fetched parts at the end
+    Returns the parts of each type ({part type: {barcode: part}}), not linked (see partgraph.PartGraph)
+    """
+    
+    d_stores = {}
+    d_barcodes = {constants.TRAY.KIND_OF_PART: None if (l_tray_barcodes is None) else [str(_bc) for _bc in l_tray_barcodes]}
+    
+    for parttype, d_daughter_funcs in TRAY_HIERARCHY :
         
-        return d_parts_orig
+        d_store = load_part_info(parttype = parttype, yamlfile = d_yamlfiles[parttype]) if (parttype in d_yamlfiles) else {}
+        d_stores[parttype] = d_store
+        
+        l_barcodes = d_barcodes.get(parttype, [])
+        
+        if (l_barcodes is None) :
+            
+            l_location_ids = list(location_id) if isinstance(location_id, (list, tuple)) else [location_id]
+            l_barcodes = [_bc for _bc, _part in d_store.items() if _part and (location_id is None or _part.location_id in l_location_ids)]
+            
+            if (not nodb) :
+                
+                l_barcodes = get_part_barcodes(parttype = parttype, location_id = location_id)
+        
+        l_fetch = [_bc for _bc in l_barcodes if needs_fetch(parttype, d_store.get(_bc, None))]
+        print(f"Sync {parttype}: {len(l_barcodes)} mounted, {len(l_fetch)} to fetch from the database.")
+        
+        if (len(l_fetch) and not nodb) :
+            
+            d_store.update(fetch_part_info(parttype = parttype, l_barcodes = l_fetch))
+        
+        l_parts = [d_store[_bc] for _bc in l_barcodes if d_store.get(_bc)]
+        
+        for daughter_parttype, daughter_func in d_daughter_funcs.items() :
+            
+            d_barcodes[daughter_parttype] = list(dict.fromkeys(str(_bc) for _part in l_parts for _bc in daughter_func(_part) if _bc))
     
-    elif ret_dict :
+    for parttype, yamlfile in d_yamlfiles.items() :
         
-        return d_parts
+        write_part_info(d_parts = d_stores[parttype], parttype = parttype, outyamlfile = yamlfile)
+    
+    return d_stores
+
+
+def gather_all_part_info(l_kwargs) :
+    """
+    Run save_all_part_info for each dictionary of arguments in l_kwargs concurrently (e.g. for several part types and locations)
+    The runs query the database on DB_PORT (BTL_DB_PORT) and share its RhApi instance: its connection pool (rhapi.DEFAULT_POOL_SIZE connections, blocking when all are in use)
+    is what bounds the number of concurrent requests to the tunnel, whatever the number of runs and of their query threads
+    Returns the list of the results in the order of l_kwargs
+    From asyncio code, see rhapi.AsyncRhApi for concurrent queries instead
+    """
+    
+    if (not HAS_REQUESTS or USE_RHAPI_SUBPROCESS or len(l_kwargs) <= 1) :
+        
+        return [save_all_part_info(**_kwargs) for _kwargs in l_kwargs]
+    
+    # Create the shared instance before the runs start
+    get_rhapi()
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers = min(DB_QUERY_WORKERS, len(l_kwargs))) as executor :
+        
+        l_futures = [dbprofile.submit(executor, save_all_part_info, **_kwargs) for _kwargs in l_kwargs]
+        
+        return [_future.result() for _future in l_futures]
 
 
 def handle_flows(hist, underflow = True, overflow = True) :
@@ -1304,7 +2312,7 @@ def get_canvas(ratio = False) :
         #canvas.SetBottomMargin(0.135)
         canvas.SetLeftMargin(0.125)
         canvas.SetRightMargin(0.05)
-
+    
     
     return canvas
 
@@ -1480,7 +2488,7 @@ def root_plot1D(
     stack.GetYaxis().SetTitleOffset(1)
     
     #stack.SetTitle(title)
-
+    
     stack.GetXaxis().CenterTitle(centertitlex)
     stack.GetYaxis().CenterTitle(centertitley)
     
@@ -1606,7 +2614,7 @@ def root_plot1D(
     outfile_noext = os.path.splitext(outfile)[0]
     
     if (len(outdir)) :
-    
+        
         os.system(f"mkdir -p {outdir}")
     
     canvas.SaveAs(f"{outfile_noext}.pdf")
@@ -1784,5 +2792,5 @@ def root_get_fn_expr(
 def load_yaml_file(fname) :
     d_cfg = {}
     with open(fname, "r") as fopen :
-        d_cfg = yaml.load(fopen.read())
+        d_cfg = safe_load_yaml(fopen.read())
     return d_cfg
@@ -1,13 +1,10 @@
 #! /usr/bin/env python3
 
-import ast
 import numpy
 import random
-import subprocess
 
 import python.utils as utils
 from utils import logging
-from utils import yaml
 
 def main():
     
@@ -16,18 +13,11 @@ def main():
     
     with open(dm_cat_file, "r") as fopen :
             
-        d_dm_info = yaml.load(fopen.read())
-    
-    dbquery_output = subprocess.run([
-        "./python/rhapi.py",
-        "-u", "http://localhost:8113",
-        "-a",
-        "-f", "json2",
-        "select s.BARCODE from mtd_cmsr.parts s where s.KIND_OF_PART = 'DetectorModule' and (s.PART_PARENT_ID is NULL or s.PART_PARENT_ID = 1000) and s.LOCATION_ID = 5023",
-    ], stdout = subprocess.PIPE, check = True)
-    
-    dbquery_output = dbquery_output.stdout.decode("utf-8")
-    l_dms_tmp = ast.literal_eval(dbquery_output)["data"]
+        d_dm_info = utils.safe_load_yaml(fopen.read())
+    
+    l_dms_tmp = utils.run_db_query(
+        "select s.BARCODE from mtd_cmsr.parts s where s.KIND_OF_PART = 'DetectorModule' and (s.PART_PARENT_ID is NULL or s.PART_PARENT_ID = 1000) and s.LOCATION_ID = 5023"
+    )
     l_dms_tmp = [str(_dm["barcode"]) for _dm in l_dms_tmp]
     
     l_bin_edges = [
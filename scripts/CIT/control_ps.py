@@ -9,7 +9,6 @@ import time
 import python.utils as utils
 
 from utils import logging
-from utils import yaml
 
 
 TIME_INTERVAL = 2 # Seconds
@@ -237,7 +236,7 @@ def main() :
     
     with open(args.pscfg, "r") as fopen :
         
-        d_pscfgs = yaml.load(fopen.read())
+        d_pscfgs = utils.safe_load_yaml(fopen.read())
     
     pscfg = d_pscfgs[args.mode]
     
@@ -3,6 +3,7 @@
 import os
 import python.constants as constants
 import python.utils as utils
+import python.partgraph as partgraph
 
 location = "CIT"
 
@@ -11,56 +12,23 @@ location = "CIT"
 #location_id = constants.LOCATION.MIB
 location_id = getattr(constants.LOCATION, location)
 
-d_sipms = utils.save_all_part_info(
-    parttype = constants.SIPM.KIND_OF_PART,
-    outyamlfile = f"info/{location}/sipm_info.yaml",
-    inyamlfile = f"info/{location}/sipm_info.yaml",
+# Top-down sync of the trays and the parts mounted in them (only the missing parts are fetched)
+d_stores = utils.sync_tray_hierarchy(
     location_id = location_id,
-    ret = True,
-    use_location_barcode_range = False,
+    d_yamlfiles = {
+        constants.SIPM.KIND_OF_PART: f"info/{location}/sipm_info.yaml",
+        constants.LYSO.KIND_OF_PART: f"info/{location}/lyso_info.yaml",
+        constants.SM.KIND_OF_PART: f"info/{location}/sm_info.yaml",
+        constants.DM.KIND_OF_PART: f"info/{location}/dm_info.yaml",
+        constants.RU.KIND_OF_PART: f"info/{location}/ru_info.yaml",
+        constants.TRAY.KIND_OF_PART: f"info/{location}/tray_info.yaml",
+    },
 )
 
-d_sms = utils.save_all_part_info(
-    parttype = constants.SM.KIND_OF_PART,
-    outyamlfile = f"info/{location}/sm_info.yaml",
-    inyamlfile = f"info/{location}/sm_info.yaml",
-    location_id = location_id,
-    ret = True,
-)
-
-d_dms =  utils.save_all_part_info(
-    parttype = constants.DM.KIND_OF_PART,
-    outyamlfile = f"info/{location}/dm_info.yaml",
-    inyamlfile = f"info/{location}/dm_info.yaml",
-    location_id = location_id,
-    ret = True,
-)
-
-d_rus = utils.save_all_part_info(
-    parttype = constants.RU.KIND_OF_PART,
-    outyamlfile = f"info/{location}/ru_info.yaml",
-    inyamlfile = f"info/{location}/ru_info.yaml",
-    location_id = location_id,
-    ret = True,
-)
-
-d_trays = utils.save_all_part_info(
-    parttype = constants.TRAY.KIND_OF_PART,
-    outyamlfile = f"info/{location}/tray_info.yaml",
-    inyamlfile = f"info/{location}/tray_info.yaml",
-    location_id = location_id,
-    ret = True,
-)
-
-utils.combine_parts(
-    d_sipms = d_sipms,
-    d_sms = d_sms,
-    d_dms = d_dms,
-    d_rus = d_rus,
-    d_trays = d_trays,
-)
+graph = partgraph.PartGraph.from_stores(d_stores)
 
-d_parts = {_key: _val.dict() for _key, _val in d_trays.items() if _val}
+# The trays with their mounted parts
+d_parts = {_key: graph.linked(_key).dict() for _key in graph.parts(constants.TRAY.KIND_OF_PART)}
 
 outyamlfile = f"info/{location}/full-tray_info.yaml"
 outdir = os.path.dirname(outyamlfile)